@@ -0,0 +1,133 @@
+import math
+import functools
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from font_fitting import fit_font_size
+
+
+def arc_curve_degree(width, token_diameter):
+    """
+    Returns the angle in degrees of the arc a text of the given width is curved along.
+
+    The curve angle can be found by treating the text width as a chord length and the token width as the diameter.
+    By bisecting this chord we can create a right triangle and solve for the angle.
+    If the text width is greater than the token width, the angle will be greater than 180 degrees.
+    """
+    additional_curve = 0
+    if width > token_diameter:
+        width = width - token_diameter
+        additional_curve = 180
+    return round(math.degrees(2 * math.asin((width / 2) / (token_diameter / 2)))) + additional_curve
+
+
+@functools.lru_cache(maxsize=64)
+def load_font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
+
+
+def measure_text(text, font_path, font_size):
+    """
+    Returns the (width, height) of a text drawn with PIL, the height being the one of the font line.
+    """
+    font = load_font(font_path, font_size)
+    ascent, descent = font.getmetrics()
+    return int(font.getlength(text)), ascent + descent
+
+
+def fit_text(text, font_path, font_size, max_width):
+    """
+    Downsizes the font by 5% steps until the text fits in max_width.
+    Returns the font and the (width, height) of the text.
+    """
+    font_size, (width, height) = fit_font_size(text, font_path, font_size, max_width,
+                                               lambda size: measure_text(text, font_path, size), 'pil')
+    return load_font(font_path, font_size), (width, height)
+
+
+def render_text_strip(text, font, width, height, color='#000000'):
+    """
+    Draws the text on a transparent strip, its baseline at y=height like ImageMagick draws it.
+    """
+    strip = Image.new('RGBA', (max(width, 1), int(height * 1.2)), (0, 0, 0, 0))
+    ImageDraw.Draw(strip).text((0, height), text, font=font, fill=color, anchor='ls')
+    return strip
+
+
+@functools.lru_cache(maxsize=256)
+def arc_remap_grid(columns, rows, curve_degree):
+    """
+    Returns the source coordinates (x, y) of every pixel of the curved image, and its size.
+
+    This is the inverse polar mapping of ImageMagick's "-distort arc {curve_degree} 180" applied to a text
+    strip rotated by 180 degrees: the arc is centered below its center, the middle row of the strip has the
+    strip's length, and the top of the text faces the center so the text reads left to right.
+    """
+    arc = math.radians(curve_degree)
+    pixels_per_radian = columns / arc
+    outer_radius = pixels_per_radian + rows / 2
+    inner_radius = outer_radius - rows
+
+    # Bounding box of the arc band, the arc being centered on the positive y axis (image y goes down)
+    angles = np.linspace(-arc / 2, arc / 2, 361)
+    extremes = [angle for angle in (-math.pi, -math.pi / 2, 0, math.pi / 2, math.pi) if -arc / 2 <= angle <= arc / 2]
+    angles = np.concatenate([angles, extremes])
+    radii = np.array([inner_radius, outer_radius])[:, None]
+    xs, ys = radii * np.sin(angles), radii * np.cos(angles)
+    left, top = math.floor(xs.min()), math.floor(ys.min())
+    width, height = math.ceil(xs.max()) - left, math.ceil(ys.max()) - top
+
+    # Polar coordinates of every destination pixel center, mapped back onto the strip
+    dest_y, dest_x = np.mgrid[0:height, 0:width].astype(np.float64)
+    dest_x += left + 0.5
+    dest_y += top + 0.5
+    source_x = np.arctan2(dest_x, dest_y) * pixels_per_radian + columns / 2 - 0.5
+    source_y = np.hypot(dest_x, dest_y) - inner_radius - 0.5
+    return source_x, source_y, (width, height)
+
+
+def arc_distort(strip, curve_degree):
+    """
+    Curves a text strip along an arc of curve_degree degrees, with a bilinear inverse polar remap.
+    """
+    if curve_degree <= 0:
+        return strip
+    columns, rows = strip.size
+    source_x, source_y, size = arc_remap_grid(columns, rows, curve_degree)
+
+    # Premultiplied alpha so transparent pixels do not bleed their color, padded by one transparent pixel
+    pixels = np.asarray(strip, dtype=np.float32) / 255
+    pixels[..., :3] *= pixels[..., 3:]
+    pixels = np.pad(pixels, ((1, 1), (1, 1), (0, 0)))
+
+    x = np.clip(source_x + 1, 0, columns + 1)
+    y = np.clip(source_y + 1, 0, rows + 1)
+    x0 = np.minimum(np.floor(x).astype(np.intp), columns)
+    y0 = np.minimum(np.floor(y).astype(np.intp), rows)
+    fx, fy = (x - x0)[..., None], (y - y0)[..., None]
+    top = pixels[y0, x0] * (1 - fx) + pixels[y0, x0 + 1] * fx
+    bottom = pixels[y0 + 1, x0] * (1 - fx) + pixels[y0 + 1, x0 + 1] * fx
+    curved = top * (1 - fy) + bottom * fy
+
+    alpha = curved[..., 3:]
+    curved[..., :3] = np.divide(curved[..., :3], alpha, out=np.zeros_like(curved[..., :3]), where=alpha > 0)
+    return Image.fromarray(np.rint(curved * 255).astype(np.uint8), 'RGBA')
+
+
+def curved_text_numpy(text, font_path, token_diameter=500, square_size=500, color='#000000'):
+    """
+    NumPy counterpart of the ImageMagick role name rendering: fits, draws and curves the text,
+    and returns it at the bottom of a transparent square RGBA image.
+    """
+    image = Image.new('RGBA', (square_size, square_size), (0, 0, 0, 0))
+    if text == "":
+        return image
+    token_diameter = int(token_diameter - (token_diameter * 0.1))  # Reduce the diameter by 10% to give a little padding
+    font, (width, height) = fit_text(text.upper(), font_path, token_diameter * 0.15, 2 * token_diameter * 0.5)
+    strip = render_text_strip(text.upper(), font, width, height, color)
+    curved = arc_distort(strip, arc_curve_degree(width, token_diameter))
+
+    # Positioned at the bottom of the base image
+    padding_top = int(square_size * 0.92 - curved.height)
+    padding_left = int((square_size - curved.width) / 2)
+    image.alpha_composite(curved, dest=(max(padding_left, 0), max(padding_top, 0)), source=(max(-padding_left, 0), max(-padding_top, 0)))
+    return image
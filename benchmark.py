@@ -0,0 +1,433 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported
+    resource = None
+
+
+BENCHMARK_RESULTS_PATH = 'benchmark_results.json'
+BENCHMARK_BASELINE_PATH = 'benchmark_baseline.json'
+# Number of characters, reminders or scripts each rendering stage processes: all the ones of the dataset
+DEFAULT_SAMPLE = None
+# Fast stages are run again, up to DEFAULT_REPEAT times while they take less than REPEAT_TIME_BUDGET seconds in
+# total, and the best run is kept: a single run of a stage taking a few milliseconds is mostly noise
+DEFAULT_REPEAT = 5
+REPEAT_TIME_BUDGET = 1.0
+# Largest slowdown (per item) and memory growth against the baseline before a stage is reported as a regression
+DEFAULT_TIME_THRESHOLD = 0.25
+DEFAULT_RSS_THRESHOLD = 0.25
+# Stages faster than this in the results and in the baseline are not reported as slower: their timings are noise
+MIN_COMPARED_WALL_S = 0.05
+
+# Synthetic datasets are made of copies of the real characters (with their icons), so they render like real ones
+DATASETS = {
+    'real': None,
+    'synthetic-1k': {'characters': 1000, 'scripts': 100},
+    'synthetic-10k': {'characters': 10000, 'scripts': 500},
+    'long-names': {'characters': 200, 'scripts': 20, 'long_names': True},
+    'many-reminders': {'characters': 200, 'scripts': 20, 'reminders': 12},
+}
+DEFAULT_DATASETS = ['real', 'synthetic-1k']
+SCRIPT_SIZE = 22
+# Tokens flattened together by the overlay_batch_with_alpha_composite stage: its float32 layers take ~70 MB per token
+COMPOSITE_BATCH_SIZE = 4
+
+
+def make_dataset(name, folder):
+    """
+    Writes a dataset (characters.json, night-order.json, scripts and icons) to folder, the real data being used as is.
+    Returns the paths of the dataset.
+    """
+    from character_db import CHARACTERS_JSON_PATH, NIGHT_ORDER_JSON_PATH, SCRIPTS_PATH
+    from generate_tokens_and_reminders import SCRAPED_IMAGES_PATH
+    dataset = {'name': name, 'characters_path': CHARACTERS_JSON_PATH, 'night_order_path': NIGHT_ORDER_JSON_PATH,
+               'scripts_dir': SCRIPTS_PATH, 'icons_dir': SCRAPED_IMAGES_PATH}
+    spec = DATASETS[name]
+    if spec is None:
+        return dataset
+
+    with open(CHARACTERS_JSON_PATH, 'r') as file:
+        real_characters = [character for character in json.load(file)
+                           if os.path.exists(os.path.join(SCRAPED_IMAGES_PATH, f"{character['id']}.png"))]
+    if not real_characters:
+        raise RuntimeError(f'No scraped icons in {SCRAPED_IMAGES_PATH} to copy, run get_assets_from_wiki.py first')
+    with open(NIGHT_ORDER_JSON_PATH, 'r') as file:
+        night_order = json.load(file)
+
+    randomizer = random.Random(name)
+    dataset_folder = os.path.join(folder, name)
+    icons_dir = os.path.join(dataset_folder, 'icons')
+    scripts_dir = os.path.join(dataset_folder, 'scripts')
+    os.makedirs(icons_dir, exist_ok=True)
+    os.makedirs(scripts_dir, exist_ok=True)
+
+    characters = []
+    copies = {}
+    for index in range(spec['characters']):
+        source = real_characters[index % len(real_characters)]
+        character = dict(source, id=f"{source['id']}{index}", name=f"{source['name']} {index}")
+        if spec.get('long_names'):
+            character['name'] = f"{source['name']} of the long night {index}"
+        if spec.get('reminders'):
+            character['reminders'] = [f"Reminder {number}" for number in range(spec['reminders'])]
+        characters.append(character)
+        copies.setdefault(source['name'], []).append(character['name'])
+        os.symlink(os.path.abspath(os.path.join(SCRAPED_IMAGES_PATH, f"{source['id']}.png")), os.path.join(icons_dir, f"{character['id']}.png"))
+
+    # Every copy wakes right after the character it is a copy of
+    night_order = {night: [copy for name in order for copy in [name] + copies.get(name, [])] for night, order in night_order.items()}
+    for number in range(spec['scripts']):
+        script = [{'id': '_meta', 'name': f'Synthetic {number}'}] + [{'id': character['id']} for character in randomizer.sample(characters, SCRIPT_SIZE)]
+        with open(os.path.join(scripts_dir, f'Synthetic {number}.json'), 'w') as file:
+            json.dump(script, file)
+
+    dataset.update({
+        'characters_path': os.path.join(dataset_folder, 'characters.json'),
+        'night_order_path': os.path.join(dataset_folder, 'night-order.json'),
+        'scripts_dir': scripts_dir,
+        'icons_dir': icons_dir,
+    })
+    with open(dataset['characters_path'], 'w') as file:
+        json.dump(characters, file)
+    with open(dataset['night_order_path'], 'w') as file:
+        json.dump(night_order, file)
+    return dataset
+
+
+def load_characters(dataset):
+    with open(dataset['characters_path'], 'r') as file:
+        characters = json.load(file)
+    return [character for character in characters if os.path.exists(os.path.join(dataset['icons_dir'], f"{character['id']}.png"))]
+
+
+def script_paths(dataset):
+    return sorted(os.path.join(dataset['scripts_dir'], name) for name in os.listdir(dataset['scripts_dir']) if name.endswith('.json'))
+
+
+def sample(items, size):
+    return items[:size] if size else items
+
+
+# Stages: each one prepares its inputs (not timed) and returns the function to time and the number of items it processes
+
+def stage_character_db(dataset, options, workdir):
+    from character_db import compile_character_database
+    characters = load_characters(dataset)
+    return lambda: compile_character_database(dataset['characters_path'], dataset['night_order_path']), len(characters)
+
+
+def stage_plot_curved_text(dataset, options, workdir):
+    from generate_tokens_and_reminders import plot_curved_text, REMINDER_TEXT_PARAMS
+    reminders = sorted({reminder for character in load_characters(dataset) for reminder in character['reminders'] + character.get('remindersGlobal', [])})
+    reminders = sample(reminders, options['sample'])
+
+    def run():
+        for reminder in reminders:
+            plot_curved_text(reminder, **REMINDER_TEXT_PARAMS)
+    return run, len(reminders)
+
+
+def stage_curved_text_to_image(dataset, options, workdir):
+    from generate_tokens_and_reminders import curved_text_to_image, TOKEN_DIAMETER
+    names = sample([character['name'].upper() for character in load_characters(dataset)], options['sample'])
+
+    def run():
+        for name in names:
+            curved_text_to_image(name, token_diameter=TOKEN_DIAMETER, backend=options['backend'])
+    return run, len(names)
+
+
+def stage_overlay_with_alpha_composite(dataset, options, workdir):
+    from generate_tokens_and_reminders import (curved_text_to_image, generate_overlay_array, overlay_with_alpha_composite,
+                                               TOKEN_BACKGROUND_PATH, TOKEN_DIAMETER, TOKEN_MASK_COLOR)
+    characters = sample(load_characters(dataset), options['sample'])
+    layers = [generate_overlay_array(character, dataset['icons_dir'], curved_text=curved_text_to_image(character['name'].upper(), token_diameter=TOKEN_DIAMETER, backend=options['backend']))
+              for character in characters]
+
+    def run():
+        for index, layer_paths in enumerate(layers):
+            overlay_with_alpha_composite(TOKEN_BACKGROUND_PATH, layer_paths, os.path.join(workdir, f'{index}.png'), mask_color=TOKEN_MASK_COLOR)
+    return run, len(layers)
+
+
+def stage_overlay_batch_with_alpha_composite(dataset, options, workdir):
+    """
+    The same tokens as overlay_with_alpha_composite, flattened COMPOSITE_BATCH_SIZE at a time by the vectorised compositor.
+    """
+    from generate_tokens_and_reminders import (curved_text_to_image, generate_overlay_array, overlay_batch_with_alpha_composite,
+                                               TOKEN_BACKGROUND_PATH, TOKEN_DIAMETER, TOKEN_MASK_COLOR)
+    characters = sample(load_characters(dataset), options['sample'])
+    layers = [generate_overlay_array(character, dataset['icons_dir'], curved_text=curved_text_to_image(character['name'].upper(), token_diameter=TOKEN_DIAMETER, backend=options['backend']))
+              for character in characters]
+
+    def run():
+        for start in range(0, len(layers), COMPOSITE_BATCH_SIZE):
+            images = overlay_batch_with_alpha_composite(TOKEN_BACKGROUND_PATH, layers[start:start + COMPOSITE_BATCH_SIZE], TOKEN_MASK_COLOR)
+            for index, image in enumerate(images, start):
+                image.save(os.path.join(workdir, f'{index}.png'))
+    return run, len(layers)
+
+
+def render_dataset_token(character, dataset, options, output_path):
+    import generate_tokens_and_reminders as tokens
+    curved_text = tokens.curved_text_to_image(character['name'].upper(), token_diameter=tokens.TOKEN_DIAMETER, backend=options['backend'])
+    layer_paths = tokens.generate_overlay_array(character, dataset['icons_dir'], curved_text=curved_text)
+    tokens.overlay_with_alpha_composite(tokens.TOKEN_BACKGROUND_PATH, layer_paths, output_path, tokens.TOKEN_MASK_COLOR)
+
+
+def stage_images_to_pdf(dataset, options, workdir):
+    from save_tokens_to_pdf import images_to_pdf
+    # The tokens of the sampled characters of the dataset, rendered beforehand
+    characters = sample(load_characters(dataset), options['sample'])
+    folder = os.path.join(workdir, 'tokens')
+    os.makedirs(folder)
+    for character in characters:
+        render_dataset_token(character, dataset, options, os.path.join(folder, f"{character['id']}.png"))
+    return lambda: images_to_pdf(folder, os.path.join(workdir, 'tokens.pdf'), image_new_size=85, side_margin=0.5, between_margin=0.10, background_color=(86, 68, 46)), len(characters)
+
+
+def night_sheets_of_scripts(dataset, options):
+    from character_db import load_character_database
+    import generate_night_order_sheet
+    database = load_character_database(dataset['characters_path'], dataset['night_order_path'], cache_path=None)
+    sheets = []
+    for path in sample(script_paths(dataset), options['sample']):
+        first_night_sheet, other_night_sheet = generate_night_order_sheet.script_night_sheets(path, database)
+        # Synthetic characters have their icons in the dataset
+        for sheet in (first_night_sheet, other_night_sheet):
+            for row in sheet.values():
+                if row['image_location'].startswith('img/token/scraped_images/'):
+                    row['image_location'] = os.path.join(dataset['icons_dir'], os.path.basename(row['image_location']))
+        sheets.append((os.path.splitext(os.path.basename(path))[0], first_night_sheet, other_night_sheet))
+    return sheets
+
+
+def stage_generate_pdf(dataset, options, workdir):
+    from generate_night_order_sheet import generate_pdf
+    sheets = night_sheets_of_scripts(dataset, options)
+
+    def run():
+        for index, (title, first_night_sheet, _) in enumerate(sheets):
+            generate_pdf(first_night_sheet, 'firstNightReminder', os.path.join(workdir, f'{index}.pdf'), f'{title} - First Night', image_width=30, image_height=30, font_size=10)
+    return run, len(sheets)
+
+
+def stage_night_sheet_raster(dataset, options, workdir):
+    # Replaces the former convert_pdf_to_image: the sheets are drawn straight to JPEG
+    from generate_night_order_sheet import write_night_sheets
+    sheets = night_sheets_of_scripts(dataset, options)
+
+    def run():
+        for index, (title, first_night_sheet, other_night_sheet) in enumerate(sheets):
+            write_night_sheets(first_night_sheet, other_night_sheet, os.path.join(workdir, f'{index}.jpg'), title, backend='raster')
+    return run, len(sheets)
+
+
+def stage_pipeline(dataset, options, workdir):
+    """
+    The whole pipeline for the sampled characters and scripts: tokens and reminders, their PDFs and the night sheets.
+    """
+    import generate_tokens_and_reminders as tokens
+    from save_tokens_to_pdf import images_to_pdf
+    from generate_night_order_sheet import write_night_sheets
+    characters = sample(load_characters(dataset), options['sample'])
+    tokens_folder = os.path.join(workdir, 'tokens')
+    reminders_folder = os.path.join(workdir, 'reminders')
+    os.makedirs(tokens_folder)
+    os.makedirs(reminders_folder)
+
+    def run():
+        for character in characters:
+            render_dataset_token(character, dataset, options, os.path.join(tokens_folder, f"{character['id']}.png"))
+            reminders = character['reminders'] + character.get('remindersGlobal', [])
+            if reminders:
+                shared_layers = tokens.generate_overlay_array(character, dataset['icons_dir'], is_reminder=True)[:-1]
+                base_plate = tokens.overlay_with_alpha_composite(tokens.REMINDER_BACKGROUND_PATH, shared_layers, None, mask_color=None)
+                for reminder in reminders:
+                    curved_text = tokens.plot_curved_text(reminder, **tokens.REMINDER_TEXT_PARAMS)
+                    tokens.overlay_with_alpha_composite(base_plate, [curved_text], os.path.join(reminders_folder, f"{character['id']}_{reminder}.png"), tokens.REMINDER_MASK_COLOR)
+        images_to_pdf(tokens_folder, os.path.join(workdir, 'tokens.pdf'), image_new_size=85, side_margin=0.5, between_margin=0.10, background_color=(86, 68, 46))
+        images_to_pdf(reminders_folder, os.path.join(workdir, 'reminders.pdf'), image_new_size=55, side_margin=0.5, between_margin=0.10, background_color=(45, 45, 45))
+        for index, (title, first_night_sheet, other_night_sheet) in enumerate(night_sheets_of_scripts(dataset, options)):
+            write_night_sheets(first_night_sheet, other_night_sheet, os.path.join(workdir, f'{index}.jpg'), title, backend='raster')
+    return run, len(characters)
+
+
+STAGES = {
+    'character_db': stage_character_db,
+    'plot_curved_text': stage_plot_curved_text,
+    'curved_text_to_image': stage_curved_text_to_image,
+    'overlay_with_alpha_composite': stage_overlay_with_alpha_composite,
+    'overlay_batch_with_alpha_composite': stage_overlay_batch_with_alpha_composite,
+    'images_to_pdf': stage_images_to_pdf,
+    'generate_pdf': stage_generate_pdf,
+    'night_sheet_raster': stage_night_sheet_raster,
+    'pipeline': stage_pipeline,
+}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_stage(job):
+    """
+    Runs one stage on one dataset in a fresh process, so caches are cold and the peak memory is the stage's own.
+    Its output is discarded: the stages print a line per item. Only the stages taking less than REPEAT_TIME_BUDGET
+    are run more than once, their later runs may use the caches warmed up by the first one.
+    """
+    stage, dataset, options = job
+    import io
+    import contextlib
+    import font_fitting
+    with tempfile.TemporaryDirectory() as workdir, io.StringIO() as log, contextlib.redirect_stdout(log):
+        # Measure every text again instead of reading the persistent metrics cache
+        font_fitting.METRICS_CACHE = font_fitting.FontMetricsCache(os.path.join(workdir, 'font_metrics_cache.json'))
+        run, items = STAGES[stage](dataset, options, workdir)
+        run_times = []
+        while not run_times or (len(run_times) < options['repeat'] and sum(run_times) < REPEAT_TIME_BUDGET):
+            start_time = time.perf_counter()
+            run()
+            run_times.append(time.perf_counter() - start_time)
+        wall_s = min(run_times)
+    return {
+        'stage': stage,
+        'dataset': dataset['name'],
+        'items': items,
+        'runs': len(run_times),
+        'wall_s': round(wall_s, 4),
+        'items_per_s': round(items / wall_s, 3) if wall_s > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_benchmarks(datasets, stages, options):
+    """
+    Runs every stage on every dataset, each in its own spawned process, and returns the results by 'dataset/stage'.
+    """
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as folder:
+        for name in datasets:
+            try:
+                dataset = make_dataset(name, folder)
+            except Exception as e:
+                print(f"{name}: dataset could not be made: {e}")
+                continue
+            for stage in stages:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    try:
+                        result = executor.submit(run_stage, (stage, dataset, options)).result()
+                    except Exception as e:
+                        print(f"{name}/{stage}: failed: {e}")
+                        continue
+                results[f'{name}/{stage}'] = result
+                print(f"{name}/{stage}: {result['items']} items in {result['wall_s']:.3f} s "
+                      f"({result['items_per_s']} items/s, peak RSS {result['peak_rss_mb']} MB)")
+    return results
+
+
+def compare_with_baseline(results, baseline, time_threshold=DEFAULT_TIME_THRESHOLD, rss_threshold=DEFAULT_RSS_THRESHOLD, stage_thresholds=None):
+    """
+    Compares the time per item and the peak memory of every result with the baseline.
+    stage_thresholds overrides time_threshold for some stages. Returns the list of regressions.
+    """
+    stage_thresholds = stage_thresholds or {}
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if not reference or not reference['items'] or not result['items']:
+            print(f"{key}: no baseline")
+            continue
+        threshold = stage_thresholds.get(result['stage'], time_threshold)
+        time_change = (result['wall_s'] / result['items']) / (reference['wall_s'] / reference['items']) - 1
+        status = 'ok'
+        if max(result['wall_s'], reference['wall_s']) < MIN_COMPARED_WALL_S:
+            status = 'too fast to compare'
+        elif time_change > threshold:
+            status = 'SLOWER'
+            regressions.append(f"{key}: {time_change:+.0%} time per item (threshold {threshold:.0%})")
+        rss_change = None
+        if result['peak_rss_mb'] and reference.get('peak_rss_mb'):
+            rss_change = result['peak_rss_mb'] / reference['peak_rss_mb'] - 1
+            if rss_change > rss_threshold:
+                status = 'MORE MEMORY' if status == 'ok' else status + ', MORE MEMORY'
+                regressions.append(f"{key}: {rss_change:+.0%} peak RSS (threshold {rss_threshold:.0%})")
+        rss_text = f", {rss_change:+.0%} peak RSS" if rss_change is not None else ''
+        print(f"{key}: {time_change:+.0%} time per item{rss_text} - {status}")
+    return regressions
+
+
+def parse_stage_thresholds(values):
+    thresholds = {}
+    for value in values:
+        stage, _, threshold = value.partition('=')
+        if stage not in STAGES or not threshold:
+            raise argparse.ArgumentTypeError(f"Invalid stage threshold '{value}', expected <stage>=<fraction>")
+        thresholds[stage] = float(threshold)
+    return thresholds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the pipeline, and the whole pipeline, on real and synthetic data.')
+    parser.add_argument('--datasets', nargs='+', choices=list(DATASETS), default=DEFAULT_DATASETS, help='Datasets to run on.')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES), help='Stages to run.')
+    parser.add_argument('--sample', type=int, default=DEFAULT_SAMPLE,
+                        help='Number of characters, reminders or scripts each rendering stage processes. Default: all the ones of the dataset.')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f'Maximum number of runs of the stages taking less than {REPEAT_TIME_BUDGET} s, the best one is kept.')
+    parser.add_argument('--backend', default=None, help='Backend curving the role names (default: the one of the build).')
+    parser.add_argument('--output', default=BENCHMARK_RESULTS_PATH, help='JSON file the results are written to.')
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE_PATH, help='Results to compare with, if the file exists.')
+    parser.add_argument('--save-baseline', action='store_true', help='Also save the results as the new baseline.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_TIME_THRESHOLD, help='Allowed slowdown per item, e.g. 0.25 for 25%%.')
+    parser.add_argument('--rss-threshold', type=float, default=DEFAULT_RSS_THRESHOLD, help='Allowed growth of the peak memory.')
+    parser.add_argument('--stage-threshold', nargs='*', default=[], metavar='STAGE=FRACTION', help='Allowed slowdown of specific stages.')
+    args = parser.parse_args()
+
+    if args.backend is None:
+        from generate_tokens_and_reminders import DEFAULT_ROLE_NAME_BACKEND
+        args.backend = DEFAULT_ROLE_NAME_BACKEND
+    options = {'sample': args.sample, 'backend': args.backend, 'repeat': args.repeat}
+    stage_thresholds = parse_stage_thresholds(args.stage_threshold)
+
+    results = run_benchmarks(args.datasets, args.stages, options)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': options,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=1)
+    print(f"Results written to {args.output}")
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=1)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        regressions = compare_with_baseline(results, baseline['results'], args.threshold, args.rss_threshold, stage_thresholds)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"- {regression}")
+            sys.exit(1)
+        print("No regression against the baseline.")
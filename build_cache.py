@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import hashlib
+import functools
+import contextlib
+from collections import deque
+
+
+BUILD_MANIFEST_PATH = 'img/token/build_manifest.json'
+MISSING_FILE_DIGEST = 'missing'
+# Size of a RenderStore on disk: past it, the least recently used entries are deleted down to PRUNE_FRACTION of it
+DEFAULT_STORE_MAX_BYTES = 256 * 1024 * 1024
+PRUNE_FRACTION = 0.75
+
+
+def hash_file(file_path):
+    """
+    Returns the sha256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_file_digest(file_path, mtime_ns, size):
+    return hash_file(file_path)
+
+
+def file_digest(file_path):
+    """
+    Returns the sha256 hex digest of a file, hashed once per process as long as its mtime and size are unchanged.
+    """
+    stat = os.stat(file_path)
+    return _cached_file_digest(file_path, stat.st_mtime_ns, stat.st_size)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Opens a temporary file next to path for writing, moved to path once the block completes, so an interrupted
+    write never leaves a half written file. The temporary file is named after the process, so concurrent writers
+    do not collide (the last one wins), and it is deleted if the block fails.
+    """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, mode) as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def bounded_map(executor, function, jobs_list, window):
+    """
+    Yields the results of function on the jobs in order, with at most window of them submitted ahead to the
+    executor, so long lists of jobs run in bounded memory.
+    """
+    pending = deque()
+    for job in jobs_list:
+        pending.append(executor.submit(function, job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def content_key(params, input_paths=(), digest_file=file_digest):
+    """
+    Returns a key hashing the (JSON serialisable) parameters and the content of the input files,
+    digest_file returning the digest of the content of a file.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    for input_path in sorted(set(input_paths)):
+        digest.update(f'\0{input_path}\0{digest_file(input_path)}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """
+    Persistent record of the inputs each generated file was built from.
+
+    Every output is stored with a key hashing all of its inputs (files and render parameters).
+    An output is considered fresh when it still exists on disk and its key is unchanged, so it
+    can be skipped on the next build. File digests are cached by (mtime, size) so an unchanged
+    input is only stat'ed, not re-read.
+    """
+
+    def __init__(self, manifest_path=BUILD_MANIFEST_PATH):
+        self.manifest_path = manifest_path
+        self.files = {}
+        self.outputs = {}
+        self._digests = {}
+        try:
+            with open(manifest_path, 'r') as file:
+                data = json.load(file)
+            self.files = data.get('files', {})
+            self.outputs = data.get('outputs', {})
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError) as e:
+            print(f"Ignoring unreadable build manifest '{manifest_path}': {e}")
+
+    def file_digest(self, file_path):
+        """
+        Returns the content digest of a file, re-hashing it only if its mtime or size changed.
+        """
+        if file_path in self._digests:
+            return self._digests[file_path]
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            digest = MISSING_FILE_DIGEST
+        else:
+            cached = self.files.get(file_path)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                digest = cached[2]
+            else:
+                digest = hash_file(file_path)
+                self.files[file_path] = [stat.st_mtime_ns, stat.st_size, digest]
+        self._digests[file_path] = digest
+        return digest
+
+    def refresh(self):
+        """
+        Forgets the digests of this run, so the files written since are hashed again if their mtime or size changed.
+        """
+        self._digests = {}
+
+    def build_key(self, input_paths, params):
+        """
+        Returns a key hashing the content of every input file and the (JSON serialisable) render parameters.
+        """
+        return content_key(params, input_paths, self.file_digest)
+
+    def is_fresh(self, output_path, key):
+        """
+        Returns True if the output exists and was built from the same inputs.
+        """
+        return self.outputs.get(output_path) == key and os.path.exists(output_path)
+
+    def record(self, output_path, key):
+        self.outputs[output_path] = key
+
+    def save(self):
+        """
+        Writes the manifest atomically so an interrupted build never leaves it half written.
+        """
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        with atomic_write(self.manifest_path) as file:
+            json.dump({'files': self.files, 'outputs': self.outputs}, file, indent=1, sort_keys=True)
+
+
+class RenderStore:
+    """
+    Persistent content-addressed store of rendered images, shared by every output using the same render.
+
+    Entries are PNG files named after the key of their render parameters and input files, so an entry is
+    rendered once and reused by the next builds until one of its inputs changes. Entries are written
+    atomically, so concurrent builds rendering the same entry are safe.
+
+    The store is bounded by the size of its files: the access time of an entry is set when it is used (its
+    modification time is kept, so the caches keyed on it, like LayerCache, still hit), and once the store
+    grows past max_bytes the least recently used ones, whose inputs most likely changed, are deleted.
+    """
+
+    def __init__(self, store_path, max_bytes=DEFAULT_STORE_MAX_BYTES):
+        self.store_path = store_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.renders = 0
+        self.evictions = 0
+        # Size of the entries, measured on the first render
+        self.bytes = None
+
+    def key(self, params, input_paths=()):
+        """
+        Returns a key hashing the (JSON serialisable) render parameters and the content of the input files.
+        """
+        return content_key(params, input_paths)
+
+    def get_path(self, key, render):
+        """
+        Returns the path of the entry of a key, calling render() to create it if it is not stored yet.
+        render must return a PIL image.
+        """
+        entry_path = os.path.join(self.store_path, f'{key}.png')
+        try:
+            os.utime(entry_path, ns=(time.time_ns(), os.stat(entry_path).st_mtime_ns))
+            self.hits += 1
+            return entry_path
+        except FileNotFoundError:
+            pass
+
+        self.renders += 1
+        os.makedirs(self.store_path, exist_ok=True)
+        image = render()
+        with atomic_write(entry_path, 'wb') as file:
+            image.save(file, format='PNG')
+        if self.bytes is None:
+            self.bytes = sum(size for _, size, _ in self.entries())
+        else:
+            self.bytes += os.path.getsize(entry_path)
+        if self.bytes > self.max_bytes:
+            self.prune(int(self.max_bytes * PRUNE_FRACTION))
+        return entry_path
+
+    def entries(self):
+        """
+        Returns the (last use, size, path) of every entry, least recently used first.
+        """
+        entries = []
+        try:
+            names = os.listdir(self.store_path)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if name.endswith('.png'):
+                path = os.path.join(self.store_path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def prune(self, max_bytes=None):
+        """
+        Deletes the least recently used entries until the store holds at most max_bytes (max_bytes of the store
+        by default), keeping the last used one. Returns the number of entries deleted.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        self.bytes = sum(size for _, size, _ in entries)
+        deleted = 0
+        for _, size, path in entries[:-1]:
+            if self.bytes <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already deleted by another build
+                pass
+            self.bytes -= size
+            deleted += 1
+        self.evictions += deleted
+        return deleted
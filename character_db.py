@@ -0,0 +1,191 @@
+import os
+import json
+import pickle
+from build_cache import atomic_write
+
+
+CHARACTERS_JSON_PATH = 'characters.json'
+NIGHT_ORDER_JSON_PATH = 'night-order.json'
+CHARACTER_DB_CACHE_PATH = 'img/token/character_db.pickle'
+SCRIPTS_PATH = 'scripts_and_night_order_sheets/scripts'
+# Bump when the records change, so older compiled caches are rebuilt
+CHARACTER_DB_VERSION = 1
+
+
+def normalise_id(character_id):
+    """
+    Returns the id a character is known by everywhere: lowercase, without spaces, apostrophes, hyphens or underscores.
+    'fortune_teller', 'Fortune Teller' and 'fortuneteller' are the same character.
+    """
+    return character_id.strip().lower().replace(" ", "").replace("'", "").replace("-", "").replace("_", "")
+
+
+class Character:
+    """
+    Compact record of a character of characters.json, with its positions in night-order.json.
+    entry is the JSON entry itself, for the code rendering it; it must not be modified.
+    """
+
+    __slots__ = ('id', 'name', 'team', 'edition', 'reminders', 'first_night_reminder', 'other_night_reminder',
+                 'first_night_position', 'other_night_position', 'entry')
+
+    def __init__(self, entry, first_night_position=None, other_night_position=None):
+        self.id = entry['id']
+        self.name = entry['name']
+        self.team = entry.get('team', '')
+        self.edition = entry.get('edition', '')
+        self.reminders = tuple(entry.get('reminders', [])) + tuple(entry.get('remindersGlobal', []))
+        self.first_night_reminder = entry.get('firstNightReminder', '')
+        self.other_night_reminder = entry.get('otherNightReminder', '')
+        self.first_night_position = first_night_position
+        self.other_night_position = other_night_position
+        self.entry = entry
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return f'Character({self.id!r})'
+
+
+class CharacterDatabase:
+    """
+    The characters and the night order, indexed by normalised id and by name.
+
+    Night positions are the indexes in the firstNight and otherNight lists of night-order.json, which also
+    contain rows that are not characters (DUSK, DAWN, MINION, DEMON): those are kept in first_night_order
+    and other_night_order.
+    """
+
+    def __init__(self, characters_json, night_order):
+        self.first_night_order = list(night_order.get('firstNight', []))
+        self.other_night_order = list(night_order.get('otherNight', []))
+        first_night_positions = {name: position for position, name in enumerate(self.first_night_order)}
+        other_night_positions = {name: position for position, name in enumerate(self.other_night_order)}
+
+        self.characters = [
+            Character(entry, first_night_positions.get(entry['name']), other_night_positions.get(entry['name']))
+            for entry in characters_json
+        ]
+        self.by_id = {normalise_id(character.id): character for character in self.characters}
+        self.by_name = {character.name: character for character in self.characters}
+
+    def get(self, character_id):
+        """
+        Returns the character of an id, in any of the spellings normalise_id accepts, None if it is unknown.
+        """
+        return self.by_id.get(normalise_id(character_id))
+
+    def ids(self):
+        return [character.id for character in self.characters]
+
+    def resolve(self, character_ids):
+        """
+        Returns the characters of a list of ids (in any spelling), without duplicates and in the order of the list,
+        and the ids that are not characters.
+        """
+        characters = []
+        unknown_ids = []
+        for character_id in character_ids:
+            character = self.get(character_id)
+            if character is None:
+                unknown_ids.append(character_id)
+            elif character not in characters:
+                characters.append(character)
+        return characters, unknown_ids
+
+    def night_order(self, names, first_night=True):
+        """
+        Returns the rows of names (character names and the other rows of the night order) that wake on the
+        first night or the other nights, in the order they wake.
+        """
+        order = self.first_night_order if first_night else self.other_night_order
+        names = set(names)
+        return [name for name in order if name in names]
+
+
+def script_path(script):
+    """
+    Returns the path of a script JSON, given as a path or as the name of a script of SCRIPTS_PATH.
+    """
+    if os.path.exists(script):
+        return script
+    return os.path.join(SCRIPTS_PATH, f'{script}.json')
+
+
+def read_script_ids(script):
+    """
+    Returns the character ids of a script JSON (a path or a script name), as written in the script.
+    Characters are listed as {"id": ...} entries or as plain strings; the _meta entry is skipped.
+    """
+    with open(script_path(script), 'r') as file:
+        entries = json.load(file)
+    character_ids = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            entry = entry.get('id', '')
+        if isinstance(entry, str) and entry and entry != '_meta':
+            character_ids.append(entry)
+    return character_ids
+
+
+def source_stats(paths):
+    stats = []
+    for path in paths:
+        stat = os.stat(path)
+        stats.append([path, stat.st_mtime_ns, stat.st_size])
+    return stats
+
+
+def compile_character_database(characters_path=CHARACTERS_JSON_PATH, night_order_path=NIGHT_ORDER_JSON_PATH):
+    """
+    Loads and indexes characters.json and night-order.json.
+    """
+    with open(characters_path, 'r') as file:
+        characters_json = json.load(file)
+    with open(night_order_path, 'r') as file:
+        night_order = json.load(file)
+    return CharacterDatabase(characters_json, night_order)
+
+
+_databases = {}
+
+
+def load_character_database(characters_path=CHARACTERS_JSON_PATH, night_order_path=NIGHT_ORDER_JSON_PATH, cache_path=CHARACTER_DB_CACHE_PATH):
+    """
+    Returns the character database, loaded once per process.
+
+    The compiled database is pickled to cache_path and reused by the next runs until the mtime or size of
+    one of the source JSON files changes. Pass cache_path=None to always compile it from the JSON files.
+    """
+    key = (characters_path, night_order_path, cache_path)
+    stats = source_stats([characters_path, night_order_path])
+    cached = _databases.get(key)
+    if cached and cached[0] == stats:
+        return cached[1]
+
+    database = None
+    if cache_path:
+        try:
+            with open(cache_path, 'rb') as file:
+                version, cached_stats, cached_database = pickle.load(file)
+            if version == CHARACTER_DB_VERSION and cached_stats == stats:
+                database = cached_database
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ignoring unreadable character database cache '{cache_path}': {e}")
+
+    if database is None:
+        database = compile_character_database(characters_path, night_order_path)
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            with atomic_write(cache_path, 'wb') as file:
+                pickle.dump((CHARACTER_DB_VERSION, stats, database), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    _databases[key] = (stats, database)
+    return database
@@ -0,0 +1,237 @@
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from build_cache import BuildManifest, atomic_write
+from character_db import load_character_database, read_script_ids
+from image_pyramid import DEFAULT_COMPRESS_LEVEL
+from tracing import TRACER, add_tracing_arguments, print_trace_summary
+
+
+GENERATED_TOKENS_PATH = 'img/token/generated_tokens'
+GENERATED_REMINDERS_PATH = 'img/token/generated_reminders'
+ATLAS_OUTPUT_PATH = 'output_prints/atlas'
+ATLAS_MANIFEST_PATH = 'img/token/atlas_manifest.json'
+ATLAS_INDEX_NAME = 'atlas.json'
+ATLAS_INDEX_VERSION = 1
+# Largest side of an atlas page: the biggest texture every GPU supports
+ATLAS_PAGE_SIZE = 4096
+# Transparent pixels around each sprite, so sampling a sprite with filtering never bleeds its neighbours in
+ATLAS_PADDING = 2
+# Pages composited and encoded at once: Pillow releases the GIL while decoding, pasting and encoding
+ATLAS_THREADS = 4
+# The sprites of each kind, and the folder of their images
+ATLAS_KINDS = [('token', GENERATED_TOKENS_PATH), ('reminder', GENERATED_REMINDERS_PATH)]
+
+
+def atlas_path(script=None):
+    """
+    Returns the folder of the atlas of a script, or of every character if no script is given.
+    """
+    return os.path.join(ATLAS_OUTPUT_PATH, os.path.splitext(os.path.basename(script))[0] if script else 'all')
+
+
+def atlas_members(database, script=None):
+    """
+    Returns the generated images to pack, of every character or of the characters of a script, as a dict of
+    kind -> {file name: (character id, reminder or None)}. Characters whose images were not generated are printed.
+    """
+    if script:
+        characters, unknown_ids = database.resolve(read_script_ids(script))
+        if unknown_ids:
+            print("These ids of the script are not characters and will not be packed:", unknown_ids)
+    else:
+        characters = database.characters
+
+    members = {'token': {}, 'reminder': {}}
+    missing = []
+    for character in characters:
+        if not os.path.exists(os.path.join(GENERATED_TOKENS_PATH, f'{character.id}.png')):
+            missing.append(character.id)
+            continue
+        members['token'][f'{character.id}.png'] = (character.id, None)
+        for reminder in character.reminders:
+            if os.path.exists(os.path.join(GENERATED_REMINDERS_PATH, f'{character.id}_{reminder}.png')):
+                members['reminder'][f'{character.id}_{reminder}.png'] = (character.id, reminder)
+    if missing and script:
+        print("These characters have no generated token and will not be packed:", missing)
+    return members
+
+
+def read_index(index_path):
+    try:
+        with open(index_path, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def grid_columns(cell, page_size=ATLAS_PAGE_SIZE, padding=ATLAS_PADDING):
+    """
+    Returns the number of cells of a side of a page, cells being cell pixels wide with padding between them.
+    """
+    return max(1, (page_size - padding) // (cell + padding))
+
+
+def assign_slots(names, previous, capacity):
+    """
+    Packs the images in the cells of the pages: returns a dict of name -> (page number, slot).
+
+    Images keep the cell they had in the previous atlas (previous, in the same format), so adding or removing a
+    character only changes the pages it is on. New images fill the cells left free, in name order, and then
+    new pages.
+    """
+    placements = {name: tuple(previous[name]) for name in names if name in previous and previous[name][1] < capacity}
+    used = set(placements.values())
+
+    def free_cells():
+        page = 0
+        while True:
+            for slot in range(capacity):
+                if (page, slot) not in used:
+                    yield page, slot
+            page += 1
+
+    cells = free_cells()
+    for name in sorted(names):
+        if name not in placements:
+            placements[name] = next(cells)
+    return placements
+
+
+def cell_position(slot, cell, columns, padding=ATLAS_PADDING):
+    return padding + (slot % columns) * (cell + padding), padding + (slot // columns) * (cell + padding)
+
+
+def write_page(page_path, sprites, width, height, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Pastes the sprites, (image path, x, y), on a transparent page and writes it atomically.
+    """
+    with TRACER.span('atlas_page', item=page_path, sprites=len(sprites)) as span:
+        page = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        for image_path, x, y in sprites:
+            with Image.open(image_path) as image:
+                page.paste(image.convert('RGBA'), (x, y))
+        with atomic_write(page_path, 'wb') as file:
+            page.save(file, 'PNG', compress_level=compress_level)
+        span.set(bytes=os.path.getsize(page_path))
+
+
+def export_atlas(database, script=None, force=False, page_size=ATLAS_PAGE_SIZE, padding=ATLAS_PADDING,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, jobs=ATLAS_THREADS, manifest_path=ATLAS_MANIFEST_PATH):
+    """
+    Packs the generated tokens and reminders, of every character or of the characters of a script, in a few atlas
+    pages per kind (tokens_0.png, reminders_0.png...) and writes atlas.json, the index of the sprites:
+        {"tokens": {id: {"page", "x", "y", "w", "h"}}, "reminders": {id: {reminder: {"page", "x", "y", "w", "h"}}},
+         "pages": {page: {"kind", "width", "height", ...}}, ...}
+
+    Every token (and every reminder) is the same size, so their bounding squares are packed in a grid of cells as
+    big as the biggest of them: sprites are drawn as rectangles, their circles cannot overlap. Only the pages
+    whose images, or the cells of their images, changed since the last export are written again (all of them
+    with force), on jobs threads. Returns the number of pages written and the number of pages.
+    """
+    output_path = atlas_path(script)
+    os.makedirs(output_path, exist_ok=True)
+    index_path = os.path.join(output_path, ATLAS_INDEX_NAME)
+    previous = read_index(index_path)
+    if previous.get('version') != ATLAS_INDEX_VERSION or previous.get('page_size') != page_size or previous.get('padding') != padding:
+        previous = {}
+    manifest = BuildManifest(manifest_path)
+
+    index = {'version': ATLAS_INDEX_VERSION, 'scope': os.path.splitext(os.path.basename(script))[0] if script else None,
+             'page_size': page_size, 'padding': padding, 'layouts': {}, 'pages': {}, 'tokens': {}, 'reminders': {}}
+    members_by_kind = atlas_members(database, script)
+    dirty_pages = []
+    for kind, folder in ATLAS_KINDS:
+        members = members_by_kind[kind]
+        sizes = {}
+        for name in members:
+            with Image.open(os.path.join(folder, name)) as image:
+                sizes[name] = image.size
+        if not sizes:
+            continue
+
+        cell = max(max(size) for size in sizes.values())
+        columns = grid_columns(cell, page_size, padding)
+        layout = {'cell': cell, 'columns': columns}
+        index['layouts'][kind] = layout
+        previous_placements = {}
+        if previous.get('layouts', {}).get(kind) == layout:
+            for page in previous['pages'].values():
+                if page['kind'] == kind:
+                    previous_placements.update((name, (page['number'], slot)) for name, slot in page['members'].items())
+        placements = assign_slots(list(members), previous_placements, columns * columns)
+
+        pages = {}
+        for name, (number, slot) in placements.items():
+            pages.setdefault(number, {})[name] = slot
+        for number, page_members in sorted(pages.items()):
+            page_name = f'{kind}s_{number}.png'
+            last_row = max(page_members.values()) // columns
+            width = padding + (columns if last_row else max(page_members.values()) + 1) * (cell + padding)
+            height = padding + (last_row + 1) * (cell + padding)
+            index['pages'][page_name] = {'kind': kind, 'number': number, 'width': width, 'height': height,
+                                         'members': dict(sorted(page_members.items()))}
+            sprites = []
+            for name, slot in sorted(page_members.items()):
+                x, y = cell_position(slot, cell, columns, padding)
+                sprites.append((os.path.join(folder, name), x, y))
+                character_id, reminder = members[name]
+                entry = {'page': page_name, 'x': x, 'y': y, 'w': sizes[name][0], 'h': sizes[name][1]}
+                if reminder is None:
+                    index['tokens'][character_id] = entry
+                else:
+                    index['reminders'].setdefault(character_id, {})[reminder] = entry
+
+            page_path = os.path.join(output_path, page_name)
+            key = manifest.build_key([path for path, _, _ in sprites], {'sprites': [[os.path.basename(path), x, y] for path, x, y in sprites],
+                                                                         'width': width, 'height': height, 'compress_level': compress_level})
+            if force or not manifest.is_fresh(page_path, key):
+                dirty_pages.append((page_path, sprites, width, height, key))
+
+    # Pages left without images
+    for page_name in previous.get('pages', {}):
+        page_path = os.path.join(output_path, page_name)
+        if page_name not in index['pages'] and os.path.exists(page_path):
+            os.remove(page_path)
+            manifest.outputs.pop(page_path, None)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [(page_path, key, executor.submit(write_page, page_path, sprites, width, height, compress_level))
+                       for page_path, sprites, width, height, key in dirty_pages]
+            for page_path, key, future in futures:
+                future.result()
+                manifest.record(page_path, key)
+                print(f"{page_path} written")
+    finally:
+        manifest.save()
+
+    with atomic_write(index_path) as file:
+        json.dump(index, file, indent=1)
+    return len(dirty_pages), len(index['pages'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack the generated tokens and reminders in atlas pages, with a JSON index of their sprites.')
+    parser.add_argument('scripts', nargs='*',
+                        help=f'Script JSONs (paths, or names of scripts in scripts_and_night_order_sheets/scripts) to write an atlas of, in {ATLAS_OUTPUT_PATH}/<script>. Default: one atlas of every character, in {ATLAS_OUTPUT_PATH}/all.')
+    parser.add_argument('--force', action='store_true', help='Write every page again, even the ones whose images did not change.')
+    parser.add_argument('--page-size', type=int, default=ATLAS_PAGE_SIZE, help='Largest width and height of a page, in pixels.')
+    parser.add_argument('--padding', type=int, default=ATLAS_PADDING, help='Transparent pixels around each sprite.')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=DEFAULT_COMPRESS_LEVEL, metavar='0-9',
+                        help='zlib level of the pages, from 0 (fastest) to 9 (smallest).')
+    parser.add_argument('--jobs', type=int, default=ATLAS_THREADS, help='Number of pages written at once.')
+    add_tracing_arguments(parser)
+    args = parser.parse_args()
+    TRACER.configure(args.trace, args.profile, reset=True)
+
+    database = load_character_database()
+    with TRACER.profile('atlas'):
+        for script in args.scripts or [None]:
+            written, pages = export_atlas(database, script, force=args.force, page_size=args.page_size, padding=args.padding,
+                                          compress_level=args.compress_level, jobs=args.jobs)
+            print(f"{atlas_path(script)}: {written} of {pages} pages written, the others were up to date.")
+    if args.trace:
+        print_trace_summary(args.trace)
@@ -0,0 +1,114 @@
+import os
+import json
+import math
+from build_cache import atomic_write, file_digest
+from tracing import TRACER
+
+
+FONT_METRICS_CACHE_PATH = 'img/token/font_metrics_cache.json'
+FONT_SHRINK_FACTOR = 0.95
+MAX_SHRINK_STEPS = 500
+
+# Metric measurements done by this process, and the ones answered by the cache
+stats = {'metric_calls': 0, 'cache_hits': 0}
+
+
+class FontMetricsCache:
+    """
+    Persistent cache of text metrics per (backend, font file content, text, size).
+    Saving merges with the entries other processes wrote meanwhile.
+    """
+
+    def __init__(self, cache_path=FONT_METRICS_CACHE_PATH):
+        self.cache_path = cache_path
+        self.metrics = None
+        self.new_metrics = {}
+
+    def load(self):
+        if self.metrics is None:
+            self.metrics = self.read()
+        return self.metrics
+
+    def read(self):
+        try:
+            with open(self.cache_path, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, key):
+        return self.load().get(key)
+
+    def set(self, key, metrics):
+        self.load()[key] = metrics
+        self.new_metrics[key] = metrics
+
+    def save(self):
+        if not self.new_metrics:
+            return
+        metrics = self.read()
+        metrics.update(self.new_metrics)
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        with atomic_write(self.cache_path) as file:
+            json.dump(metrics, file)
+        self.new_metrics = {}
+
+
+METRICS_CACHE = FontMetricsCache()
+
+
+def fit_font_size(text, font_path, font_size, max_width, measure, backend):
+    """
+    Returns the font size the text fits in max_width at, with the (width, height) of the text at that size.
+
+    The size is the one of shrinking font_size by FONT_SHRINK_FACTOR until the text fits, but instead of
+    measuring every step, the number of steps is estimated from one measurement (the width being
+    proportional to the size), then corrected one step at a time: usually 2 or 3 measurements.
+    Metrics are cached per (backend, font file, text, size) across runs.
+
+    Args:
+    - text (str): The text to fit.
+    - font_path (str): Path of the font, its content is part of the cache key.
+    - font_size (float): The starting (largest) font size.
+    - max_width (float): The width the text must fit in.
+    - measure (callable): measure(font_size) returns the (width, height) of the text.
+    - backend (str): Name of the measuring backend, part of the cache key.
+    """
+    namespace = f'{backend}|{file_digest(font_path) if os.path.exists(font_path) else font_path}|{text}'
+    sizes = [font_size]
+    metrics = {}
+
+    def size_at(step):
+        # Sizes are computed by repeated multiplication, exactly like the shrinking loop did
+        while len(sizes) <= step:
+            sizes.append(sizes[-1] * FONT_SHRINK_FACTOR)
+        return sizes[step]
+
+    def fits(step):
+        if step not in metrics:
+            key = f'{namespace}|{size_at(step)!r}'
+            cached = METRICS_CACHE.get(key)
+            if cached is None:
+                stats['metric_calls'] += 1
+                cached = list(measure(size_at(step)))
+                METRICS_CACHE.set(key, cached)
+            else:
+                stats['cache_hits'] += 1
+            metrics[step] = tuple(cached)
+        return metrics[step][0] <= max_width
+
+    with TRACER.span('font_fitting', text=text, backend=backend) as span:
+        metric_calls = stats['metric_calls']
+        step = 0
+        if not fits(0):
+            step = math.ceil(math.log(max_width / metrics[0][0]) / math.log(FONT_SHRINK_FACTOR)) if max_width > 0 else 1
+            step = min(max(step, 1), MAX_SHRINK_STEPS)
+            if fits(step):
+                while step > 1 and fits(step - 1):
+                    step -= 1
+            else:
+                while not fits(step) and step < MAX_SHRINK_STEPS:
+                    step += 1
+        # iterations are the sizes tried, measurements the ones the cache did not know
+        span.set(steps=step, iterations=len(metrics), measurements=stats['metric_calls'] - metric_calls)
+    return size_at(step), metrics[step]
@@ -1,10 +1,57 @@
 import json
+import argparse
+import reportlab
 from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfgen import canvas
-from PIL import Image, ImageOps
+from PIL import Image, ImageDraw, ImageFont
+from build_cache import BuildManifest, RenderStore, bounded_map, content_key
+from character_db import load_character_database
+from tracing import TRACER, add_tracing_arguments, print_trace_summary
 import os
-import tempfile
-from pdf2image import convert_from_path
+import io
+import time
+import functools
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+NIGHT_SHEET_DPI = 300
+NIGHT_SHEET_BACKENDS = ['raster', 'pdf']
+NIGHT_SHEETS_OUTPUT_PATH = 'output_prints/night_order_sheets'
+NIGHT_SHEET_ICON_STORE_PATH = 'img/token/night_sheet_icon_store'
+NIGHT_SHEET_MANIFEST_PATH = 'img/token/night_sheet_manifest.json'
+SCRIPTS_PATH = 'scripts_and_night_order_sheets/scripts'
+SCRAPED_IMAGES_PATH = 'img/token/scraped_images'
+# Size of the icons and of the text of the sheets written for the scripts, in points
+NIGHT_SHEET_LAYOUT = {'image_width': 30, 'image_height': 30, 'font_size': 10}
+
+# Rows that are not characters, added to the sheets of every script
+ADDITIONAL_REMINDERS = ['DAWN', 'DUSK', 'DEMON', 'MINION']
+ADDITIONAL_REMINDERS_DICT = {'DAWN':{'firstNightReminder': '',
+                                    'otherNightReminder': '',
+                                    'id': 'dawn',  # Use the item as the ID
+                                    'image_location': 'img/components/dawn.png'},
+                            'DUSK':{'firstNightReminder': '',
+                                    'otherNightReminder': '',
+                                    'id': 'dusk',  # Use the item as the ID
+                                    'image_location': 'img/components/dusk.png'},
+                            'DEMON':{'firstNightReminder': 'Wake the Demon, show them their Minions and their Bluffs',
+                                    'otherNightReminder': '',
+                                    'id': 'dawn',  # Use the item as the ID
+                                    'image_location': 'img/components/demon.png'},
+                            'MINION':{'firstNightReminder': 'Wake the Minions, show them the Demon',
+                                    'otherNightReminder': '',
+                                    'id': 'dawn',  # Use the item as the ID
+                                    'image_location': 'img/components/minion.png'}}
+
+# Fonts of the sheets, and the TrueType fonts shipped with reportlab the raster backend draws them with
+PDF_FONTS = ('Helvetica', 'Helvetica-Bold')
+RASTER_FONT_PATHS = {
+    'Helvetica': os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf'),
+    'Helvetica-Bold': os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'VeraBd.ttf'),
+}
 
 def read_json_values(file_path):
     # Load the JSON data from the file
@@ -27,54 +74,40 @@ def read_json_values(file_path):
     # print("Values in JSON file:", all_values)
     return all_values
 
-def replace_items_with_names(list1, characters_list):
-    # Create a dictionary to map 'id' to 'name' from the list of dictionaries
-    id_to_name = {character['id']: character['name'] for character in characters_list}
-
-    # Iterate over list1 and replace items using the id_to_name dictionary
+def replace_items_with_names(list1, database):
+    # Iterate over list1 and replace the ids of characters (in any spelling) with their names
     for i, item in enumerate(list1):
-        if item.replace('_','') in id_to_name:
-            list1[i] = id_to_name[item.replace('_','')]
+        character = database.get(item) if isinstance(item, str) else None
+        if character is not None:
+            list1[i] = character.name
     return list1
 
 
 
-def create_night_sheet(items, characters_json, additional_reminders,additional_reminders_dict):
+def create_night_sheet(items, database, additional_reminders_dict):
     # Initialize the new dictionary to store the results
     night_sheet = {}
 
-    # Create a mapping from 'name' to the rest of the dictionary for quick lookup
-    character_dict = {character['name']: character for character in characters_json}
-
     # Loop through each item in the items list
     for item in items:
-        if item in character_dict:
-            # Access the dictionary corresponding to the current item
-            character_info = character_dict[item]
+        character = database.by_name.get(item)
+        if character is not None:
             # Create a new key in night_sheet for this item
             night_sheet[item] = {
-                'firstNightReminder': character_info.get('firstNightReminder', ''),
-                'otherNightReminder': character_info.get('otherNightReminder', ''),
-                'id': character_info.get('id', ''),  # the ID is the item itself
-                'image_location': 'img/token/scraped_images/' + character_info.get('id', '') + '.png'
+                'firstNightReminder': character.first_night_reminder,
+                'otherNightReminder': character.other_night_reminder,
+                'id': character.id,
+                'image_location': f'{SCRAPED_IMAGES_PATH}/{character.id}.png'
             }
-        elif item in additional_reminders:
+        elif item in additional_reminders_dict:
             # Handle custom reminders for additional items not in characters_json
             night_sheet[item] = additional_reminders_dict[item]
 
     return night_sheet
 
 
-def ordered_intersection(list1, list2):
-    # Create a set from list1 for faster lookup
-    set1 = set(list1)
-    # Collect items from list2 that are in list1, preserving the order of list2
-    result = [item for item in list2 if item in set1]
-    return result
-
 
-
-def wrap_text(text, width, font_name, font_size, canvas):
+def wrap_text(text, width, font_name, font_size):
     """
     A utility function to wrap text to fit within a specified width.
     """
@@ -83,7 +116,7 @@ def wrap_text(text, width, font_name, font_size, canvas):
     line = ""
     for word in words:
         test_line = line + word + " "
-        if canvas.stringWidth(test_line, font_name, font_size) > width:
+        if pdfmetrics.stringWidth(test_line, font_name, font_size) > width:
             wrapped_lines.append(line)
             line = word + " "
         else:
@@ -91,59 +124,128 @@ def wrap_text(text, width, font_name, font_size, canvas):
     wrapped_lines.append(line)  # add the last line
     return wrapped_lines
 
-def generate_pdf(items, first_other_reminder_key = 'firstNightReminder' ,filename="output.pdf", title="", image_width=100, image_height=100, font_size=12, title_font_size=18):
-    c = canvas.Canvas(filename, pagesize=A4)
-    width, height = A4    
+def flattened_icon(image_location, size, background=(255, 255, 255)):
+    """
+    Returns the icon of a night sheet row resized to size (width, height) and flattened on the background color, in RGB.
+    """
+    with Image.open(image_location) as img:
+        img = img.resize(size)
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+    background_img = Image.new('RGBA', img.size, background + (255,))
+    return Image.alpha_composite(background_img, img).convert('RGB')
+
+class IconCache:
+    """
+    Process-wide cache of the flattened, sized icons of the night sheets, shared by every sheet of every script.
+
+    Icons are keyed by (image_location, mtime, size, background), so an edited icon is flattened again. With a
+    RenderStore, the icons are also kept on disk and reused by the next runs.
+    Cached images are shared: callers must not modify them in place.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self.icons = {}
+        self.readers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image_location, size, background=(255, 255, 255)):
+        """
+        Returns the flattened_icon of an image, computed once per process (and once across runs with a store).
+        """
+        key = (image_location, os.stat(image_location).st_mtime_ns, size, background)
+        icon = self.icons.get(key)
+        if icon is not None:
+            self.hits += 1
+            return icon
+
+        self.misses += 1
+        with TRACER.span('icon_flatten', path=image_location, bytes=os.path.getsize(image_location)):
+            if self.store is None:
+                icon = flattened_icon(image_location, size, background)
+            else:
+                params = {'icon': image_location, 'size': list(size), 'background': list(background)}
+                entry_path = self.store.get_path(self.store.key(params, [image_location]), lambda: flattened_icon(image_location, size, background))
+                with Image.open(entry_path) as img:
+                    icon = img.convert('RGB')
+        self.icons[key] = icon
+        return icon
+
+    def get_reader(self, image_location, size, background=(255, 255, 255)):
+        """
+        Returns the icon as a reportlab ImageReader, to draw it from memory.
+        """
+        icon = self.get(image_location, size, background)
+        key = (image_location, size, background)
+        # The reader is made again if the icon was edited meanwhile
+        reader_icon, reader = self.readers.get(key, (None, None))
+        if reader_icon is not icon:
+            reader = ImageReader(icon)
+            self.readers[key] = (icon, reader)
+        return reader
+
+ICON_CACHE = IconCache()
+
+def layout_title(title, fonts=PDF_FONTS, page_size=A4, title_font_size=18, top=30):
+    """
+    Returns the drawing operation of the title of a night sheet column, centred top points below the top of the page.
+    """
+    bold_font_name = fonts[1]
+    width, height = page_size
+    title_width = pdfmetrics.stringWidth(title, bold_font_name, title_font_size)
+    return ('text', title, (width - title_width) / 2, height - top - title_font_size, bold_font_name, title_font_size)
+
+def layout_night_sheet(items, first_other_reminder_key='firstNightReminder', title="", fonts=PDF_FONTS, page_size=A4,
+                       image_width=100, image_height=100, font_size=12, title_font_size=18):
+    """
+    Lays out a night sheet column, independently of what it is drawn on.
+
+    Args:
+    - items (dict): The night sheet, rows by character name.
+    - first_other_reminder_key (str): 'firstNightReminder' or 'otherNightReminder'.
+    - fonts (tuple): The (regular, bold) reportlab font names the text is measured with.
+    - page_size (tuple): The (width, height) of a page, in points.
+
+    Returns:
+    - list: The pages, each a list of drawing operations in points from the bottom left corner of the page:
+      ('image', image_location, x, y, width, height) and ('text', string, x, y, font_name, font_size).
+    """
+    font_name, bold_font_name = fonts
+    width, height = page_size
     h_padding = 30
     v_padding = 5
     v_padding_init = 30
     x_position = h_padding
     y_position = height - v_padding_init  # Start from the top
+    page = []
+    pages = [page]
 
     # Draw the title
     if title:
-        c.setFont("Helvetica-Bold", title_font_size)
-        title_width = c.stringWidth(title, "Helvetica-Bold", title_font_size)
-        c.drawString((width - title_width) / 2, y_position - title_font_size, title)
+        page.append(layout_title(title, fonts, page_size, title_font_size, v_padding_init))
         y_position -= (title_font_size * 2)  # Adjust y_position after the title
 
-    temp_files = []  # List to keep track of temporary files
-
     for key, info in items.items():
-        # Load and resize image
-        img_path = info['image_location']
-        with Image.open(img_path) as img:
-            img = img.resize((image_width, image_height))  # Resize method needs adjustment based on Pillow version
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-            white_bg = Image.new('RGBA', img.size, (255, 255, 255, 255))
-            img_with_bg = Image.alpha_composite(white_bg, img)
-            img_with_bg = img_with_bg.convert('RGB')
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-            img_with_bg.save(temp_file.name)
-            temp_files.append(temp_file.name)
-
         # Draw image
         image_y_position = y_position - image_height
-        c.drawImage(temp_file.name, x_position, image_y_position, width=image_width, height=image_height)
+        page.append(('image', info['image_location'], x_position, image_y_position, image_width, image_height))
 
         # Prepare and wrap text
         text_x_position = x_position + image_width #+ h_padding
         text_width = width - text_x_position - 2 * h_padding - 80
         text = f"{info[first_other_reminder_key]}"
-        lines = wrap_text(text, text_width, "Helvetica", font_size, c)
+        lines = wrap_text(text, text_width, font_name, font_size)
 
         # Calculate text block height
         text_block_height = len(lines) * (font_size * 1.2)
-        
+
         # Text block position and drawing
-        text_y_position = image_y_position + font_size 
-        c.setFont("Helvetica-Bold", font_size)
-        character_width = c.stringWidth(key, "Helvetica-Bold", font_size)
-        c.drawString(text_x_position, text_y_position, key)
-        c.setFont("Helvetica", font_size)
+        text_y_position = image_y_position + font_size
+        page.append(('text', key, text_x_position, text_y_position, bold_font_name, font_size))
         for line in lines:
-            c.drawString(text_x_position +100, text_y_position, line)
+            page.append(('text', line, text_x_position + 100, text_y_position, font_name, font_size))
             text_y_position -= font_size * 1.2  # Move up for next line
 
         # Adjust y_position for next image
@@ -151,68 +253,160 @@ def generate_pdf(items, first_other_reminder_key = 'firstNightReminder' ,filenam
 
         # Check if we need a new page
         if y_position < (image_height + v_padding):
-            c.showPage()
+            page = []
+            pages.append(page)
             y_position = height - v_padding
 
-    c.save()
-
-    # Cleanup temporary files
-    for file_path in temp_files:
-        os.remove(file_path)
-
+    if not page:
+        pages.pop()  # The last row filled the page
+    return pages
 
-def convert_pdf_to_image(pdf_path, output_path):
-    try:
-        # Convert PDF to a list of images (one image per page)
-        images = convert_from_path(pdf_path, dpi=300, first_page=1, last_page=1)
-        
-        # Save the first page as an image
-        images[0].save(output_path, 'JPEG')
-        
-        # Remove the PDF file after saving the image
-        os.remove(pdf_path)
-    except Exception as e:
-        print(f"An error occurred: {e}")
+def draw_page_on_canvas(c, operations, x_offset=0):
+    """
+    Draws the operations of a laid out page on a reportlab canvas, shifted right by x_offset points.
+    """
+    for operation in operations:
+        if operation[0] == 'image':
+            _, image_location, x, y, image_width, image_height = operation
+            icon = ICON_CACHE.get_reader(image_location, (image_width, image_height))
+            c.drawImage(icon, x_offset + x, y, width=image_width, height=image_height)
+        else:
+            _, string, x, y, font_name, font_size = operation
+            c.setFont(font_name, font_size)
+            c.drawString(x_offset + x, y, string)
 
+@functools.lru_cache(maxsize=None)
+def raster_font(font_name, size):
+    return ImageFont.truetype(RASTER_FONT_PATHS[font_name], size)
 
-def merge_images_side_by_side(image_path1, image_path2, output_path):
+def draw_page_on_image(image, operations, dpi=NIGHT_SHEET_DPI, x_offset=0):
     """
-    Merges two images side by side and saves the result.
-
-    Parameters:
-    - image_path1: Path to the first image file.
-    - image_path2: Path to the second image file.
-    - output_path: Path to save the merged image.
+    Draws the operations of a laid out page on a PIL image at dpi, shifted right by x_offset points.
+    Text is drawn with the font of RASTER_FONT_PATHS, fitted to the width it has in the PDF font, so the
+    layout is exactly the one of the PDF.
     """
-    # Open the images
-    image1 = Image.open(image_path1)
-    image2 = Image.open(image_path2)
+    scale = dpi / 72
+    for operation in operations:
+        if operation[0] == 'image':
+            _, image_location, x, y, image_width, image_height = operation
+            size = (round(image_width * scale), round(image_height * scale))
+            icon = ICON_CACHE.get(image_location, size)
+            image.paste(icon, (round((x_offset + x) * scale), image.height - round(y * scale) - size[1]))
+        else:
+            _, string, x, y, font_name, font_size = operation
+            if not string.strip():
+                continue
+            font = raster_font(font_name, round(font_size * scale))
+            left, top, right, bottom = font.getbbox(string, anchor='ls')
+            mask = Image.new('L', (right - left, bottom - top), 0)
+            ImageDraw.Draw(mask).text((-left, -top), string, font=font, fill=255, anchor='ls')
+            # Condense the text to its width in the PDF font, the lines are wrapped with those metrics
+            condensing = pdfmetrics.stringWidth(string, font_name, font_size) * scale / font.getlength(string)
+            mask = mask.resize((max(1, round(mask.width * condensing)), mask.height), Image.Resampling.LANCZOS)
+            image.paste('black', (round((x_offset + x) * scale + left * condensing), image.height - round(y * scale) + top), mask)
 
-    # Get the maximum height of the two images
-    max_height = max(image1.height, image2.height)
+def generate_pdf(items, first_other_reminder_key = 'firstNightReminder' ,filename="output.pdf", title="", image_width=100, image_height=100, font_size=12, title_font_size=18):
+    c = canvas.Canvas(filename, pagesize=A4)
+    pages = layout_night_sheet(items, first_other_reminder_key, title, PDF_FONTS, A4, image_width, image_height, font_size, title_font_size)
+    for page_number, operations in enumerate(pages):
+        if page_number:
+            c.showPage()
+        draw_page_on_canvas(c, operations)
+    c.save()
 
-    # Resize images to the maximum height, keeping aspect ratio
-    image1 = image1.resize((int(image1.width * max_height / image1.height), max_height))
-    image2 = image2.resize((int(image2.width * max_height / image2.height), max_height))
+NIGHT_SHEET_EXTENSIONS = {'raster': '.jpg', 'pdf': '.pdf'}
+
+# The columns of the sheets: the reminder they show, and the end of their title
+NIGHT_SHEET_COLUMNS = [('firstNightReminder', 'First Night'), ('otherNightReminder', 'Other Nights')]
+
+class NightSheetBody:
+    """
+    The two columns of the sheets of write_night_sheets, laid out (and drawn, with the raster backend) without their
+    titles: the scripts whose sheets have the same rows share a body, drawn once and retitled for each of them.
+    """
 
-    # Create a new image with a width equal to the sum of both images
-    total_width = image1.width + image2.width
-    new_image = Image.new('RGB', (total_width, max_height))
+    def __init__(self, first_night_sheet, other_night_sheet, backend='raster', dpi=NIGHT_SHEET_DPI, image_width=30, image_height=30, font_size=10):
+        self.backend = backend
+        self.dpi = dpi
+        width, height = A4
+        with TRACER.span('night_sheet_layout'):
+            self.columns = []
+            for sheet, (reminder_key, column_title) in zip((first_night_sheet, other_night_sheet), NIGHT_SHEET_COLUMNS):
+                # Laid out with a title to leave room for it, the title is drawn by write()
+                pages = layout_night_sheet(sheet, reminder_key, column_title, PDF_FONTS, A4, image_width, image_height, font_size)
+                self.columns.append([pages[0][1:]] + pages[1:])
+
+        self.image = None
+        if backend == 'raster':
+            # Same size as the A4 pages rasterised at dpi
+            self.page_width, page_height = round(width * dpi / 72), round(height * dpi / 72)
+            with TRACER.span('night_sheet_draw', backend=backend):
+                self.image = Image.new('RGB', (2 * self.page_width, page_height), 'white')
+                for column_number, pages in enumerate(self.columns):
+                    draw_page_on_image(self.image, pages[0], dpi, x_offset=column_number * self.page_width * 72 / dpi)
+            # The band above the rows, where write() draws the titles: it is pasted back to clear them
+            rows_top = max((operation[3] + operation[5] for pages in self.columns for operation in pages[0]), default=0)
+            self.title_band = self.image.crop((0, 0, self.image.width, max(1, round((height - rows_top) * dpi / 72))))
+
+    def write(self, output, title):
+        """
+        Writes the sheets titled after title to output, the path of the file or a binary file object.
+        """
+        width, height = A4
+        titles = [layout_title(f"{title} - {column_title}", PDF_FONTS, A4) for _, column_title in NIGHT_SHEET_COLUMNS]
+
+        if self.backend == 'raster':
+            if any(len(pages) > 1 for pages in self.columns):
+                print(f"{title}: a column does not fit on one page, use the 'pdf' backend to get all of it")
+            try:
+                with TRACER.span('night_sheet_title', backend=self.backend):
+                    for column_number, operation in enumerate(titles):
+                        draw_page_on_image(self.image, [operation], self.dpi, x_offset=column_number * self.page_width * 72 / self.dpi)
+                with TRACER.span('night_sheet_encode', backend=self.backend):
+                    self.image.save(output, 'JPEG')
+            finally:
+                self.image.paste(self.title_band, (0, 0))
+            return
+
+        with TRACER.span('night_sheet_draw', backend=self.backend):
+            c = canvas.Canvas(output, pagesize=(2 * width, height))
+            for page_number in range(max(len(pages) for pages in self.columns)):
+                if page_number:
+                    c.showPage()
+                for column_number, pages in enumerate(self.columns):
+                    if page_number < len(pages):
+                        operations = [titles[column_number]] + pages[0] if page_number == 0 else pages[page_number]
+                        draw_page_on_canvas(c, operations, x_offset=column_number * width)
+        with TRACER.span('night_sheet_encode', backend=self.backend):
+            c.save()
+
+def write_night_sheets(first_night_sheet, other_night_sheet, output, title, backend='raster', dpi=NIGHT_SHEET_DPI,
+                       image_width=30, image_height=30, font_size=10):
+    """
+    Lays out the first night and other nights columns side by side, on two A4 pages wide sheets, ready to be folded in 2.
 
-    # Paste image1 and image2 next to each other
-    new_image.paste(image1, (0, 0))
-    new_image.paste(image2, (image1.width, 0))
+    The 'raster' backend draws them straight on an RGB canvas at dpi and saves the first sheet as a JPEG;
+    the 'pdf' backend writes every sheet as vector graphics in a PDF.
+    output is the path of the file, or a binary file object.
+    """
+    body = NightSheetBody(first_night_sheet, other_night_sheet, backend, dpi, image_width, image_height, font_size)
+    body.write(output, title)
 
-    # Save the new image
-    new_image.save(output_path)
+def generate_night_sheets(first_night_sheet, other_night_sheet, output_path, title, backend='raster', dpi=NIGHT_SHEET_DPI,
+                          image_width=30, image_height=30, font_size=10):
+    """
+    Writes the sheets of write_night_sheets to output_path + '.jpg' (raster backend) or '.pdf' (pdf backend).
+    Returns the path of the written file.
+    """
+    filename = output_path + NIGHT_SHEET_EXTENSIONS[backend]
+    write_night_sheets(first_night_sheet, other_night_sheet, filename, title, backend, dpi, image_width, image_height, font_size)
+    return filename
 
 
 
 
 ### Start of the main script:
 
-import os
-
 def list_files_in_directory(directory):
     try:
         # List all entries in the directory
@@ -231,66 +425,202 @@ def list_files_in_directory(directory):
         print(f"An error occurred: {e}")
         return []
 
-# Specify the directory you want to list files from
-script_names = list_files_in_directory('scripts_and_night_order_sheets/scripts')
-
-
-for script_name in script_names:
-    print('processing: ', script_name)
-    input_script_json=f'scripts_and_night_order_sheets/scripts/{script_name}.json'
+def script_night_sheets(input_script_json, database):
+    """
+    Returns the first night and the other nights sheets (rows by name) of a script JSON.
+    """
     characters_in_script = read_json_values(input_script_json)
+    characters_in_script.extend(ADDITIONAL_REMINDERS)
 
-    additionnal_reminders = ['DAWN','DUSK','DEMON','MINION']
-    characters_in_script_with_reminders = characters_in_script.extend(additionnal_reminders)
-
-    with open('night-order.json', 'r') as file:
-            data = json.load(file)
-    first_night_order = data['firstNight']
-    other_night_order = data['otherNight']
-
-    with open('characters.json', 'r') as file:
-            characters_json = json.load(file)
-
-    characters_in_script_clean = replace_items_with_names(characters_in_script, characters_json)
-    first_night_order_script = ordered_intersection(characters_in_script_clean,first_night_order)
-    other_night_order_script = ordered_intersection(characters_in_script_clean,other_night_order)
-
+    characters_in_script_clean = replace_items_with_names(characters_in_script, database)
+    first_night_order_script = database.night_order(characters_in_script_clean, first_night=True)
+    other_night_order_script = database.night_order(characters_in_script_clean, first_night=False)
 
-    additional_reminders_dict = {'DAWN':{'firstNightReminder': '',
-                                        'otherNightReminder': '',
-                                        'id': 'dawn',  # Use the item as the ID
-                                        'image_location': 'img/components/dawn.png'},
-                                'DUSK':{'firstNightReminder': '',
-                                        'otherNightReminder': '',
-                                        'id': 'dusk',  # Use the item as the ID
-                                        'image_location': 'img/components/dusk.png'},
-                                'DEMON':{'firstNightReminder': 'Wake the Demon, show them their Minions and their Bluffs',
-                                        'otherNightReminder': '',
-                                        'id': 'dawn',  # Use the item as the ID
-                                        'image_location': 'img/components/demon.png'},
-                                'MINION':{'firstNightReminder': 'Wake the Minions, show them the Demon',
-                                        'otherNightReminder': '',
-                                        'id': 'dawn',  # Use the item as the ID
-                                        'image_location': 'img/components/minion.png'}}
+    first_night_sheet = create_night_sheet(first_night_order_script, database, ADDITIONAL_REMINDERS_DICT)
+    other_night_sheet = create_night_sheet(other_night_order_script, database, ADDITIONAL_REMINDERS_DICT)
+    return first_night_sheet, other_night_sheet
 
-    first_night_sheet = create_night_sheet(first_night_order_script, characters_json, additionnal_reminders, additional_reminders_dict)
-    other_night_sheet = create_night_sheet(other_night_order_script, characters_json, additionnal_reminders, additional_reminders_dict)
+def night_sheet_path(script_name, options):
+    return os.path.join(options['output_dir'], f'{script_name}_merged') + NIGHT_SHEET_EXTENSIONS[options['backend']]
 
+def night_sheet_fingerprint(manifest, first_night_sheet, other_night_sheet, options):
+    """
+    Returns the fingerprint of the body of the sheets of a script: its resolved first night and other nights rows,
+    the content of their icons, and the layout and rendering parameters. The sheets of the scripts with the same
+    fingerprint only differ by their title.
+    """
+    params = {
+        'first_night': [[name, info['firstNightReminder'], info['image_location']] for name, info in first_night_sheet.items()],
+        'other_nights': [[name, info['otherNightReminder'], info['image_location']] for name, info in other_night_sheet.items()],
+        'backend': options['backend'], 'dpi': options['dpi'], **NIGHT_SHEET_LAYOUT,
+    }
+    icon_paths = [info['image_location'] for sheet in (first_night_sheet, other_night_sheet) for info in sheet.values()]
+    return manifest.build_key(icon_paths + list(RASTER_FONT_PATHS.values()) + [__file__], params)
+
+def night_sheet_sources_key(manifest, database):
+    """
+    Returns a key of everything the sheets of any script are made from besides the script itself: the character
+    database, every icon, the fonts and this code.
+    """
+    icon_paths = [info['image_location'] for info in ADDITIONAL_REMINDERS_DICT.values()]
+    if os.path.isdir(SCRAPED_IMAGES_PATH):
+        icon_paths += [os.path.join(SCRAPED_IMAGES_PATH, name) for name in os.listdir(SCRAPED_IMAGES_PATH)]
+    database_key = content_key({'characters': [character.entry for character in database.characters],
+                                'first_night': database.first_night_order, 'other_nights': database.other_night_order})
+    return manifest.build_key(icon_paths + list(RASTER_FONT_PATHS.values()) + [__file__], {'database': database_key})
+
+def plan_night_sheets(script_names, database, options, manifest, force=False):
+    """
+    Returns the scripts whose sheets have to be written, grouped by the fingerprint of their body, as lists of
+    (script name, key of its sheets, key of its sources), and the number of scripts whose sheets are up to date.
 
+    A script is up to date without even being read when neither its JSON nor the sources of every sheet changed
+    since its sheets were written (the key of its sources). Otherwise its rows are resolved, and it is still up to
+    date if its sheets would be the same. Only the names and keys are kept, so planning thousands of scripts takes
+    little memory.
+    """
+    sources_key = night_sheet_sources_key(manifest, database)
+    groups = {}
+    up_to_date = 0
+    for script_name in script_names:
+        script_path = os.path.join(options['scripts_dir'], f'{script_name}.json')
+        filename = night_sheet_path(script_name, options)
+        script_key = manifest.build_key([script_path], {'title': script_name, 'sources': sources_key, 'backend': options['backend'],
+                                                        'dpi': options['dpi'], **NIGHT_SHEET_LAYOUT})
+        if not force and manifest.outputs.get(f'script:{filename}') == script_key and os.path.exists(filename):
+            up_to_date += 1
+            continue
+        try:
+            first_night_sheet, other_night_sheet = script_night_sheets(script_path, database)
+        except Exception as e:
+            print(f"An error occurred while processing {script_name}: {e}")
+            continue
+        body_key = night_sheet_fingerprint(manifest, first_night_sheet, other_night_sheet, options)
+        key = manifest.build_key([], {'body': body_key, 'title': script_name})
+        if not force and manifest.is_fresh(filename, key):
+            manifest.record(f'script:{filename}', script_key)
+            up_to_date += 1
+            continue
+        groups.setdefault(body_key, []).append((script_name, key, script_key))
+    return list(groups.values()), up_to_date
+
+def generate_group_night_sheets(group, database, options):
+    """
+    Generates the night order sheets of a group of scripts of plan_night_sheets: their body is drawn once, and
+    retitled for each script.
 
-    # Example usage:
-    first_night_file_name = f"scripts_and_night_order_sheets/night_order_sheet/temp/{script_name}order_FirstNight_v2.pdf"
-    other_night_filename = f"scripts_and_night_order_sheets/night_order_sheet/temp/{script_name}order_OtherNight_v2.pdf"
-    generate_pdf(first_night_sheet, first_other_reminder_key = 'firstNightReminder' , filename=first_night_file_name, title=f"{script_name} - First Night", image_width=30, image_height=30, font_size=10)
-    generate_pdf(other_night_sheet, first_other_reminder_key = 'otherNightReminder' , filename=other_night_filename, title=f"{script_name} - Other Nights", image_width=30, image_height=30, font_size=10)
+    Args:
+    - group (list): The (script name, key of its sheets, key of its sources) of scripts of options['scripts_dir'], without extension.
+    - database (CharacterDatabase): The characters and night order, from load_character_database.
+    - options (dict): scripts_dir, output_dir, backend and dpi.
 
-    first_night_image_file_name = f'scripts_and_night_order_sheets/night_order_sheet/temp/{script_name}_first.jpg'
-    other_night_image_file_name = f'scripts_and_night_order_sheets/night_order_sheet/temp/{script_name}_other.jpg'
-    convert_pdf_to_image(first_night_file_name, first_night_image_file_name)
-    convert_pdf_to_image(other_night_filename, other_night_image_file_name)
+    Returns:
+    - list: The (script name, path of the written sheets or None, seconds it took, keys) of each script.
+    """
+    results = []
+    body = None
+    for script_name, key, script_key in group:
+        start_time = time.perf_counter()
+        filename = night_sheet_path(script_name, options)
+        try:
+            with TRACER.span('night_sheet', item=script_name, backend=options['backend'], shared=body is not None) as span:
+                if body is None:
+                    first_night_sheet, other_night_sheet = script_night_sheets(os.path.join(options['scripts_dir'], f'{script_name}.json'), database)
+                    rows = len(first_night_sheet) + len(other_night_sheet)
+                    body = NightSheetBody(first_night_sheet, other_night_sheet, options['backend'], options['dpi'], **NIGHT_SHEET_LAYOUT)
+                body.write(filename, script_name)
+                span.set(rows=rows, bytes=os.path.getsize(filename))
+        except Exception as e:
+            print(f"An error occurred while processing {script_name}: {e}")
+            filename = None
+        results.append((script_name, filename, time.perf_counter() - start_time, key, script_key))
+    return results
+
+# Character database of a worker process, received once by init_worker
+worker_database = None
+
+def init_worker(database, icon_store_path, tracing=None):
+    global worker_database
+    worker_database = database
+    TRACER.configure(**(tracing or {}))
+    if icon_store_path:
+        ICON_CACHE.store = RenderStore(icon_store_path)
+
+def generate_group_in_worker(job):
+    """
+    Process pool entry point: generates the sheets of a group of scripts and returns the results with everything
+    it printed, so the parent can report results in the order of the groups.
+    """
+    group, options = job
+    with io.StringIO() as log, contextlib.redirect_stdout(log):
+        with TRACER.profile('night_sheets'):
+            results = generate_group_night_sheets(group, worker_database, options)
+        return results, log.getvalue()
 
-    output = f'output_prints/night_order_sheets/{script_name}_merged.jpg'
-    # output = 'merged.jpg'
+def generate_all_night_sheets(script_names, database, options, jobs=1, icon_store_path=None, force=False, manifest_path=NIGHT_SHEET_MANIFEST_PATH):
+    """
+    Generates the night order sheets of the given scripts, on a pool of spawned processes if jobs > 1, and
+    reports the time each script took. The character database is sent once to each process, not once per script.
 
-    # Example usage
-    merge_images_side_by_side(first_night_image_file_name, other_night_image_file_name, output)
+    The sheets of a script are skipped when its rows, icons, title and options are unchanged since they were
+    written (unless force), and the scripts with the same rows share the drawing of their body. At most 2 * jobs
+    groups of scripts are in flight, so thousands of scripts are generated in bounded memory.
+    Returns the number of scripts whose sheets were written or up to date.
+    """
+    os.makedirs(options['output_dir'], exist_ok=True)
+    manifest = BuildManifest(manifest_path)
+    try:
+        groups, up_to_date = plan_night_sheets(script_names, database, options, manifest, force)
+        if up_to_date:
+            print(f"{up_to_date} scripts are up to date")
+        jobs_list = [(group, options) for group in groups]
+        if jobs > 1 and len(jobs_list) > 1:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=init_worker, initargs=(database, icon_store_path, TRACER.settings())) as executor:
+                return up_to_date + report_night_sheets(bounded_map(executor, generate_group_in_worker, jobs_list, 2 * jobs), manifest)
+
+        init_worker(database, icon_store_path, TRACER.settings())
+        return up_to_date + report_night_sheets(map(generate_group_in_worker, jobs_list), manifest)
+    finally:
+        manifest.save()
+
+def report_night_sheets(results, manifest):
+    generated = 0
+    for group_results, log in results:
+        print(log, end='')
+        shared_with = None
+        for script_name, filename, seconds, key, script_key in group_results:
+            if filename is not None:
+                suffix = f" (same rows as {shared_with})" if shared_with else ''
+                print(f"{script_name}: {seconds:.2f} s -> {filename}{suffix}")
+                manifest.record(filename, key)
+                manifest.record(f'script:{filename}', script_key)
+                generated += 1
+            shared_with = shared_with or script_name
+    return generated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the night order sheets of every script.')
+    parser.add_argument('scripts', nargs='*', help='Names of the scripts to generate (default: every script of --scripts-dir).')
+    parser.add_argument('--scripts-dir', default=SCRIPTS_PATH, help='Folder of the script JSONs.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes generating scripts in parallel.')
+    parser.add_argument('--backend', choices=NIGHT_SHEET_BACKENDS, default='raster',
+                        help="'raster' draws the sheets straight to JPEG at --dpi, 'pdf' writes them as two-column vector PDFs.")
+    parser.add_argument('--dpi', type=int, default=NIGHT_SHEET_DPI, help='Resolution of the raster backend.')
+    parser.add_argument('--output-dir', default=NIGHT_SHEETS_OUTPUT_PATH, help='Folder the sheets are written to.')
+    parser.add_argument('--force', action='store_true', help='Write the sheets of every script, even the ones that are up to date.')
+    parser.add_argument('--icon-store', action='store_true', help=f'Keep the flattened icons in {NIGHT_SHEET_ICON_STORE_PATH} for the next runs.')
+    add_tracing_arguments(parser)
+    args = parser.parse_args()
+    TRACER.configure(args.trace, args.profile, reset=True)
+
+    script_names = args.scripts or sorted(list_files_in_directory(args.scripts_dir))
+    options = {'scripts_dir': args.scripts_dir, 'output_dir': args.output_dir, 'backend': args.backend, 'dpi': args.dpi}
+    icon_store_path = NIGHT_SHEET_ICON_STORE_PATH if args.icon_store else None
+
+    start_time = time.perf_counter()
+    generated = generate_all_night_sheets(script_names, load_character_database(), options, jobs=args.jobs, icon_store_path=icon_store_path,
+                                          force=args.force)
+    print(f"{generated}/{len(script_names)} scripts generated or up to date in {time.perf_counter() - start_time:.2f} s")
+    if args.trace:
+        print_trace_summary(args.trace)
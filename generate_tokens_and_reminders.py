@@ -1,13 +1,29 @@
+import io
 import os
-import json
-import matplotlib.pyplot as plt
-from matplotlib.font_manager import FontProperties
-import numpy as np
-from PIL import Image, ImageDraw
-from wand.color import Color
-from wand.drawing import Drawing
-from wand.image import Image as wandImage
-import math
+import queue
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+import shutil
+import argparse
+from batch_composite import composite_batch
+from build_cache import BuildManifest, RenderStore, bounded_map
+from character_db import load_character_database, read_script_ids
+import arc_text
+import font_fitting
+import glyph_atlas
+import image_pyramid
+from layer_cache import LayerCache, circular_mask, solid_color
+from tracing import TRACER, add_tracing_arguments, print_trace_summary
+try:
+    from wand.color import Color
+    from wand.drawing import Drawing
+    from wand.image import Image as wandImage
+except ImportError:
+    # ImageMagick is optional, role names are then curved with the NumPy backend
+    wandImage = None
 
 
 # Constants for file paths and configuration
@@ -17,12 +33,33 @@ GENERATED_TOKENS_PATH = os.path.join(IMG_TOKEN_PATH, 'generated_tokens')
 GENERATED_REMINDERS_PATH = os.path.join(IMG_TOKEN_PATH, 'generated_reminders')
 CURVED_CHARACTER_NAMES_PATH = os.path.join(IMG_TOKEN_PATH, 'curved_character_names')
 CURVED_REMINDERS_PATH = os.path.join(IMG_TOKEN_PATH, 'curved_reminders')
+CURVED_TEXT_STORE_PATH = os.path.join(IMG_TOKEN_PATH, 'curved_text_store')
 CHARACTERS_JSON_PATH =  'characters.json'
 TOKEN_BG_PATH = 'img/token_bg'
-
-# Ensure all necessary directories exist
-for path in [SCRAPED_IMAGES_PATH, GENERATED_TOKENS_PATH, GENERATED_REMINDERS_PATH, CURVED_CHARACTER_NAMES_PATH, CURVED_REMINDERS_PATH]:
-    os.makedirs(path, exist_ok=True)
+TOKEN_BACKGROUND_PATH = os.path.join(TOKEN_BG_PATH, 'official_assets/token.b01ebc0e.png')
+REMINDER_BACKGROUND_PATH = os.path.join(TOKEN_BG_PATH, 'reminder_background.png')
+ROLE_NAME_FONT_PATH = 'img/components/RoleName.ttf'
+REMINDER_FONT_PATH = 'img/components/DejaVuSansMono-Bold.ttf'
+
+# Render parameters, also part of the build cache keys
+TOKEN_DIAMETER = 500
+ROLE_NAME_BACKENDS = ['wand', 'numpy']
+DEFAULT_ROLE_NAME_BACKEND = 'wand' if wandImage is not None else 'numpy'
+TOKEN_MASK_COLOR = (86, 68, 46, 0)
+REMINDER_MASK_COLOR = (45, 45, 45, 0)
+REMINDER_TEXT_PARAMS = {'radius': 130, 'start_angle': 270, 'margin': 10, 'text_color': 'White'}
+REMINDER_FONT_SIZE = 30
+
+# Decoded layers shared by every token and reminder of the process
+LAYER_CACHE = LayerCache()
+# Curved reminder texts, rendered once per unique label and shared by every character and build
+CURVED_TEXT_STORE = RenderStore(CURVED_TEXT_STORE_PATH)
+
+# Rendered images waiting for the consumer of stream_print_images, which bounds their memory if it falls behind
+STREAM_QUEUE_SIZE = 16
+
+# Folders the tokens, reminders and their intermediates are written to, made by process_characters
+OUTPUT_PATHS = [GENERATED_TOKENS_PATH, GENERATED_REMINDERS_PATH, CURVED_CHARACTER_NAMES_PATH, CURVED_REMINDERS_PATH]
 
 def get_filenames_no_extension(folder_path):
     """
@@ -33,49 +70,46 @@ def get_filenames_no_extension(folder_path):
         if os.path.isfile(os.path.join(folder_path, file)) and file != '.DS_Store'
     ]
 
-def plot_curved_text(text, radius=90, filename='curved_text.png', start_angle=270, margin=10, text_color='Black'):
+def plot_curved_text(text, radius=90, filename=None, start_angle=270, margin=10, text_color='Black'):
     """
-    Plots curved text around a circle with specified parameters.
+    Plots curved text around a circle with specified parameters and returns it as an RGBA PIL image.
+    The image is only written to disk if a filename is given.
     """
-    fig, ax = plt.subplots()
-    fig.patch.set_alpha(0.0)
-    ax.patch.set_alpha(0.0)
-    ax.set_xlim(-radius-margin, radius+margin)
-    ax.set_ylim(-radius-margin, radius+margin)
-
-    max_spread, max_len_text = 150, 19
-    spread = (len(text)/max_len_text) * max_spread
-    for i, char in enumerate(text):
-        start_angle_relative = start_angle - (spread/2 - spread / len(text)/2)
-        angle = start_angle_relative + spread * i/ len(text)
-        x = radius * np.cos(np.radians(angle))
-        y = radius * np.sin(np.radians(angle))
-        rotation = angle + 90
-        font = FontProperties(family='monospace', weight='bold', size=30)
-        ax.text(x, y, char, color=text_color, ha='center', va='bottom', rotation=rotation, fontproperties=font)
-    ax.axis('off')
-    plt.savefig(filename, bbox_inches='tight', pad_inches=0, dpi=300, transparent=True)
-    plt.close(fig)
+    image = glyph_atlas.render_curved_text(text, REMINDER_FONT_PATH, font_size=REMINDER_FONT_SIZE, radius=radius,
+                                           start_angle=start_angle, margin=margin, text_color=text_color)
+    if filename:
+        image.save(filename)
+    return image
 
 
-def curved_text_to_image(text, filepath='curved_text.png', token_diameter = 500):
+def curved_text_to_image(text, filepath=None, token_diameter = 500, backend=DEFAULT_ROLE_NAME_BACKEND):
     """Change a text string into an image with curved text.
 
     Args:
         text (str): The text to be displayed.
-        token_type (str): The type of text to be displayed. Either "reminder" or "role".
+        filepath (str): Optional path where the curved text is also saved, for debugging.
         token_diameter (int): The width of the token. This is used to determine the amount of curvature.
-        components (TokenComponents): The component package to load fonts from.
+        backend (str): "wand" to curve the text with ImageMagick, "numpy" to curve it without it.
+
+    Returns:
+        PIL.Image.Image: A square RGBA image with the curved text at its bottom.
     """
+    # Create a transparent base image of the new size
+    square_size = 500
+    if backend == 'numpy':
+        image = arc_text.curved_text_numpy(text, ROLE_NAME_FONT_PATH, token_diameter=token_diameter, square_size=square_size)
+        if filepath:
+            image.save(filepath)
+        return image
     # Make sure we have text to draw. Otherwise, just return an empty image.
-    img = wandImage(width=1, height=1, resolution=(600, 600))
     if text == "":
-        return img
+        return Image.new('RGBA', (square_size, square_size), (0, 0, 0, 0))
+    img = wandImage(width=1, height=1, resolution=(600, 600))
 
     # Set up the font and color based on the token type
     token_diameter = int(token_diameter - (token_diameter * 0.1))  # Reduce the diameter by 10% to give a little padding
     font_size = token_diameter * 0.15 
-    font_filepath = 'components/RoleName.ttf'
+    font_filepath = ROLE_NAME_FONT_PATH
     color = "#000000"
     text = text.upper()
 
@@ -85,16 +119,12 @@ def curved_text_to_image(text, filepath='curved_text.png', token_diameter = 500)
         draw.font = font_filepath
         draw.font_size = font_size
         draw.fill_color = Color(color)
-        # Get size of text
-        height, width = 0, math.inf
         # Downsize the text until it fits within the token
-        while True:
+        def measure(size):
+            draw.font_size = size
             metrics = draw.get_font_metrics(img, text)
-            height, width = int(metrics.text_height), int(metrics.text_width)
-            if width > 2 * token_diameter * 0.5:
-                draw.font_size = draw.font_size * 0.95
-            else:
-                break
+            return int(metrics.text_width), int(metrics.text_height)
+        draw.font_size, (width, height) = font_fitting.fit_font_size(text, font_filepath, font_size, 2 * token_diameter * 0.5, measure, 'wand')
 
         # Resize the image
         img.resize(width=width, height=int(height * 1.2))
@@ -103,40 +133,30 @@ def curved_text_to_image(text, filepath='curved_text.png', token_diameter = 500)
         draw(img)
         img.virtual_pixel = 'transparent'
         # Curve the text
-        # The curve angle can be found by treating the text width as a chord length and the token width as the diameter
-        # By bisecting this chord we can create a right triangle and solve for the angle.
-        # If the text width is greater than the token width, the angle will be greater than 180 degrees.
-        additional_curve = 0
-        if width > token_diameter:
-            width = width - token_diameter
-            additional_curve = 180
-        curve_degree = round(math.degrees(2 * math.asin((width / 2) / (token_diameter / 2)))) + additional_curve
+        curve_degree = arc_text.arc_curve_degree(width, token_diameter)
         # rotate it 180 degrees since we want it to curve down, then distort and rotate back 180 degrees
         img.rotate(180)
         img.distort('arc', (curve_degree, 180))
         img_width = img.width
 
-        img.save(filename=filepath)
+    with img, wandImage(width=square_size , height=square_size  , background=Color('transparent')) as base_image:
+        # Composite the curved text over the transparent base
+        # positioned at the bottom of the base image
+        padding_top = int(square_size*0.92 - img.height)
+        padding_left = int((square_size - img_width)/2)
+        base_image.composite(img, left=padding_left, top=padding_top)
+        pixels = base_image.export_pixels(channel_map='RGBA', storage='char')
 
-        # Create a transparent base image of the new size
-        square_size = 500
+    image = Image.frombytes('RGBA', (square_size, square_size), bytes(pixels))
+    if filepath:
+        image.save(filepath)
+    return image
 
-    with wandImage(width=square_size , height=square_size  , background=Color('transparent')) as base_image:
-        # Load the original image
-        with wandImage(filename=filepath) as original_image:
-            # Composite the original image over the transparent base
-            # positioned at the bottom of the base image
-            padding_top = int(square_size*0.92 - img.height)
-            padding_left = int((square_size - img_width)/2)
-            base_image.composite(original_image, left=padding_left, top=padding_top)
-            
-            # Save the result
-            base_image.save(filename=filepath)
 
-
-def generate_overlay_array(character_data, folder_path, is_reminder=False, reminder=''):
+def generate_overlay_array(character_data, folder_path, is_reminder=False, reminder='', curved_text=None):
     """
     Generates an array of image paths for overlay, based on character data and conditions.
+    The curved text is always the last layer; if curved_text (a path or an image) is given it is used instead of its path.
     """
     overlay_array = ['img/token_bg/clockface-2-very_white.png'] if is_reminder else []
     curved_text_subpath = CURVED_REMINDERS_PATH if is_reminder else CURVED_CHARACTER_NAMES_PATH
@@ -155,91 +175,533 @@ def generate_overlay_array(character_data, folder_path, is_reminder=False, remin
             overlay_array.append('img/token/leaves/setup.png')
 
     overlay_array.append(os.path.join(folder_path, f"{character_data['id']}.png"))
-    overlay_array.append(curved_text_path)
+    overlay_array.append(curved_text_path if curved_text is None else curved_text)
     return overlay_array
 
 
+def open_layer(layer, size=None):
+    """
+    Returns a layer as an RGBA PIL image resized to size, the layer being either an image path or an
+    already loaded image. Image files are loaded through LAYER_CACHE: the returned image may be shared.
+    """
+    if not isinstance(layer, Image.Image):
+        return LAYER_CACHE.get(layer, size)
+    layer = layer if layer.mode == 'RGBA' else layer.convert('RGBA')
+    if size is not None and layer.size != size:
+        layer = layer.resize(size, Image.Resampling.LANCZOS)
+    return layer
+
+
 # Define a single function for overlay with alpha composite
 def overlay_with_alpha_composite(base_image_path, overlay_image_paths, output_path, mask_color):
     """
     Applies one or more overlay images on top of a base image and saves the result.
-    Optionally adds a transparent mask to the composite image.
+    Adds a circular mask of mask_color around the composite image.
     
     Args:
-    - base_image_path (str): The path to the base image.
-    - overlay_image_paths (list[str]): A list of paths to overlay images.
-    - output_path (str): The path where the final composite image will be saved.
-    - add_transparent_mask (bool): If True, adds a circular transparent mask to the composite.
+    - base_image_path (str | PIL.Image.Image): The path to the base image, or the image itself.
+    - overlay_image_paths (list[str | PIL.Image.Image]): A list of overlay image paths or images.
+    - output_path (str): The path where the final composite image will be saved, None to keep it in memory.
+    - mask_color (tuple): RGBA color outside of the circular mask, None to leave the composite unmasked.
+
+    Returns:
+    - PIL.Image.Image: The composite image, None if it could not be created.
     """
     try:
-        base_img = Image.open(base_image_path).convert("RGBA")
+        with TRACER.span('composite', layers=len(overlay_image_paths) + 1):
+            base_img = open_layer(base_image_path)
 
-        for overlay_image_path in overlay_image_paths:
-            overlay_img = Image.open(overlay_image_path).convert("RGBA")
-            overlay_img_resized = overlay_img.resize(base_img.size, Image.Resampling.LANCZOS)
-            base_img = Image.alpha_composite(base_img, overlay_img_resized)
+            for overlay_image_path in overlay_image_paths:
+                overlay_img_resized = open_layer(overlay_image_path, base_img.size)
+                base_img = Image.alpha_composite(base_img, overlay_img_resized)
 
 
-        # Apply a transparent mask if requested
-        width, height = base_img.size
-        colored_bg_img = Image.new('RGBA', (width, height), mask_color)
-        mask = Image.new('L', (width, height), 0)
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse((0, 0, width, height), fill=255)
-        base_img = Image.composite(base_img, colored_bg_img, mask)
+            # Apply the circular mask
+            if mask_color is not None:
+                colored_bg_img = solid_color(base_img.size, tuple(mask_color))
+                base_img = Image.composite(base_img, colored_bg_img, circular_mask(base_img.size))
 
-        base_img.save(output_path)
+        if output_path:
+            with TRACER.span('png_encode', path=output_path) as span:
+                base_img.save(output_path)
+                span.set(bytes=os.path.getsize(output_path))
+        return base_img
 
     except Exception as e:
         print(f"An error occurred: {e}")
+        return None
 
-# Main processing logic
 
-if __name__ == "__main__":
+def overlay_batch_with_alpha_composite(base_image_path, overlay_stacks, mask_color):
+    """
+    Batch counterpart of overlay_with_alpha_composite: flattens the overlays of several images over the same base,
+    and applies the circular mask, in one vectorised pass of batch_composite.composite_batch. The images match
+    the ones of overlay_with_alpha_composite within batch_composite.PIL_TOLERANCE.
+
+    The build composites with overlay_with_alpha_composite: on a single core, PIL's 8 bit compositing is faster
+    than the float pass, which pays off with many images per batch and a multi-threaded NumPy.
+
+    Args:
+    - base_image_path (str | PIL.Image.Image): The path to the base image shared by the batch, or the image itself.
+    - overlay_stacks (list[list[str | PIL.Image.Image]]): The overlay image paths or images of each image, bottom first.
+    - mask_color (tuple): RGBA color outside of the circular mask, None to leave the composites unmasked.
+
+    Returns:
+    - list[PIL.Image.Image]: The composite images, in the order of overlay_stacks.
+    """
+    if not overlay_stacks:
+        return []
+    with TRACER.span('composite_batch', items=len(overlay_stacks)):
+        base_img = open_layer(base_image_path)
+        # Shorter stacks are padded with transparent layers, which leave the image unchanged
+        depth = max(1, max(len(stack) for stack in overlay_stacks))
+        blank = solid_color(base_img.size, (0, 0, 0, 0))
+        layers = [[open_layer(layer, base_img.size) for layer in stack] + [blank] * (depth - len(stack)) for stack in overlay_stacks]
+        return composite_batch(base_img, layers, None if mask_color is None else tuple(mask_color))
+
+
+def compose_token(character, backend=DEFAULT_ROLE_NAME_BACKEND, curved_text_path=None, output_path=None):
+    """
+    Renders the curved role name and the big character token, saved to output_path if given.
+    The curved role name is kept in memory, and only written to curved_text_path if given.
+    Returns the token image, None if it could not be created.
+    """
+    with TRACER.span('curved_text', backend=backend):
+        curved_text = curved_text_to_image(character['name'].upper(), filepath=curved_text_path, token_diameter=TOKEN_DIAMETER, backend=backend)
+    leaf_array = generate_overlay_array(character, SCRAPED_IMAGES_PATH, curved_text=curved_text)
+    return overlay_with_alpha_composite(TOKEN_BACKGROUND_PATH, leaf_array, output_path, mask_color=TOKEN_MASK_COLOR)
+
+
+def save_generated_image(image, output_path, encoding=None):
+    """
+    Saves a rendered token or reminder with its resolution pyramid, with the keyword arguments of
+    image_pyramid.save_pyramid in encoding. Returns True if it was saved.
+    """
     try:
-        with open(CHARACTERS_JSON_PATH, 'r') as file:
-            data = json.load(file)
-    except FileNotFoundError:
-        print(f"Error: '{CHARACTERS_JSON_PATH}' not found.")
-        exit()
+        image_pyramid.save_pyramid(image, output_path, **(encoding or {}))
+        return True
+    except Exception as e:
+        print(f"An error occurred while saving {output_path}: {e}")
+        return False
+
+
+def render_token(character, keep_intermediates=False, backend=DEFAULT_ROLE_NAME_BACKEND, encoding=None):
+    """
+    Renders the curved role name and the big character token. Returns True if the token was saved.
+    The curved role name is kept in memory, and only written to disk with keep_intermediates.
+    """
+    curved_character_names_path = os.path.join(CURVED_CHARACTER_NAMES_PATH, f"{character['id']}.png") if keep_intermediates else None
+    result_image_path = os.path.join(GENERATED_TOKENS_PATH, f"{character['id']}.png")
+    token = compose_token(character, backend, curved_character_names_path)
+    return token is not None and save_generated_image(token, result_image_path, encoding)
 
-    characters_in_json = [character['id'] for character in data]
-    character_names = get_filenames_no_extension(SCRAPED_IMAGES_PATH)
+
+def curved_reminder_text(reminder, size):
+    """
+    Returns the path of the curved reminder text, already resized to the reminder size, in CURVED_TEXT_STORE.
+    Each unique (text, font, radius, start_angle, margin, color, size) is rendered once across characters and builds.
+    """
+    params = {'text': reminder, 'font_size': REMINDER_FONT_SIZE, 'size': size, **REMINDER_TEXT_PARAMS}
+    with TRACER.span('curved_reminder_text') as span:
+        renders = CURVED_TEXT_STORE.renders
+        key = CURVED_TEXT_STORE.key(params, [REMINDER_FONT_PATH, glyph_atlas.__file__])
+        path = CURVED_TEXT_STORE.get_path(key, lambda: plot_curved_text(reminder, **REMINDER_TEXT_PARAMS).resize(size, Image.Resampling.LANCZOS))
+        span.set(cached=CURVED_TEXT_STORE.renders == renders)
+    return path
+
+
+def reminder_base_plate(character):
+    """
+    Composites the layers shared by all the reminders of a character (background, clockface and icon),
+    without the mask, which has to be applied once the text is on top.
+    """
+    shared_layers = generate_overlay_array(character, SCRAPED_IMAGES_PATH, is_reminder=True)[:-1]
+    with TRACER.span('reminder_base_plate', item=character['id'], character=character['id']):
+        return overlay_with_alpha_composite(REMINDER_BACKGROUND_PATH, shared_layers, None, mask_color=None)
 
 
+def compose_reminder(character, reminder, base_plate=None, curved_text_path=None, output_path=None):
+    """
+    Renders the small reminder token, with its curved text from the shared store, saved to output_path if given.
+    base_plate is the result of reminder_base_plate, to share between the reminders of the character.
+    The curved text is also copied to curved_text_path if given.
+    Returns the reminder image, None if it could not be created.
+    """
+    if base_plate is None:
+        base_plate = reminder_base_plate(character)
+    curved_text = curved_reminder_text(reminder, base_plate.size)
+    if curved_text_path:
+        shutil.copyfile(curved_text, curved_text_path)
+    return overlay_with_alpha_composite(base_plate, [curved_text], output_path, mask_color=REMINDER_MASK_COLOR)
+
+
+def render_reminder(character, reminder, keep_intermediates=False, base_plate=None, encoding=None):
+    """
+    Renders the small reminder token, with its curved text from the shared store. Returns True if the reminder was saved.
+    base_plate is the result of reminder_base_plate, to share between the reminders of the character.
+    With keep_intermediates, the curved text is also copied next to the other intermediates.
+    """
+    curved_text_path = os.path.join(CURVED_REMINDERS_PATH, f"{character['id']}_{reminder}.png") if keep_intermediates else None
+    result_image_reminder_path = os.path.join(GENERATED_REMINDERS_PATH, f"{character['id']}_{reminder}.png")
+    reminder_image = compose_reminder(character, reminder, base_plate, curved_text_path)
+    return reminder_image is not None and save_generated_image(reminder_image, result_image_reminder_path, encoding)
+
+
+def token_build_key(manifest, character, backend=DEFAULT_ROLE_NAME_BACKEND, encoding=None):
+    """
+    Hashes every input of a character token: its JSON entry, icon, background, leaves, font, render parameters and
+    the encoding of its resolution pyramid.
+    """
+    # The curved text (last layer) is rendered from the character entry, it is not an input file
+    layer_paths = generate_overlay_array(character, SCRAPED_IMAGES_PATH)[:-1]
+    input_paths = [TOKEN_BACKGROUND_PATH, ROLE_NAME_FONT_PATH, __file__, arc_text.__file__] + layer_paths
+    params = {'character': character, 'token_diameter': TOKEN_DIAMETER, 'mask_color': TOKEN_MASK_COLOR, 'backend': backend,
+              'encoding': image_pyramid.encoding_settings(encoding)}
+    return manifest.build_key(input_paths, params)
+
+
+def reminder_build_key(manifest, character, reminder, encoding=None):
+    """
+    Hashes every input of a reminder token: its text, the character icon, backgrounds, render parameters and the
+    encoding of its resolution pyramid.
+    """
+    layer_paths = generate_overlay_array(character, SCRAPED_IMAGES_PATH, is_reminder=True, reminder=reminder)[:-1]
+    input_paths = [REMINDER_BACKGROUND_PATH, REMINDER_FONT_PATH, __file__, glyph_atlas.__file__] + layer_paths
+    params = {'id': character['id'], 'reminder': reminder, 'text': REMINDER_TEXT_PARAMS, 'font_size': REMINDER_FONT_SIZE, 'mask_color': REMINDER_MASK_COLOR,
+              'encoding': image_pyramid.encoding_settings(encoding)}
+    return manifest.build_key(input_paths, params)
+
+
+def plan_character(character, manifest, force=False, backend=DEFAULT_ROLE_NAME_BACKEND, encoding=None):
+    """
+    Returns the build key of the token and of each reminder of a character that needs to be rendered, and the
+    paths of the up to date ones whose resolution pyramid is missing or older than them.
+    The token key is None if the token is up to date.
+    """
+    settings = image_pyramid.encoding_settings(encoding)
+    token_key = None
+    pyramid_paths = []
+    result_image_path = os.path.join(GENERATED_TOKENS_PATH, f"{character['id']}.png")
+    key = token_build_key(manifest, character, backend, encoding)
+    if force or not manifest.is_fresh(result_image_path, key):
+        token_key = key
+    elif not image_pyramid.levels_fresh(result_image_path, **settings):
+        pyramid_paths.append(result_image_path)
+
+    reminder_keys = []
+    for reminder in character['reminders'] + character.get('remindersGlobal', []):
+        result_image_reminder_path = os.path.join(GENERATED_REMINDERS_PATH, f"{character['id']}_{reminder}.png")
+        key = reminder_build_key(manifest, character, reminder, encoding)
+        if force or not manifest.is_fresh(result_image_reminder_path, key):
+            reminder_keys.append((reminder, key))
+        elif not image_pyramid.levels_fresh(result_image_reminder_path, **settings):
+            pyramid_paths.append(result_image_reminder_path)
+    return token_key, reminder_keys, pyramid_paths
+
+
+def render_character(character, token_key, reminder_keys, options):
+    """
+    Renders the planned token and reminders of a character, with the render options of process_characters.
+    Returns the (output_path, key) pairs that were saved.
+    """
+    saved = []
+    keep_intermediates = options['keep_intermediates']
+    try:
+        metric_calls = font_fitting.stats['metric_calls']
+        if token_key is not None:
+            with TRACER.span('token', item=character['id'], character=character['id']):
+                token_saved = render_token(character, keep_intermediates, options['backend'], options['encoding'])
+            if token_saved:
+                saved.append((os.path.join(GENERATED_TOKENS_PATH, f"{character['id']}.png"), token_key))
+                metric_calls = font_fitting.stats['metric_calls'] - metric_calls
+                print(f'{character["id"]} - Token created successfully! ({metric_calls} font metric calls)')
+
+        # The background, clockface and icon are composited once for all the reminders of the character
+        base_plate = reminder_base_plate(character) if reminder_keys else None
+        for reminder, key in reminder_keys:
+            with TRACER.span('reminder', item=f"{character['id']}/{reminder}", character=character['id']):
+                reminder_saved = render_reminder(character, reminder, keep_intermediates, base_plate, options['encoding'])
+            if reminder_saved:
+                saved.append((os.path.join(GENERATED_REMINDERS_PATH, f"{character['id']}_{reminder}.png"), key))
+    except Exception as e:
+        print(f"An error occurred while processing {character['id']}: {e}")
+    return saved
+
+
+def render_character_in_worker(job):
+    """
+    Process pool entry point: renders a character and returns the saved outputs with everything it printed,
+    so the parent can report results in a deterministic order.
+    """
+    TRACER.configure(**job[-1]['tracing'])
+    with io.StringIO() as log, contextlib.redirect_stdout(log):
+        with TRACER.profile('tokens'):
+            saved = render_character(*job)
+        font_fitting.METRICS_CACHE.save()
+        return saved, log.getvalue()
+
+
+def process_characters(characters, manifest, force=False, jobs=1, keep_intermediates=False, backend=DEFAULT_ROLE_NAME_BACKEND, encoding=None):
+    """
+    Renders the tokens and reminders of the given characters, skipping the ones whose inputs are unchanged.
+    With jobs > 1, characters are rendered on a pool of spawned processes; results are reported and
+    recorded in the manifest in the order of the characters list. Returns the number of files rendered, counting
+    the up to date ones whose resolution pyramid was written again, and the number of files that could not be.
+    encoding holds the keyword arguments of image_pyramid.save_pyramid: the resolution pyramid written with each
+    image, and how it is encoded.
+    """
+    for path in OUTPUT_PATHS:
+        os.makedirs(path, exist_ok=True)
+    options = {'keep_intermediates': keep_intermediates, 'backend': backend, 'encoding': encoding, 'tracing': TRACER.settings()}
+    planned = []
+    pyramid_paths = []
+    for character in characters:
+        token_key, reminder_keys, stale_pyramids = plan_character(character, manifest, force, backend, encoding)
+        if token_key is not None or reminder_keys:
+            planned.append((character, token_key, reminder_keys, options))
+        pyramid_paths.extend(stale_pyramids)
+
+    # Up to date images whose levels were deleted, or written in another format: only their pyramid is written
+    rebuilt = 0
+    failed = 0
+    for output_path in pyramid_paths:
+        try:
+            image_pyramid.rebuild_pyramid(output_path, **image_pyramid.encoding_settings(encoding))
+            print(f'{output_path} - Resolution pyramid written again')
+            rebuilt += 1
+        except Exception as e:
+            print(f"An error occurred while writing the resolution pyramid of {output_path}: {e}")
+            failed += 1
+
+    if jobs > 1 and len(planned) > 1:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+            results = list(executor.map(render_character_in_worker, planned))
+    else:
+        results = None
+
+    rendered = 0
+    for index, job in enumerate(planned):
+        if results is None:
+            saved = render_character(*job)
+        else:
+            saved, log = results[index]
+            print(log, end='')
+        for output_path, key in saved:
+            manifest.record(output_path, key)
+        rendered += len(saved)
+        failed += (job[1] is not None) + len(job[2]) - len(saved)
+    return rendered + rebuilt, failed
+
+
+def select_characters(database, scripts=()):
+    """
+    Returns the JSON entries of the characters with a scraped icon, or only of the characters of the given scripts,
+    printing the ones that cannot be generated.
+    """
+    character_names = get_filenames_no_extension(SCRAPED_IMAGES_PATH) if os.path.isdir(SCRAPED_IMAGES_PATH) else []
+
     # Identify missing characters in the JSON file
-    missing_characters_in_json = [item for item in character_names if item not in characters_in_json]
+    missing_characters_in_json = [item for item in character_names if database.get(item) is None]
     if missing_characters_in_json:
         print("These characters are not in the JSON and will not be generated:", missing_characters_in_json)
 
-    for character in data:
-        if character['id'] in character_names:
-        # if character['id'] in ['devilsadvocate','drunk','po']:
+    scraped_ids = set(character_names)
+    characters = database.characters
+    if scripts:
+        script_ids = [character_id for script in scripts for character_id in read_script_ids(script)]
+        characters, unknown_ids = database.resolve(script_ids)
+        if unknown_ids:
+            print("These ids of the scripts are not characters and will not be generated:", unknown_ids)
+        missing_icons = [character.id for character in characters if character.id not in scraped_ids]
+        if missing_icons:
+            print("These characters of the scripts have no scraped icon and will not be generated:", missing_icons)
+    return [character.entry for character in characters if character.id in scraped_ids]
+
+
+def build_tokens(database, scripts=(), force=False, jobs=1, keep_intermediates=False, backend=DEFAULT_ROLE_NAME_BACKEND, encoding=None):
+    """
+    Renders the tokens and reminders of every character with a scraped icon, or only of the characters of the
+    given scripts, with process_characters. Returns the number of files rendered and of files that could not be.
+    """
+    manifest = BuildManifest()
+    characters_to_render = select_characters(database, scripts)
+    try:
+        return process_characters(characters_to_render, manifest, force=force, jobs=jobs, keep_intermediates=keep_intermediates, backend=backend,
+                                  encoding=encoding)
+    finally:
+        manifest.save()
+        font_fitting.METRICS_CACHE.save()
+
+
+def print_render_jobs(characters, manifest, force=False, backend=DEFAULT_ROLE_NAME_BACKEND, save=False, encoding=None):
+    """
+    Returns the jobs of stream_print_images: the tokens, then the reminders, of the characters sorted by file name
+    like images_to_pdf places them. A job is a token, or the consecutive reminders of a character, which share
+    their base plate: (kind, character, [(file name, reminder, output path, build key, up to date)]).
+    With save, images whose resolution pyramid is missing or older than them are not up to date.
+    """
+    settings = image_pyramid.encoding_settings(encoding)
+
+    def is_fresh(output_path, key):
+        return (not force and manifest.is_fresh(output_path, key)
+                and (not save or image_pyramid.levels_fresh(output_path, **settings)))
+
+    tokens = []
+    reminders = []
+    for character in characters:
+        file_name = f"{character['id']}.png"
+        output_path = os.path.join(GENERATED_TOKENS_PATH, file_name)
+        key = token_build_key(manifest, character, backend, encoding)
+        tokens.append((file_name, character, None, output_path, key, is_fresh(output_path, key)))
+        for reminder in character['reminders'] + character.get('remindersGlobal', []):
+            file_name = f"{character['id']}_{reminder}.png"
+            output_path = os.path.join(GENERATED_REMINDERS_PATH, file_name)
+            key = reminder_build_key(manifest, character, reminder, encoding)
+            reminders.append((file_name, character, reminder, output_path, key, is_fresh(output_path, key)))
+
+    jobs = [('token', character, [(file_name, reminder, output_path, key, fresh)])
+            for file_name, character, reminder, output_path, key, fresh in sorted(tokens, key=lambda item: item[0])]
+    for file_name, character, reminder, output_path, key, fresh in sorted(reminders, key=lambda item: item[0]):
+        if jobs and jobs[-1][0] == 'reminder' and jobs[-1][1] is character:
+            jobs[-1][2].append((file_name, reminder, output_path, key, fresh))
+        else:
+            jobs.append(('reminder', character, [(file_name, reminder, output_path, key, fresh)]))
+    return jobs
+
+
+def render_print_job(job):
+    """
+    Renders the images of a job of print_render_jobs, saved to their output path with their resolution pyramid with options['save'].
+    Returns the (kind, file name, image, output path, build key) of each, the image being the output path when it
+    is up to date, and None if it could not be rendered: the error is printed and the other images are rendered.
+    """
+    kind, character, items, options = job
+    TRACER.configure(**options['tracing'])
+    results = []
+    base_plate = None
+    for file_name, reminder, output_path, key, fresh in items:
+        image = output_path
+        if not fresh:
             try:
-                # if character['edition'] == 'tb':
-                    # Process big character tokens
-                curved_character_names_path = os.path.join(CURVED_CHARACTER_NAMES_PATH, f"{character['id']}.png")
-                curved_text_to_image(character['name'].upper(), filepath=curved_character_names_path, token_diameter=500)
-
-                leaf_array = generate_overlay_array(character, SCRAPED_IMAGES_PATH)
-                result_image_path = os.path.join(GENERATED_TOKENS_PATH, f"{character['id']}.png")
-                overlay_with_alpha_composite(os.path.join(TOKEN_BG_PATH, 'official_assets/token.b01ebc0e.png' ), leaf_array, result_image_path, mask_color=(86, 68, 46, 0))
-                print(f'{character["id"]} - Token created successfully!')
-                
-                # Process small reminder tokens
-                for reminder in character['reminders']:
-                    curved_reminders_path = os.path.join(CURVED_REMINDERS_PATH, f"{character['id']}_{reminder}.png")
-                    plot_curved_text(reminder, radius=130, filename=curved_reminders_path, start_angle=270, margin=10, text_color = 'White')
-
-                    leaf_array_reminder = generate_overlay_array(character, SCRAPED_IMAGES_PATH, is_reminder=True, reminder=reminder)
-                    result_image_reminder_path = os.path.join(GENERATED_REMINDERS_PATH, f"{character['id']}_{reminder}.png")
-                    overlay_with_alpha_composite(os.path.join(TOKEN_BG_PATH, 'reminder_background.png'), leaf_array_reminder, result_image_reminder_path, mask_color=(45, 45, 45, 0))
-                for reminder in character.get('remindersGlobal', []):
-                    curved_reminders_path = os.path.join(CURVED_REMINDERS_PATH, f"{character['id']}_{reminder}.png")
-                    plot_curved_text(reminder, radius=130, filename=curved_reminders_path, start_angle=270, margin=10, text_color = 'White')
-
-                    leaf_array_reminder = generate_overlay_array(character, SCRAPED_IMAGES_PATH, is_reminder=True, reminder=reminder)
-                    result_image_reminder_path = os.path.join(GENERATED_REMINDERS_PATH, f"{character['id']}_{reminder}.png")
-                    overlay_with_alpha_composite(os.path.join(TOKEN_BG_PATH, 'reminder_background.png'), leaf_array_reminder, result_image_reminder_path, mask_color=(45, 45, 45, 0))
+                with TRACER.span(kind, item=os.path.splitext(file_name)[0], character=character['id']):
+                    if kind == 'token':
+                        image = compose_token(character, options['backend'])
+                    else:
+                        base_plate = base_plate or reminder_base_plate(character)
+                        image = compose_reminder(character, reminder, base_plate)
+                    if image is not None and options['save'] and not save_generated_image(image, output_path, options['encoding']):
+                        image = None
             except Exception as e:
-                print(f"An error occurred while processing {character['id']}: {e}")
\ No newline at end of file
+                print(f"An error occurred while processing {character['id']} ({file_name}): {e}")
+                image = None
+        results.append((kind, file_name, image, output_path, key))
+    return results
+
+
+def render_print_jobs(render_jobs, jobs=1):
+    """
+    Yields the results of the jobs in order, rendering at most 2 * jobs of them ahead on a pool of spawned processes if jobs > 1.
+    """
+    if jobs <= 1:
+        yield from map(render_print_job, render_jobs)
+        return
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        yield from bounded_map(executor, render_print_job, render_jobs, 2 * jobs)
+
+
+def stream_print_images(characters, manifest, jobs=1, save=False, force=False, backend=DEFAULT_ROLE_NAME_BACKEND, queue_size=STREAM_QUEUE_SIZE,
+                        encoding=None):
+    """
+    Renders the tokens, then the reminders, of the characters on a background thread (and a pool of spawned
+    processes if jobs > 1), and yields their ('token' or 'reminder', file name, image) as soon as they are
+    rendered, sorted by file name like images_to_pdf places them, so they can be placed while the next ones render.
+
+    At most queue_size images wait for the consumer: rendering pauses when it falls behind. The up to date files
+    of the generated folders are yielded as paths instead of being rendered again. With save, rendered images
+    are also written there, with their resolution pyramid after encoding (see process_characters), and recorded in
+    the manifest. image is None if the image could not be rendered.
+    """
+    options = {'backend': backend, 'save': save, 'encoding': encoding, 'tracing': TRACER.settings()}
+    if save:
+        for path in OUTPUT_PATHS:
+            os.makedirs(path, exist_ok=True)
+    render_jobs = [job + (options,) for job in print_render_jobs(characters, manifest, force, backend, save, encoding)]
+    results = queue.Queue(maxsize=queue_size)
+    done = object()
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for job_results in render_print_jobs(render_jobs, jobs):
+                for kind, file_name, image, output_path, key in job_results:
+                    if save and isinstance(image, Image.Image):
+                        manifest.record(output_path, key)
+                    results.put((kind, file_name, image))
+                    if stopped.is_set():
+                        return
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(done)
+
+    producer = threading.Thread(target=produce, name='stream_print_images', daemon=True)
+    producer.start()
+    try:
+        while True:
+            result = results.get()
+            if result is done:
+                break
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        # Unblock the producer if the consumer stopped early
+        stopped.set()
+        while producer.is_alive():
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
+
+
+# Main processing logic
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate character tokens and reminders.')
+    parser.add_argument('scripts', nargs='*',
+                        help='Script JSONs (paths, or names of scripts in scripts_and_night_order_sheets/scripts) to only build the characters of. Default: every character.')
+    parser.add_argument('--force', action='store_true', help='Re-render every token, ignoring the build manifest.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes rendering characters in parallel.')
+    parser.add_argument('--keep-intermediates', action='store_true', help='Also save the curved texts to disk, for debugging.')
+    parser.add_argument('--backend', choices=ROLE_NAME_BACKENDS, default=DEFAULT_ROLE_NAME_BACKEND,
+                        help='How role names are curved: with ImageMagick (wand) or with NumPy, which does not need ImageMagick.')
+    parser.add_argument('--no-pyramid', action='store_true',
+                        help=f'Only save the full resolution images, without their print sizes and thumbnails in {image_pyramid.PYRAMID_PATH}.')
+    parser.add_argument('--pyramid-format', choices=list(image_pyramid.PYRAMID_FORMATS), default=image_pyramid.DEFAULT_PYRAMID_FORMAT,
+                        help='Format of the print sizes and thumbnails (WebP is lossless). Full resolution images are always PNGs.')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=image_pyramid.DEFAULT_COMPRESS_LEVEL, metavar='0-9',
+                        help='zlib level of the PNGs, from 0 (fastest) to 9 (smallest).')
+    add_tracing_arguments(parser)
+    args = parser.parse_args()
+    TRACER.configure(args.trace, args.profile, reset=True)
+
+    try:
+        database = load_character_database(CHARACTERS_JSON_PATH)
+    except FileNotFoundError:
+        print(f"Error: '{CHARACTERS_JSON_PATH}' not found.")
+        exit()
+
+    with TRACER.profile('tokens'):
+        encoding = {'pyramid': not args.no_pyramid, 'image_format': args.pyramid_format, 'compress_level': args.compress_level}
+        rendered, failed = build_tokens(database, args.scripts, force=args.force, jobs=args.jobs, keep_intermediates=args.keep_intermediates,
+                                        backend=args.backend, encoding=encoding)
+    print(f"{rendered} files rendered, the others were up to date.")
+    if failed:
+        print(f"{failed} files could not be rendered, they are rendered again on the next run.")
+    if args.trace:
+        print_trace_summary(args.trace)
+    if failed:
+        exit(1)
@@ -1,14 +1,44 @@
 import os
 import re
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from build_cache import atomic_write
+from character_db import load_character_database, normalise_id
 
 # Constants for paths and URLs
 CHARACTERS_FILE_PATH = 'characters.txt'
 SCRAPED_IMAGES_DIR = 'img/token/scraped_images/'
+FETCH_STATE_PATH = 'img/token/scraped_images_state.json'
 BOTC_WIKI_BASE_URL = "https://wiki.bloodontheclocktower.com"
 
-# Ensure the directory for scraped images exists
-os.makedirs(SCRAPED_IMAGES_DIR, exist_ok=True)
+# Network settings: concurrent requests, and retries with exponential backoff on failures and throttling
+MAX_CONCURRENT_REQUESTS = 8
+MAX_RETRIES = 4
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+REQUEST_TIMEOUT = 30
+
+# Characters whose File: page cannot be used, with the path of their icon on the wiki
+CHARACTER_ICON_URLS = {
+    'fortuneteller': '/images/9/97/Icon_fortuneteller.png',
+    'harpy': '/images/d/d3/Icon_harpy.png',
+    'kazali': '/images/3/3c/Icon_kazali.png',
+    'scarletwoman': '/images/1/13/Icon_scarletwoman.png',
+}
+
+print_lock = threading.Lock()
+
+def log(message):
+    """
+    Print a message from any download thread without interleaving it with the others.
+    """
+    with print_lock:
+        print(message)
 
 def read_characters_from_file(file_path):
     """
@@ -17,58 +47,160 @@ def read_characters_from_file(file_path):
     characters = []
     with open(file_path, 'r') as file:
         for line in file:
-            character = line.strip().lower().replace(" ", "").replace("'", "").replace("-", "")
+            character = normalise_id(line)
             if character:
                 characters.append(character)
     return sorted(characters)
 
-def download_image(image_url, character_name):
+def create_session(pool_size=MAX_CONCURRENT_REQUESTS, max_retries=MAX_RETRIES):
+    """
+    Create a requests session with a connection pool shared by all the downloads, retrying failed GETs with backoff.
+    """
+    retry = Retry(total=max_retries, backoff_factor=RETRY_BACKOFF_FACTOR, status_forcelist=RETRY_STATUS_CODES, allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def load_fetch_state(state_path=FETCH_STATE_PATH):
+    """
+    Load the image URL, ETag and Last-Modified of every downloaded icon.
+    """
+    try:
+        with open(state_path, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_fetch_state(state, state_path=FETCH_STATE_PATH):
+    os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+    with atomic_write(state_path) as file:
+        json.dump(state, file, indent=1, sort_keys=True)
+
+def download_image(image_url, character_name, session=None, previous_state=None, images_dir=SCRAPED_IMAGES_DIR):
     """
     Download and save the image for a character.
+    If the icon was downloaded before from the same URL, a conditional request is sent and an unchanged icon is not downloaded again.
+    Returns the new fetch state of the icon, None if the download failed.
     """
+    session = session or requests
+    scraped_file = os.path.join(images_dir, f'{character_name}.png')
+    headers = {}
+    if previous_state and previous_state.get('url') == image_url and os.path.exists(scraped_file):
+        if previous_state.get('etag'):
+            headers['If-None-Match'] = previous_state['etag']
+        if previous_state.get('last_modified'):
+            headers['If-Modified-Since'] = previous_state['last_modified']
     try:
-        response = requests.get(image_url)
+        response = session.get(image_url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            log(f"{character_name} is up to date")
+            return previous_state
         response.raise_for_status()
-        scraped_file = f'{SCRAPED_IMAGES_DIR}{character_name}.png'
-        with open(scraped_file, "wb") as file:
+        # Write to a temporary file first so an interrupted download never leaves a truncated icon
+        with atomic_write(scraped_file, 'wb') as file:
             file.write(response.content)
-        print(f"Successfully saved {character_name}")
-    except requests.HTTPError as e:
-        print(f"Failed to download image for {character_name}: {e}")
+        log(f"Successfully saved {character_name}")
+        return {'url': image_url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    except (requests.RequestException, OSError) as e:
+        # Also the icons that could not be written, so the other characters are still downloaded
+        log(f"Failed to download image for {character_name}: {e}")
+        return None
+
+def find_image_url(character, session=None, base_url=BOTC_WIKI_BASE_URL):
+    """
+    Find the URL of a character icon on its File: page of the wiki, None if there is none.
+    """
+    session = session or requests
+    url = f"{base_url}/File:Icon_{character}.png"
+    response = session.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()  # Raises HTTPError for bad responses
+
+    pattern = r'href="(/images/[^/]+/[^/]+/Icon_[^"]+.png)"'
+    matches = re.findall(pattern, response.text)
+    if matches:
+        return base_url + matches[0]
+    return None
 
-def scrape_character_images(characters, character_urls):
+def fetch_character_image(character, character_urls, session, previous_state, base_url=BOTC_WIKI_BASE_URL, images_dir=SCRAPED_IMAGES_DIR):
     """
-    Scrape images for characters from the BOTC wiki, with specific URLs for ignored characters.
+    Fetch the icon of one character, returns its new fetch state (None if it failed).
+    Icons downloaded before are revalidated on their known URL, without loading their File: page again,
+    unless that URL fails.
     """
-    for character in characters:
-        image_url = character_urls.get(character)
+    image_path = character_urls.get(character)
+    if image_path:
+        log(f"Using provided URL for character: {character}")
+        return download_image(base_url + image_path, character, session, previous_state, images_dir)
+    known_url = None
+    if previous_state and previous_state.get('url') and os.path.exists(os.path.join(images_dir, f'{character}.png')):
+        known_url = previous_state['url']
+        character_state = download_image(known_url, character, session, previous_state, images_dir)
+        if character_state is not None:
+            return character_state
+        # The icon may have been moved or renamed on the wiki: its File: page links to its new URL
+        log(f"Looking for a new URL of the icon of {character}")
+    try:
+        image_url = find_image_url(character, session, base_url)
+        if known_url and image_url == known_url:
+            # Still the icon of its File: page, the failed download is not sent again
+            return None
         if image_url:
-            print(f"Using provided URL for character: {character}")
-            download_image(image_url, character)
-        else:
-            try:
-                url = f"{BOTC_WIKI_BASE_URL}/File:Icon_{character}.png"
-                response = requests.get(url)
-                response.raise_for_status()  # Raises HTTPError for bad responses
-
-                pattern = r'href="(/images/[^/]+/[^/]+/Icon_[^"]+.png)"'
-                matches = re.findall(pattern, response.text)
-                if matches:
-                    image_url = BOTC_WIKI_BASE_URL + matches[0]
-                    download_image(image_url, character)
-                else:
-                    print(f"No image found for {character}")
-            except requests.HTTPError as e:
-                print(f"Failed to fetch {character}: {e}")
+            return download_image(image_url, character, session, previous_state, images_dir)
+        log(f"No image found for {character}")
+    except requests.RequestException as e:
+        log(f"Failed to fetch {character}: {e}")
+    return None
 
-if __name__ == "__main__":
-    # Ignore list with specific URLs
-    ignore_list_with_urls = {
-        'fortuneteller': 'https://wiki.bloodontheclocktower.com/images/9/97/Icon_fortuneteller.png',
-        'harpy': 'https://wiki.bloodontheclocktower.com/images/d/d3/Icon_harpy.png',
-        'kazali': 'https://wiki.bloodontheclocktower.com/images/3/3c/Icon_kazali.png',
-        'scarletwoman': 'https://wiki.bloodontheclocktower.com/images/1/13/Icon_scarletwoman.png',
-    }
-    
+def scrape_character_images(characters, character_urls, base_url=BOTC_WIKI_BASE_URL, jobs=MAX_CONCURRENT_REQUESTS,
+                            skip_existing=False, images_dir=SCRAPED_IMAGES_DIR, state_path=FETCH_STATE_PATH):
+    """
+    Scrape images for characters from the BOTC wiki, with specific URLs (paths on the wiki) for ignored characters.
+
+    Icons are fetched concurrently over a pooled session. Their URL, ETag and Last-Modified are kept in
+    state_path, so the next runs only send conditional requests and skip unchanged icons; with skip_existing,
+    icons already on disk are not requested at all. The state is saved even if the run is interrupted, so
+    it can be resumed.
+    """
+    os.makedirs(images_dir, exist_ok=True)
+    state = load_fetch_state(state_path)
+    if skip_existing:
+        characters = [character for character in characters if not os.path.exists(os.path.join(images_dir, f'{character}.png'))]
+
+    session = create_session(pool_size=jobs)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(fetch_character_image, character, character_urls, session, state.get(character), base_url, images_dir): character
+                for character in characters
+            }
+            for future in as_completed(futures):
+                character_state = future.result()
+                if character_state is not None:
+                    state[futures[future]] = character_state
+    finally:
+        session.close()
+        save_fetch_state(state, state_path)
+    return state
+
+def fetch_character_icons(database=None, base_url=BOTC_WIKI_BASE_URL, jobs=MAX_CONCURRENT_REQUESTS, skip_existing=False):
+    """
+    Downloads the icons of the characters of characters.txt, warning about the ones that are not in the
+    character database (loaded if not given).
+    """
     characters = read_characters_from_file(CHARACTERS_FILE_PATH)
-    scrape_character_images(characters, ignore_list_with_urls)
\ No newline at end of file
+    database = database or load_character_database()
+    unknown_characters = [character for character in characters if database.get(character) is None]
+    if unknown_characters:
+        print("These characters are not in characters.json, their tokens will not be generated:", unknown_characters)
+    return scrape_character_images(characters, CHARACTER_ICON_URLS, base_url=base_url, jobs=jobs, skip_existing=skip_existing)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Download the character icons from the wiki.')
+    parser.add_argument('--base-url', default=BOTC_WIKI_BASE_URL, help='Base URL of the wiki, e.g. a local mirror.')
+    parser.add_argument('--jobs', type=int, default=MAX_CONCURRENT_REQUESTS, help='Maximum number of concurrent requests.')
+    parser.add_argument('--skip-existing', action='store_true', help='Do not request icons that are already downloaded.')
+    args = parser.parse_args()
+
+    fetch_character_icons(base_url=args.base_url, jobs=args.jobs, skip_existing=args.skip_existing)
@@ -0,0 +1,109 @@
+import functools
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+
+CURVED_TEXT_DPI = 300
+# Size in pixels of the drawing area the text is laid out in, the axes area of a default 6.4x4.8 inches
+# matplotlib figure at 300 dpi, so curved reminders keep the proportions of the former matplotlib renderer.
+CURVED_TEXT_AREA_SIZE = (1488, 1108.8)
+MAX_SPREAD, MAX_LEN_TEXT = 150, 19
+
+
+class GlyphAtlas:
+    """
+    Rasterised glyphs of one font, size and color.
+
+    Each character is drawn once in a cell as wide as its advance and as high as the font line,
+    so glyphs placed on their cell share the same baseline.
+    """
+
+    def __init__(self, font_path, font_size, color):
+        self.font = ImageFont.truetype(font_path, font_size)
+        self.color = ImageColor.getrgb(color)[:3]
+        ascent, descent = self.font.getmetrics()
+        self.ascent = ascent
+        self.line_height = ascent + descent
+        self.glyphs = {}
+
+    def glyph(self, char):
+        """
+        Returns the RGBA cell of a character, rendering it on first use.
+        """
+        if char not in self.glyphs:
+            width = max(1, int(np.ceil(self.font.getlength(char))))
+            mask = Image.new('L', (width, self.line_height), 0)
+            ImageDraw.Draw(mask).text((0, self.ascent), char, font=self.font, fill=255, anchor='ls')
+            cell = Image.new('RGBA', mask.size, self.color + (0,))
+            cell.putalpha(mask)
+            self.glyphs[char] = cell
+        return self.glyphs[char]
+
+
+@functools.lru_cache(maxsize=None)
+def get_glyph_atlas(font_path, font_size, color):
+    """
+    Returns the glyph atlas of a (font, size, color), shared for the whole run.
+    """
+    return GlyphAtlas(font_path, font_size, color)
+
+
+def render_curved_text(text, font_path, font_size=30, radius=90, start_angle=270, margin=10, text_color='Black'):
+    """
+    Renders text along an arc and returns it as an RGBA PIL image.
+
+    The characters are spread evenly around start_angle (degrees, counterclockwise from the right), each one
+    rotated to follow the arc and standing on it. The image covers the (2*(radius+margin)) wide square drawing
+    area, grown to fit glyphs going over its border.
+
+    Args:
+        text (str): The text to be displayed.
+        font_path (str): Path of the TrueType font.
+        font_size (float): Font size in points, rendered at CURVED_TEXT_DPI.
+        radius (float): Radius of the arc, in the same units as margin.
+        start_angle (float): Angle of the middle of the text.
+        margin (float): Space between the arc and the drawing area border.
+        text_color (str): Any PIL color string.
+    """
+    area_width, area_height = CURVED_TEXT_AREA_SIZE
+    if not text:
+        return Image.new('RGBA', (int(area_width), int(area_height)), (0, 0, 0, 0))
+
+    atlas = get_glyph_atlas(font_path, round(font_size * CURVED_TEXT_DPI / 72), text_color)
+    cells = [atlas.glyph(char) for char in text]
+
+    # Position and rotation of every glyph, computed at once
+    spread = (len(text) / MAX_LEN_TEXT) * MAX_SPREAD
+    angles = start_angle - (spread / 2 - spread / len(text) / 2) + spread * np.arange(len(text)) / len(text)
+    scale_x = area_width / (2 * (radius + margin))
+    scale_y = area_height / (2 * (radius + margin))
+    anchor_x = area_width / 2 + radius * np.cos(np.radians(angles)) * scale_x
+    anchor_y = area_height / 2 - radius * np.sin(np.radians(angles)) * scale_y
+    rotations = np.radians(angles + 90)
+    cos, sin = np.cos(rotations), np.sin(rotations)
+
+    # Rotated glyph boxes stand on their anchor, horizontally centered on it
+    widths = np.array([cell.width for cell in cells], dtype=float)
+    heights = np.array([cell.height for cell in cells], dtype=float)
+    box_widths = np.ceil(np.abs(widths * cos) + np.abs(heights * sin)).astype(int)
+    box_heights = np.ceil(np.abs(widths * sin) + np.abs(heights * cos)).astype(int)
+    lefts = np.rint(anchor_x - box_widths / 2).astype(int)
+    tops = np.rint(anchor_y - box_heights).astype(int)
+
+    # Inverse affine transforms from each rotated box back to its glyph cell
+    offsets_x = widths / 2 - box_widths / 2 * cos + box_heights / 2 * sin
+    offsets_y = heights / 2 - box_widths / 2 * sin - box_heights / 2 * cos
+    transforms = np.stack([cos, -sin, offsets_x, sin, cos, offsets_y], axis=1)
+
+    # Grow the drawing area to fit every glyph
+    min_x, min_y = min(0, lefts.min()), min(0, tops.min())
+    max_x = max(int(area_width), (lefts + box_widths).max())
+    max_y = max(int(area_height), (tops + box_heights).max())
+    image = Image.new('RGBA', (max_x - min_x, max_y - min_y), atlas.color + (0,))
+
+    for char, cell, box_width, box_height, left, top, transform in zip(text, cells, box_widths, box_heights, lefts, tops, transforms):
+        if char.isspace():
+            continue
+        rotated = cell.transform((int(box_width), int(box_height)), Image.Transform.AFFINE, tuple(transform), Image.Resampling.BICUBIC)
+        image.alpha_composite(rotated, (int(left - min_x), int(top - min_y)))
+    return image
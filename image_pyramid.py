@@ -0,0 +1,172 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from tracing import TRACER
+
+
+PYRAMID_PATH = 'img/token/pyramid'
+# Levels written next to the images of each generated folder, as (width in pixels, mode): the size of the images in
+# the printable PDFs (85 and 55 points at 300 dpi), flattened like save_tokens_to_pdf embeds them, and a thumbnail
+PYRAMID_LEVELS = {
+    'generated_tokens': [(354, 'RGB'), (64, 'RGBA')],
+    'generated_reminders': [(229, 'RGB'), (64, 'RGBA')],
+}
+PYRAMID_FORMATS = {'png': '.png', 'webp': '.webp'}
+DEFAULT_PYRAMID_FORMAT = 'png'
+# zlib level of the PNGs, from 0 (fastest) to 9 (smallest). Pillow's default 6 keeps the files as small as they
+# were; 1 encodes about twice as fast, for files a few percent bigger (--compress-level 1)
+DEFAULT_COMPRESS_LEVEL = 6
+# Threads encoding the levels of an image while the full resolution image is saved: Pillow releases the GIL while
+# resizing and encoding
+ENCODE_THREADS = 4
+
+encode_executor = None
+
+
+def level_path(source_path, width, image_format=DEFAULT_PYRAMID_FORMAT, pyramid_path=PYRAMID_PATH):
+    """
+    Returns the path of a level of an image, e.g. img/token/pyramid/generated_tokens/354/imp.png for
+    img/token/generated_tokens/imp.png.
+    """
+    folder = os.path.basename(os.path.dirname(os.path.abspath(source_path)))
+    name = os.path.splitext(os.path.basename(source_path))[0] + PYRAMID_FORMATS[image_format]
+    return os.path.join(pyramid_path, folder, str(width), name)
+
+
+def save_image(image, path, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Saves an image as a PNG with the given zlib level, or as a lossless WebP, after the extension of path.
+    """
+    if path.endswith('.webp'):
+        image.save(path, 'WEBP', lossless=True)
+    else:
+        image.save(path, 'PNG', compress_level=compress_level)
+
+
+def write_level(image, path, width, mode, compress_level=DEFAULT_COMPRESS_LEVEL):
+    # Converted first, then resized, like save_tokens_to_pdf does with the full resolution image
+    level = image if image.mode == mode else image.convert(mode)
+    height = max(1, round(image.height * width / image.width))
+    if level.size != (width, height):
+        level = level.resize((width, height), Image.Resampling.LANCZOS)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_image(level, path, compress_level)
+    return os.path.getsize(path)
+
+
+def image_levels(output_path):
+    """
+    Returns the (width, mode) levels of PYRAMID_LEVELS of an image, after its folder.
+    """
+    return PYRAMID_LEVELS.get(os.path.basename(os.path.dirname(os.path.abspath(output_path))), [])
+
+
+def encoding_settings(encoding=None):
+    """
+    Returns the keyword arguments of save_pyramid in encoding completed with their defaults, as recorded in build keys.
+    """
+    return {'pyramid': True, 'image_format': DEFAULT_PYRAMID_FORMAT, 'compress_level': DEFAULT_COMPRESS_LEVEL,
+            **(encoding or {})}
+
+
+def submit_levels(image, output_path, image_format=DEFAULT_PYRAMID_FORMAT, compress_level=DEFAULT_COMPRESS_LEVEL,
+                  pyramid_path=PYRAMID_PATH):
+    """
+    Starts encoding the levels of an image on the encode threads. Returns their (path, future) pairs for stamp_levels.
+    """
+    global encode_executor
+    futures = []
+    for width, mode in image_levels(output_path):
+        encode_executor = encode_executor or ThreadPoolExecutor(max_workers=ENCODE_THREADS, thread_name_prefix='pyramid')
+        path = level_path(output_path, width, image_format, pyramid_path)
+        futures.append((path, encode_executor.submit(write_level, image, path, width, mode, compress_level)))
+    return futures
+
+
+def stamp_levels(output_path, futures):
+    """
+    Waits for the levels of submit_levels, and stamps them with the modification time of the full resolution image.
+    """
+    if not futures:
+        return
+    with TRACER.span('pyramid_encode', path=output_path, levels=len(futures)) as span:
+        span.set(bytes=sum(future.result() for _, future in futures))
+    stat = os.stat(output_path)
+    for path, _ in futures:
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def save_pyramid(image, output_path, pyramid=True, image_format=DEFAULT_PYRAMID_FORMAT, compress_level=DEFAULT_COMPRESS_LEVEL,
+                 pyramid_path=PYRAMID_PATH):
+    """
+    Saves the full resolution image to output_path as a PNG, and writes the levels of PYRAMID_LEVELS for its folder,
+    in one pass: each level is resized from the image in memory, and encoded on a thread while the next ones are.
+
+    Levels are stamped with the modification time of the full resolution image, so nearest_level() ignores them
+    once the image is written again without them.
+
+    Args:
+    - image (PIL.Image.Image): The full resolution image.
+    - output_path (str): The path of the full resolution image.
+    - pyramid (bool): Whether the levels are written, or only the full resolution image.
+    - image_format (str): The format of the levels, a key of PYRAMID_FORMATS. WebP levels are lossless.
+    - compress_level (int): The zlib level of the PNGs, from 0 (fastest) to 9 (smallest).
+    """
+    futures = submit_levels(image, output_path, image_format, compress_level, pyramid_path) if pyramid else []
+    with TRACER.span('png_encode', path=output_path) as span:
+        save_image(image, output_path, compress_level)
+        span.set(bytes=os.path.getsize(output_path))
+    stamp_levels(output_path, futures)
+
+
+def levels_fresh(output_path, pyramid=True, image_format=DEFAULT_PYRAMID_FORMAT, compress_level=DEFAULT_COMPRESS_LEVEL,
+                 pyramid_path=PYRAMID_PATH):
+    """
+    Returns True if every level of the image saved at output_path is written in image_format from its current
+    version, or if the pyramid is off. Takes the keyword arguments of save_pyramid.
+    """
+    if not pyramid:
+        return True
+    try:
+        source_mtime = os.stat(output_path).st_mtime_ns
+        return all(os.stat(level_path(output_path, width, image_format, pyramid_path)).st_mtime_ns == source_mtime
+                   for width, _ in image_levels(output_path))
+    except OSError:
+        return False
+
+
+def rebuild_pyramid(output_path, pyramid=True, image_format=DEFAULT_PYRAMID_FORMAT, compress_level=DEFAULT_COMPRESS_LEVEL,
+                    pyramid_path=PYRAMID_PATH):
+    """
+    Writes the levels of an image already saved at output_path, e.g. when its pyramid was deleted, without
+    rendering it again. Takes the keyword arguments of save_pyramid.
+    """
+    if not pyramid:
+        return
+    with Image.open(output_path) as image:
+        image.load()
+        stamp_levels(output_path, submit_levels(image, output_path, image_format, compress_level, pyramid_path))
+
+
+def nearest_level(source_path, width, pyramid_path=PYRAMID_PATH):
+    """
+    Returns the path of the smallest level of an image at least width pixels wide, or source_path if it has none,
+    or if its levels were made from a previous version of it.
+    """
+    folder = os.path.join(pyramid_path, os.path.basename(os.path.dirname(os.path.abspath(source_path))))
+    try:
+        widths = sorted(int(name) for name in os.listdir(folder) if name.isdigit())
+        source_mtime = os.stat(source_path).st_mtime_ns
+    except OSError:
+        return source_path
+    for level_width in widths:
+        if level_width < width:
+            continue
+        for image_format in PYRAMID_FORMATS:
+            path = level_path(source_path, level_width, image_format, pyramid_path)
+            try:
+                if os.stat(path).st_mtime_ns == source_mtime:
+                    return path
+            except OSError:
+                pass
+    return source_path
@@ -0,0 +1,71 @@
+import os
+import functools
+from collections import OrderedDict
+from PIL import Image, ImageDraw
+from tracing import TRACER
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class LayerCache:
+    """
+    LRU cache of decoded RGBA layers, already resized to the size they are composited at.
+
+    Layers are keyed by (path, mtime, target size) so an edited file is reloaded. The cache is bounded by
+    the memory of the decoded pixels; the least recently used layers are dropped first.
+    Cached images are shared: callers must not modify them in place.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.layers = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, size=None):
+        """
+        Returns the RGBA layer of an image file, LANCZOS-resized to size if given.
+        """
+        key = (path, os.stat(path).st_mtime_ns, size)
+        layer = self.layers.get(key)
+        if layer is not None:
+            self.layers.move_to_end(key)
+            self.hits += 1
+            return layer
+
+        self.misses += 1
+        with TRACER.span('layer_load', path=path, bytes=os.path.getsize(path)):
+            with Image.open(path) as img:
+                layer = img.convert('RGBA')
+            if size is not None and layer.size != size:
+                layer = layer.resize(size, Image.Resampling.LANCZOS)
+        self.layers[key] = layer
+        self.bytes += layer.width * layer.height * 4
+        while self.bytes > self.max_bytes and len(self.layers) > 1:
+            _, dropped = self.layers.popitem(last=False)
+            self.bytes -= dropped.width * dropped.height * 4
+        return layer
+
+    def clear(self):
+        self.layers.clear()
+        self.bytes = 0
+
+
+@functools.lru_cache(maxsize=16)
+def circular_mask(size):
+    """
+    Returns the 'L' mask of the ellipse filling an image of the given size. Shared: do not modify it.
+    """
+    mask = Image.new('L', size, 0)
+    ImageDraw.Draw(mask).ellipse((0, 0) + size, fill=255)
+    return mask
+
+
+@functools.lru_cache(maxsize=16)
+def solid_color(size, color):
+    """
+    Returns an RGBA image of a single color. Shared: do not modify it.
+    """
+    return Image.new('RGBA', size, color)
@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import argparse
+import importlib
+from build_cache import BuildManifest
+from character_db import CHARACTERS_JSON_PATH, NIGHT_ORDER_JSON_PATH, SCRIPTS_PATH, load_character_database
+from tracing import TRACER, add_tracing_arguments, print_trace_summary
+
+
+PIPELINE_MANIFEST_PATH = 'img/token/pipeline_manifest.json'
+# Paths of the stages, repeated here rather than imported so a stage module is only imported when the stage runs
+SCRAPED_IMAGES_PATH = 'img/token/scraped_images'
+GENERATED_TOKENS_PATH = 'img/token/generated_tokens'
+GENERATED_REMINDERS_PATH = 'img/token/generated_reminders'
+PYRAMID_PATH = 'img/token/pyramid'
+TOKENS_PDF_PATH = 'output_prints/tokens_printable.pdf'
+REMINDERS_PDF_PATH = 'output_prints/reminders_printable.pdf'
+NIGHT_SHEETS_OUTPUT_PATH = 'output_prints/night_order_sheets'
+ATLAS_OUTPUT_PATH = 'output_prints/atlas'
+
+
+class Stage:
+    """
+    A step of the pipeline: the module implementing it, imported only when the stage runs, the files and folders
+    it reads and writes (a folder stands for every file in it), and the options changing its outputs.
+
+    A stage depends on the stages writing one of its inputs. It is stale when the content of its inputs or of
+    its outputs changed since it last ran, or when one of its options did. A stage reading remote inputs, which
+    cannot be hashed, is always_stale: it runs every time, and the stages depending on it only run if it changed
+    their inputs.
+    """
+
+    def __init__(self, name, module, run, inputs, outputs, params=None, always_stale=False):
+        self.name = name
+        self.module = module
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params or (lambda args: {})
+        self.always_stale = always_stale
+
+    def depends_on(self, other):
+        return any(path == output or path.startswith(output + os.sep) for path in self.inputs for output in other.outputs)
+
+
+def run_fetch(module, database, args, force):
+    module.fetch_character_icons(database, base_url=args.base_url or module.BOTC_WIKI_BASE_URL)
+
+
+def run_tokens(module, database, args, force):
+    backend = args.backend or module.DEFAULT_ROLE_NAME_BACKEND
+    rendered, failed = module.build_tokens(database, force=force, jobs=args.jobs, backend=backend)
+    print(f"{rendered} files rendered, the others were up to date.")
+    if failed:
+        raise RuntimeError(f"{failed} tokens and reminders could not be rendered")
+
+
+def run_pdf(module, database, args, force):
+    failed = module.print_pdfs()
+    if failed:
+        raise RuntimeError(f"These PDFs could not be written: {', '.join(failed)}")
+
+
+def run_atlas(module, database, args, force):
+    written, pages = module.export_atlas(database, force=force)
+    print(f"{written} of {pages} atlas pages written, the others were up to date.")
+
+
+def run_night_sheets(module, database, args, force):
+    script_names = sorted(module.list_files_in_directory(SCRIPTS_PATH))
+    options = {'scripts_dir': SCRIPTS_PATH, 'output_dir': NIGHT_SHEETS_OUTPUT_PATH, 'backend': 'raster', 'dpi': module.NIGHT_SHEET_DPI}
+    generated = module.generate_all_night_sheets(script_names, database, options, jobs=args.jobs, force=force)
+    if generated < len(script_names):
+        raise RuntimeError(f"{len(script_names) - generated} of {len(script_names)} night sheets could not be generated")
+
+
+STAGES = [
+    # The icons on the wiki can change at any time: they are revalidated on every run, mostly with 304 responses
+    Stage('fetch', 'get_assets_from_wiki', run_fetch,
+          inputs=['characters.txt', 'get_assets_from_wiki.py'],
+          outputs=[SCRAPED_IMAGES_PATH],
+          params=lambda args: {'base_url': args.base_url},
+          always_stale=True),
+    Stage('tokens', 'generate_tokens_and_reminders', run_tokens,
+          inputs=[CHARACTERS_JSON_PATH, SCRAPED_IMAGES_PATH, 'img/token_bg', 'img/token/leaves', 'img/components',
+                  'generate_tokens_and_reminders.py', 'arc_text.py', 'glyph_atlas.py', 'font_fitting.py', 'layer_cache.py', 'image_pyramid.py',
+                  'character_db.py', 'build_cache.py', 'tracing.py'],
+          outputs=[GENERATED_TOKENS_PATH, GENERATED_REMINDERS_PATH, PYRAMID_PATH],
+          params=lambda args: {'backend': args.backend}),
+    Stage('pdf', 'save_tokens_to_pdf', run_pdf,
+          inputs=[CHARACTERS_JSON_PATH, GENERATED_TOKENS_PATH, GENERATED_REMINDERS_PATH, PYRAMID_PATH, 'save_tokens_to_pdf.py', 'image_pyramid.py'],
+          outputs=[TOKENS_PDF_PATH, REMINDERS_PDF_PATH]),
+    Stage('atlas', 'export_atlas', run_atlas,
+          inputs=[CHARACTERS_JSON_PATH, GENERATED_TOKENS_PATH, GENERATED_REMINDERS_PATH, 'export_atlas.py'],
+          outputs=[os.path.join(ATLAS_OUTPUT_PATH, 'all')]),
+    Stage('night_sheets', 'generate_night_order_sheet', run_night_sheets,
+          inputs=[CHARACTERS_JSON_PATH, NIGHT_ORDER_JSON_PATH, SCRIPTS_PATH, SCRAPED_IMAGES_PATH, 'img/components',
+                  'generate_night_order_sheet.py'],
+          outputs=[NIGHT_SHEETS_OUTPUT_PATH]),
+]
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+def expand_paths(paths):
+    """
+    Returns the files of a list of files and folders, the folders being walked recursively.
+    Missing files are kept: they are hashed as missing.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in os.walk(path):
+                files.extend(os.path.join(folder, name) for name in names
+                             if name != '.DS_Store' and not name.endswith(('.tmp', '.part')))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def select_stages(targets):
+    """
+    Returns the target stages and every stage they depend on, in the order of STAGES.
+    """
+    selected = set(targets or STAGES_BY_NAME)
+    for stage in reversed(STAGES):
+        if stage.name in selected:
+            selected.update(other.name for other in STAGES if other is not stage and stage.depends_on(other))
+    return [stage for stage in STAGES if stage.name in selected]
+
+
+def stage_state(manifest, stage, args):
+    """
+    Returns the keys of the inputs (with the options) and of the outputs of a stage, as recorded once it ran.
+    """
+    input_key = manifest.build_key(expand_paths(stage.inputs), {'stage': stage.name, **stage.params(args)})
+    output_key = manifest.build_key(expand_paths(stage.outputs), {})
+    return {'inputs': input_key, 'outputs': output_key}
+
+
+def run_pipeline(stages, args, forced=(), dry_run=False, manifest_path=PIPELINE_MANIFEST_PATH):
+    """
+    Runs the stale stages in order, in this process: the character database is loaded once for all of them, and
+    the module of a stage is only imported if it runs. A failed stage stops the stages depending on it.
+    Returns a report row per stage: its status and the seconds spent checking, importing and running it.
+    """
+    manifest = BuildManifest(manifest_path)
+    start_time = time.perf_counter()
+    database = load_character_database()
+    print(f"Character database loaded in {time.perf_counter() - start_time:.2f} s")
+
+    report = []
+    blocked = []
+    ran = []
+    for stage in stages:
+        row = {'stage': stage.name, 'status': 'up to date', 'check_s': 0.0, 'import_s': None, 'run_s': None}
+        report.append(row)
+        if any(stage.depends_on(other) for other in blocked):
+            row['status'] = 'skipped'
+            blocked.append(stage)
+            continue
+
+        check_start = time.perf_counter()
+        manifest.refresh()
+        state = stage_state(manifest, stage, args)
+        stale = stage.always_stale or stage.name in forced or manifest.outputs.get(f'stage:{stage.name}') != state
+        row['check_s'] = time.perf_counter() - check_start
+        if dry_run:
+            # The outputs of the stages before it would change: it would be checked again. The outputs of an
+            # always_stale stage most often do not, the stages after it are listed as their current outputs say
+            if stale or any(stage.depends_on(other) for other in ran):
+                row['status'] = 'stale'
+                if not stage.always_stale:
+                    ran.append(stage)
+            continue
+        if not stale:
+            continue
+
+        print(f"Running {stage.name}...")
+        try:
+            import_start = time.perf_counter()
+            module = importlib.import_module(stage.module)
+            row['import_s'] = time.perf_counter() - import_start
+            run_start = time.perf_counter()
+            with TRACER.profile(stage.name):
+                stage.run(module, database, args, stage.name in forced)
+            row['run_s'] = time.perf_counter() - run_start
+        except Exception as e:
+            print(f"An error occurred while running {stage.name}: {e}")
+            row['status'] = 'failed'
+            blocked.append(stage)
+            continue
+
+        row['status'] = 'ran'
+        ran.append(stage)
+        manifest.refresh()
+        manifest.record(f'stage:{stage.name}', {'inputs': state['inputs'], 'outputs': stage_state(manifest, stage, args)['outputs']})
+        manifest.save()
+    if not dry_run:
+        manifest.save()
+    return report
+
+
+def print_report(report):
+    def seconds(value):
+        return f'{value:.2f}' if value is not None else '-'
+
+    print(f"{'stage':<14}{'status':<12}{'check s':>9}{'import s':>10}{'run s':>9}")
+    for row in report:
+        print(f"{row['stage']:<14}{row['status']:<12}{seconds(row['check_s']):>9}{seconds(row['import_s']):>10}{seconds(row['run_s']):>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the stale stages of the pipeline: fetch -> tokens -> pdf and atlas, and night_sheets.')
+    parser.add_argument('stages', nargs='*',
+                        help=f"Stages to bring up to date ({', '.join(STAGES_BY_NAME)}), with the stages they depend on. Default: every stage.")
+    parser.add_argument('--force', nargs='+', choices=['all'] + list(STAGES_BY_NAME), default=[],
+                        help='Run these stages even if they are up to date (tokens are then all rendered again).')
+    parser.add_argument('--skip', nargs='+', choices=list(STAGES_BY_NAME), default=[],
+                        help='Do not run these stages, e.g. fetch when offline: the stages depending on them use their current outputs.')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the stages that would run.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes rendering tokens and night sheets in parallel.')
+    parser.add_argument('--backend', choices=['wand', 'numpy'], default=None,
+                        help='How role names are curved (default: wand if ImageMagick is installed, numpy otherwise).')
+    parser.add_argument('--base-url', default=None, help='Base URL of the wiki the icons are fetched from (default: the official wiki).')
+    add_tracing_arguments(parser)
+    args = parser.parse_args()
+    unknown_stages = [name for name in args.stages if name not in STAGES_BY_NAME]
+    if unknown_stages:
+        parser.error(f"unknown stages: {', '.join(unknown_stages)}")
+    TRACER.configure(args.trace, args.profile, reset=True)
+
+    forced = list(STAGES_BY_NAME) if 'all' in args.force else args.force
+    stages = [stage for stage in select_stages(args.stages + forced if args.stages else None) if stage.name not in args.skip]
+    report = run_pipeline(stages, args, forced=forced, dry_run=args.dry_run)
+    print_report(report)
+    if args.trace:
+        print_trace_summary(args.trace)
+    if any(row['status'] in ('failed', 'skipped') for row in report):
+        sys.exit(1)
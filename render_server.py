@@ -0,0 +1,322 @@
+import io
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from build_cache import content_key
+from character_db import CHARACTERS_JSON_PATH, NIGHT_ORDER_JSON_PATH, SCRIPTS_PATH, load_character_database
+import font_fitting
+import generate_tokens_and_reminders as tokens
+import generate_night_order_sheet as night_sheets
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_MB = 256
+# Number of latencies kept per route for the percentiles of /stats
+LATENCY_WINDOW = 1000
+# Resolutions a night sheet can be requested at
+MIN_NIGHT_SHEET_DPI = 72
+MAX_NIGHT_SHEET_DPI = 600
+
+CONTENT_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.pdf': 'application/pdf'}
+
+
+class PngCache:
+    """
+    LRU cache of encoded renders (PNG, JPEG or PDF bytes) keyed by the content of their inputs, bounded in bytes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.renders = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key):
+        data = self.renders.get(key)
+        if data is not None:
+            self.renders.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if key in self.renders:
+            self.bytes -= len(self.renders.pop(key))
+        self.renders[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes and len(self.renders) > 1:
+            _, dropped = self.renders.popitem(last=False)
+            self.bytes -= len(dropped)
+
+
+class LiveKeys:
+    """
+    Stand-in for the BuildManifest of the build keys: hashes the current content of the input files,
+    so a render is cached until one of its inputs changes on disk.
+    """
+
+    def build_key(self, input_paths, params):
+        return content_key(params, input_paths)
+
+
+class NotFound(Exception):
+    pass
+
+
+class RenderService:
+    """
+    Renders tokens, reminders and night sheets in memory, with every cache of the build kept warm between requests:
+    decoded layers, fonts and glyphs, curved texts, night sheet icons, the character database, and an LRU of the
+    encoded renders. Rendering is serialised, the caches are not thread safe; /stats is answered meanwhile.
+    """
+
+    def __init__(self, cache_bytes=DEFAULT_CACHE_MB * 1024 * 1024, backend=tokens.DEFAULT_ROLE_NAME_BACKEND):
+        self.backend = backend
+        self.cache = PngCache(cache_bytes)
+        self.keys = LiveKeys()
+        self.render_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.routes = {}
+        self.started = time.time()
+
+    def warm_up(self):
+        """
+        Loads the character database and decodes the backgrounds and leaves shared by every token and reminder.
+        """
+        load_character_database()
+        token_size = tokens.open_layer(tokens.TOKEN_BACKGROUND_PATH).size
+        reminder_size = tokens.open_layer(tokens.REMINDER_BACKGROUND_PATH).size
+        leaves_path = os.path.join(tokens.IMG_TOKEN_PATH, 'leaves')
+        for leaf in sorted(os.listdir(leaves_path)):
+            tokens.open_layer(os.path.join(leaves_path, leaf), token_size)
+        tokens.open_layer('img/token_bg/clockface-2-very_white.png', reminder_size)
+
+    def character(self, character_id):
+        character = load_character_database().get(character_id)
+        if character is None:
+            raise NotFound(f"Unknown character '{character_id}'")
+        if not os.path.exists(os.path.join(tokens.SCRAPED_IMAGES_PATH, f"{character.id}.png")):
+            raise NotFound(f"No scraped icon for '{character.id}'")
+        return character
+
+    def token(self, character_id, backend=None):
+        character = self.character(character_id)
+        backend = backend or self.backend
+        if backend not in tokens.ROLE_NAME_BACKENDS or (backend == 'wand' and tokens.wandImage is None):
+            raise ValueError(f"Role name backend '{backend}' is not available")
+        key = tokens.token_build_key(self.keys, character.entry, backend)
+        return key, lambda: png_bytes(tokens.compose_token(character.entry, backend))
+
+    def reminder(self, character_id, reminder):
+        character = self.character(character_id)
+        if reminder not in character.reminders:
+            raise NotFound(f"'{character.id}' has no reminder '{reminder}'")
+        key = tokens.reminder_build_key(self.keys, character.entry, reminder)
+        return key, lambda: png_bytes(tokens.compose_reminder(character.entry, reminder))
+
+    def night_sheet(self, script, backend='raster', dpi=night_sheets.NIGHT_SHEET_DPI):
+        # Only the scripts of SCRIPTS_PATH are served, by name
+        if not script or '/' in script or '\\' in script or '..' in script:
+            raise ValueError(f"Invalid script name '{script}'")
+        input_script_json = os.path.join(SCRIPTS_PATH, f'{script}.json')
+        if not os.path.exists(input_script_json):
+            raise NotFound(f"Unknown script '{script}'")
+        first_night_sheet, other_night_sheet = night_sheets.script_night_sheets(input_script_json, load_character_database())
+        image_locations = [row['image_location'] for sheet in (first_night_sheet, other_night_sheet) for row in sheet.values()]
+        params = {'night_sheet': script, 'backend': backend, 'dpi': dpi}
+        key = content_key(params, [input_script_json, CHARACTERS_JSON_PATH, NIGHT_ORDER_JSON_PATH, night_sheets.__file__] + image_locations)
+
+        def render():
+            output = io.BytesIO()
+            title = os.path.splitext(os.path.basename(input_script_json))[0]
+            night_sheets.write_night_sheets(first_night_sheet, other_night_sheet, output, title, backend=backend, dpi=dpi)
+            return output.getvalue()
+        return key, render
+
+    def get(self, route, key_and_render):
+        """
+        Returns the render of a request and whether it came from the cache, rendering it on a miss.
+        key_and_render is a function returning the cache key of the render and a function rendering it.
+        """
+        start_time = time.perf_counter()
+        with self.render_lock:
+            key, render = key_and_render()
+            data = self.cache.get(key)
+            hit = data is not None
+            if not hit:
+                data = render()
+                if data is None:
+                    raise RuntimeError(f"Rendering {route} failed")
+                self.cache.put(key, data)
+        self.record(route, hit, time.perf_counter() - start_time)
+        return data, hit
+
+    def record(self, route, hit, seconds):
+        with self.stats_lock:
+            stats = self.routes.setdefault(route, {'requests': 0, 'hits': 0, 'latencies': deque(maxlen=LATENCY_WINDOW)})
+            stats['requests'] += 1
+            stats['hits'] += hit
+            stats['latencies'].append(seconds)
+
+    def stats(self):
+        """
+        Returns the hit rates and the latencies (in ms, over the last LATENCY_WINDOW requests) of every route,
+        and the state of the underlying caches.
+        """
+        with self.stats_lock:
+            routes = {}
+            for route, stats in self.routes.items():
+                latencies = sorted(stats['latencies'])
+                routes[route] = {
+                    'requests': stats['requests'],
+                    'hits': stats['hits'],
+                    'hit_rate': round(stats['hits'] / stats['requests'], 4),
+                    'latency_ms': {
+                        'mean': round(1000 * sum(latencies) / len(latencies), 3),
+                        'p50': round(1000 * percentile(latencies, 0.5), 3),
+                        'p95': round(1000 * percentile(latencies, 0.95), 3),
+                        'max': round(1000 * latencies[-1], 3),
+                    },
+                }
+        return {
+            'uptime_s': round(time.time() - self.started, 1),
+            'routes': routes,
+            'render_cache': {'entries': len(self.cache.renders), 'bytes': self.cache.bytes, 'max_bytes': self.cache.max_bytes},
+            'layer_cache': {'hits': tokens.LAYER_CACHE.hits, 'misses': tokens.LAYER_CACHE.misses, 'bytes': tokens.LAYER_CACHE.bytes},
+            'curved_text_store': {'hits': tokens.CURVED_TEXT_STORE.hits, 'renders': tokens.CURVED_TEXT_STORE.renders,
+                                  'evictions': tokens.CURVED_TEXT_STORE.evictions},
+            'night_sheet_icons': {'hits': night_sheets.ICON_CACHE.hits, 'misses': night_sheets.ICON_CACHE.misses},
+            'font_metrics': dict(font_fitting.stats),
+        }
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def png_bytes(image):
+    if image is None:
+        return None
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /token/<id>.png[?backend=numpy|wand]
+    GET /reminder/<id>/<reminder>.png
+    GET /night-sheet/<script>.jpg|.pdf[?dpi=300] (a script of SCRIPTS_PATH, at 72 to 600 dpi)
+    GET /characters
+    GET /stats
+
+    Renders are answered with an X-Cache (hit or miss) and an X-Render-Time-Ms header.
+    """
+
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if parts == ['stats']:
+                return self.send_json(self.service.stats())
+            if parts == ['characters']:
+                database = load_character_database()
+                return self.send_json([{'id': character.id, 'name': character.name, 'reminders': list(character.reminders)} for character in database.characters])
+
+            name, extension = os.path.splitext(parts[-1])
+            if parts[0] == 'token' and len(parts) == 2 and extension == '.png':
+                route, key_and_render = 'token', lambda: self.service.token(name, query.get('backend'))
+            elif parts[0] == 'reminder' and len(parts) == 3 and extension == '.png':
+                route, key_and_render = 'reminder', lambda: self.service.reminder(parts[1], name)
+            elif parts[0] == 'night-sheet' and len(parts) == 2 and extension in ('.jpg', '.pdf'):
+                backend = 'raster' if extension == '.jpg' else 'pdf'
+                dpi = min(MAX_NIGHT_SHEET_DPI, max(MIN_NIGHT_SHEET_DPI, int(query.get('dpi', night_sheets.NIGHT_SHEET_DPI))))
+                route, key_and_render = 'night-sheet', lambda: self.service.night_sheet(name, backend, dpi)
+            else:
+                raise NotFound(f"Unknown path '{url.path}'")
+
+            start_time = time.perf_counter()
+            data, hit = self.service.get(route, key_and_render)
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPES[extension])
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('X-Cache', 'hit' if hit else 'miss')
+            self.send_header('X-Render-Time-Ms', f'{1000 * (time.perf_counter() - start_time):.3f}')
+            self.end_headers()
+            self.wfile.write(data)
+        except NotFound as e:
+            self.send_json({'error': str(e)}, status=404)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, status=400)
+        except Exception as e:
+            self.send_json({'error': f'{type(e).__name__}: {e}'}, status=500)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, indent=1).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def create_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+    """
+    Returns an HTTP server for the service, listening on host:port or on a Unix socket.
+    """
+    handler = type('BoundRenderRequestHandler', (RenderRequestHandler,), {'service': service})
+    if unix_socket:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError('Unix sockets are not supported on this platform')
+        return UnixHTTPServer(unix_socket, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve tokens, reminders and night sheets from a process with warm caches.')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='Address to listen on (local only by default).')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on.')
+    parser.add_argument('--unix-socket', help='Listen on this Unix socket instead of a TCP port.')
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_CACHE_MB, help='Size of the LRU cache of rendered files, in MB.')
+    parser.add_argument('--backend', choices=tokens.ROLE_NAME_BACKENDS, default=tokens.DEFAULT_ROLE_NAME_BACKEND,
+                        help='Default backend curving the role names.')
+    args = parser.parse_args()
+
+    service = RenderService(cache_bytes=args.cache_mb * 1024 * 1024, backend=args.backend)
+    start_time = time.perf_counter()
+    service.warm_up()
+    print(f"Caches warmed up in {time.perf_counter() - start_time:.2f} s")
+
+    server = create_server(service, args.host, args.port, args.unix_socket)
+    print(f"Serving on {args.unix_socket or f'http://{args.host}:{args.port}'} (GET /stats for hit rates and latencies)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        font_fitting.METRICS_CACHE.save()
@@ -1,8 +1,14 @@
 import os
+import argparse
+from reportlab import rl_config
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader
 from PIL import Image
+from image_pyramid import nearest_level
+from character_db import load_character_database, read_script_ids
+from tracing import TRACER, add_tracing_arguments, print_trace_summary
 
 IMG_TOKEN_PATH = 'img/token'
 output_tokens_pdf_path = 'output_prints/tokens_printable.pdf'
@@ -11,77 +17,287 @@ output_reminders_pdf_path = 'output_prints/reminders_printable.pdf'
 generated_tokens_folder_path = os.path.join(IMG_TOKEN_PATH, 'generated_tokens')
 generated_reminders_folder_path = os.path.join(IMG_TOKEN_PATH, 'generated_reminders')
 
-def images_to_pdf(folder_path, output_pdf_path, duplicates_tokens=False, image_new_size=1.0, side_margin=1.0, between_margin=0.5, background_color=None):
+# Resolution the images are embedded at, for their printed size
+PRINT_DPI = 300
+# Embed the images as binary streams: without reportlab's C accelerator, ASCII85 encoding them is most of the time
+# spent writing a PDF, and makes them a quarter bigger
+rl_config.useA85 = 0
+
+# Number of tokens printed for the characters that can be in play more than once
+TOKEN_COPIES = {'legion': 8, 'riot': 4, 'villageidiot': 3, 'imp': 2}
+
+# Layout of the printable PDFs: printed size of the images (points), margins (inches) and page background
+TOKENS_PDF_LAYOUT = {'image_new_size': 85, 'side_margin': 0.5, 'between_margin': 0.10, 'background_color': (86, 68, 46)}
+# 614 614 614 0.13 79
+REMINDERS_PDF_LAYOUT = {'image_new_size': 55, 'side_margin': 0.5, 'between_margin': 0.10, 'background_color': (45, 45, 45)}
+# 255 255 255 0.2 51
+
+def print_pixels(image_new_size, dpi=PRINT_DPI):
+    return max(1, round(image_new_size / 72 * dpi))
+
+def load_print_image(image, image_new_size, dpi=PRINT_DPI):
+    """
+    Load an image (a path or a PIL image) downsampled to the given dpi at its printed size (image_new_size points), for reportlab.
+    Transparency is dropped like reportlab did for inline images: the transparent corners keep their mask color.
+    """
+    pixels = print_pixels(image_new_size, dpi)
+    if isinstance(image, Image.Image):
+        img = image.convert('RGB')
+    else:
+        with Image.open(image) as img:
+            img = img.convert('RGB')
+    if img.width > pixels or img.height > pixels:
+        img = img.resize((pixels, pixels), Image.Resampling.LANCZOS)
+    return ImageReader(img)
+
+def embed_image_once(c, name, image, image_new_size, dpi=PRINT_DPI):
+    """
+    Embed an image (a path or a PIL image) in the PDF as a form XObject named after name, its file name, the first
+    time only. Returns the name of the form, that every placement of the image references.
+    A path is read from the smallest level of its resolution pyramid that is big enough, when there is one.
+    """
+    form_name = 'img_' + os.path.splitext(os.path.basename(name))[0].replace(' ', '_')
+    if not c.hasForm(form_name):
+        if isinstance(image, str):
+            image = nearest_level(image, print_pixels(image_new_size, dpi))
+        size = os.path.getsize(image) if isinstance(image, str) else image.width * image.height * len(image.getbands())
+        with TRACER.span('pdf_embed', item=name, bytes=size):
+            c.beginForm(form_name, lowerx=0, lowery=0, upperx=image_new_size, uppery=image_new_size)
+            c.drawImage(load_print_image(image, image_new_size, dpi), 0, 0, width=image_new_size, height=image_new_size)
+            c.endForm()
+    return form_name
+
+class PdfSheetWriter:
+    """
+    Places images on the A4 pages of a printable PDF, as many as fit on a page, in the order they are added.
+
+    Each image is embedded once, downsampled to dpi, as soon as it is added, and each page is drawn as soon as it
+    is full: images can be added while the next ones are still being rendered, and do not have to stay in memory.
+
+    Args:
+    - output_pdf_path (str): Path for the output PDF file.
+    - image_new_size (float): Printed width and height of the images, in points.
+    - side_margin (float): Margin on the sides of the page in inches. Default is 1.0 inch.
+    - between_margin (float): Margin between images in inches. Default is 0.5 inch.
+    - background_color (tuple): Background color in RGB format. Default is None (white).
+    - dpi (int): Resolution of the embedded images at their printed size.
+    """
+
+    def __init__(self, output_pdf_path, image_new_size=1.0, side_margin=1.0, between_margin=0.5, background_color=None, dpi=PRINT_DPI):
+        self.output_pdf_path = output_pdf_path
+        self.image_new_size = image_new_size
+        self.page_width, self.page_height = A4
+        self.side_margin = side_margin * inch  # Convert margin to points
+        self.between_margin = between_margin * inch  # Convert margin to points
+        self.background_color = background_color
+        self.dpi = dpi
+        self.canvas = canvas.Canvas(output_pdf_path, pagesize=A4)
+        self.x_offset, self.y_offset = self.side_margin, self.page_height - self.side_margin  # Initialize offsets
+        # (image name, form name, x, y) of the images of the page being filled
+        self.placements = []
+        self.pages_drawn = 0
+
+    def set_background(self):
+        if self.background_color:
+            c = self.canvas
+            c.setFillColorRGB(self.background_color[0]/255.0, self.background_color[1]/255.0, self.background_color[2]/255.0)
+            c.rect(0, 0, self.page_width, self.page_height, stroke=0, fill=1)
+
+    def add(self, name, image, count=1):
+        """
+        Places count copies of an image, a path or a PIL image, named after its file name.
+        """
+        form_name = embed_image_once(self.canvas, name, image, self.image_new_size, self.dpi)
+        for i in range(count):
+            print("placing: "+ name)
+            # Calculate position for the next image
+            if self.x_offset + self.image_new_size > self.page_width - self.side_margin:
+                self.x_offset = self.side_margin
+                self.y_offset -= self.image_new_size + self.between_margin
+
+            if self.y_offset - self.image_new_size < self.side_margin:
+                self.draw_page()  # Start a new page
+                self.y_offset = self.page_height - self.side_margin
+
+            self.placements.append((name, form_name, self.x_offset, self.y_offset - self.image_new_size))
+            self.x_offset += self.image_new_size + self.between_margin
+
+    def draw_page(self):
+        c = self.canvas
+        if self.pages_drawn:
+            c.showPage()
+        self.pages_drawn += 1
+        self.set_background()  # Set background color for the page
+        with TRACER.span('pdf_page', item=f'{os.path.basename(self.output_pdf_path)} page {self.pages_drawn}', images=len(self.placements)):
+            for name, form_name, x, y in self.placements:
+                with TRACER.span('pdf_place', image=name):
+                    c.saveState()
+                    c.translate(x, y)
+                    c.doForm(form_name)
+                    c.restoreState()
+        self.placements = []
+
+    def close(self):
+        """
+        Draws the last page and writes the PDF.
+        """
+        self.draw_page()
+        with TRACER.span('pdf_save', item=os.path.basename(self.output_pdf_path)) as span:
+            self.canvas.save()
+            span.set(bytes=os.path.getsize(self.output_pdf_path))
+
+def image_copies(image_names, duplicates_tokens=False):
+    """
+    Returns the number of copies to print of each image file name, sorted by name: one, or more for the tokens of
+    the characters that can be in play more than once with duplicates_tokens.
+    """
+    images_dict = {name: 1 for name in image_names}
+    if duplicates_tokens:
+        database = load_character_database()
+        for image in images_dict:
+            character = database.get(os.path.splitext(image)[0])
+            if character is not None and character.id in TOKEN_COPIES:
+                images_dict[image] = TOKEN_COPIES[character.id]
+    return {key: images_dict[key] for key in sorted(images_dict)}
+
+def images_to_pdf(folder_path, output_pdf_path, duplicates_tokens=False, image_new_size=1.0, side_margin=1.0, between_margin=0.5, background_color=None, dpi=PRINT_DPI, image_names=None):
     """
     Convert images in a folder to a single PDF, fitting as many images on a page as possible.
+    Each image is embedded once, downsampled to dpi, however many times it is placed.
     
     Args:
     - folder_path (str): Path to the folder containing images.
     - output_pdf_path (str): Path for the output PDF file.
-    - scale_factor (float): Factor to scale the images by. Default is 1.0 (no scaling).
+    - image_new_size (float): Printed width and height of the images, in points.
     - side_margin (float): Margin on the sides of the page in inches. Default is 1.0 inch.
     - between_margin (float): Margin between images in inches. Default is 0.5 inch.
     - background_color (tuple): Background color in RGB format. Default is None (white).
+    - dpi (int): Resolution of the embedded images at their printed size.
+    - image_names (iterable): Only place these files of the folder. Default is None (every image).
+
+    Returns:
+    - bool: True if the PDF was written.
     """
     try:
-        # Constants for A4 page size and conversions
-        page_width, page_height = A4
-        side_margin = side_margin * inch  # Convert margin to points
-        between_margin = between_margin * inch  # Convert margin to points
-        
-        # Initialize PDF
-        c = canvas.Canvas(output_pdf_path, pagesize=A4)
-        
-        def set_background():
-            if background_color:
-                c.setFillColorRGB(background_color[0]/255.0, background_color[1]/255.0, background_color[2]/255.0)
-                c.rect(0, 0, page_width, page_height, stroke=0, fill=1)
-        
-        set_background()  # Set background color for the first page
-        
+        writer = PdfSheetWriter(output_pdf_path, image_new_size, side_margin, between_margin, background_color, dpi)
+
         # Process images
-        images_dict = {f: 1 for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))}
-        # Only update values if the keys already exist in the dictionary
-        if duplicates_tokens:
-            for key, value in [('legion.png', 8), ('riot.png', 4), ('villageidiot.png', 3), ('imp.png', 2)]:
-                if key in images_dict:
-                    images_dict[key] = value
-        images_dict = {key: images_dict[key] for key in sorted(images_dict)}
-        
-        x_offset, y_offset = side_margin, page_height - side_margin  # Initialize offsets
-        
-        for image, count in images_dict.items():
-            for i in range(count):
-                img_path = os.path.join(folder_path, image)
-                print("placing: "+ image)
-                with Image.open(img_path) as img:
-                    # Scale image if needed
-                    # print(int(img.width),int(img.height),int(img.height),scale_factor, int(img.height*scale_factor))
-                    img = img.resize((image_new_size, image_new_size))
-
-
-                    # Calculate position for the next image
-                    if x_offset + img.width > page_width - side_margin:
-                        x_offset = side_margin
-                        y_offset -= img.height + between_margin
-
-                    if y_offset - img.height < side_margin:
-                        c.showPage()  # Start a new page
-                        y_offset = page_height - side_margin
-                        set_background()  # Set background color for the new page
-
-                    # Draw image
-                    c.drawInlineImage(img_path, x_offset, y_offset - img.height, width=img.width, height=img.height)
-                    x_offset += img.width + between_margin
-                
-        c.save()
+        folder_images = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+        if image_names is not None:
+            image_names = set(image_names)
+            folder_images = [f for f in folder_images if f in image_names]
+        # Print more copies of the tokens of the characters that can be in play more than once
+        for image, count in image_copies(folder_images, duplicates_tokens).items():
+            writer.add(image, os.path.join(folder_path, image), count)
+
+        writer.close()
         print(f"PDF generated successfully: {output_pdf_path}")
+        return True
     except Exception as e:
         print(f"An error occurred while generating the PDF: {e}")
+        return False
+
+def script_image_names(scripts):
+    """
+    Returns the file names of the tokens and of the reminders of the characters of the given scripts.
+    """
+    database = load_character_database()
+    script_ids = [character_id for script in scripts for character_id in read_script_ids(script)]
+    characters, unknown_ids = database.resolve(script_ids)
+    if unknown_ids:
+        print("These ids of the scripts are not characters and will not be printed:", unknown_ids)
+    token_names = [f"{character.id}.png" for character in characters]
+    reminder_names = [f"{character.id}_{reminder}.png" for character in characters for reminder in character.reminders]
+    return token_names, reminder_names
+
+def pdf_paths(script=None):
+    """
+    Returns the paths of the tokens and reminders PDFs, of a script if given.
+    """
+    if script is None:
+        return output_tokens_pdf_path, output_reminders_pdf_path
+    script_name = os.path.splitext(os.path.basename(script))[0]
+    output_folder = os.path.dirname(output_tokens_pdf_path)
+    return (os.path.join(output_folder, f'{script_name}_tokens_printable.pdf'),
+            os.path.join(output_folder, f'{script_name}_reminders_printable.pdf'))
+
+def print_pdfs(scripts=()):
+    """
+    Places every generated token and reminder on the two printable PDFs, or writes one pair of PDFs per script
+    with only its characters. Returns the paths of the PDFs that could not be written.
+    """
+    os.makedirs(os.path.dirname(output_tokens_pdf_path), exist_ok=True)
+    failed = []
+    if not scripts:
+        # Example usage for tokens and reminders with background color set to light gray
+        if not images_to_pdf(generated_tokens_folder_path, output_tokens_pdf_path, duplicates_tokens=True, **TOKENS_PDF_LAYOUT):
+            failed.append(output_tokens_pdf_path)
+        if not images_to_pdf(generated_reminders_folder_path, output_reminders_pdf_path, **REMINDERS_PDF_LAYOUT):
+            failed.append(output_reminders_pdf_path)
+    for script in scripts:
+        token_names, reminder_names = script_image_names([script])
+        tokens_pdf_path, reminders_pdf_path = pdf_paths(script)
+        if not images_to_pdf(generated_tokens_folder_path, tokens_pdf_path, duplicates_tokens=True, image_names=token_names, **TOKENS_PDF_LAYOUT):
+            failed.append(tokens_pdf_path)
+        if not images_to_pdf(generated_reminders_folder_path, reminders_pdf_path, image_names=reminder_names, **REMINDERS_PDF_LAYOUT):
+            failed.append(reminders_pdf_path)
+    return failed
+
+def stream_pdfs(scripts=(), jobs=1, save_images=False, force=False, backend=None):
+    """
+    Renders the tokens and reminders and places them on the printable PDFs as soon as they are rendered, instead of
+    placing the files written by generate_tokens_and_reminders.py: rendering and writing the PDFs overlap.
+
+    Up to date generated files are placed as they are, the other images are rendered (on jobs processes) and kept
+    in memory, or also saved to the generated folders with save_images. With scripts, one pair of PDFs is written
+    per script, with only its characters.
+    """
+    # Only imported to stream: it loads the rendering libraries
+    import generate_tokens_and_reminders as tokens
+    from build_cache import BuildManifest
+
+    database = load_character_database()
+    backend = backend or tokens.DEFAULT_ROLE_NAME_BACKEND
+    os.makedirs(os.path.dirname(output_tokens_pdf_path), exist_ok=True)
+    manifest = BuildManifest()
+    try:
+        for script in scripts or [None]:
+            characters = tokens.select_characters(database, [script] if script else ())
+            tokens_pdf_path, reminders_pdf_path = pdf_paths(script)
+            writers = {'token': PdfSheetWriter(tokens_pdf_path, **TOKENS_PDF_LAYOUT),
+                       'reminder': PdfSheetWriter(reminders_pdf_path, **REMINDERS_PDF_LAYOUT)}
+            copies = image_copies([f"{character['id']}.png" for character in characters], duplicates_tokens=True)
+            for kind, file_name, image in tokens.stream_print_images(characters, manifest, jobs, save_images, force, backend):
+                if image is None:
+                    print(f"{file_name} could not be rendered and is not printed")
+                    continue
+                writers[kind].add(file_name, image, copies.get(file_name, 1) if kind == 'token' else 1)
+            for writer in writers.values():
+                writer.close()
+                print(f"PDF generated successfully: {writer.output_pdf_path}")
+    finally:
+        if save_images:
+            manifest.save()
+        tokens.font_fitting.METRICS_CACHE.save()
 
 if __name__ == "__main__":
-    # Example usage for tokens and reminders with background color set to light gray
-    images_to_pdf(generated_tokens_folder_path, output_tokens_pdf_path, duplicates_tokens=True, image_new_size = 85, side_margin=0.5, between_margin=0.10, background_color=(86, 68, 46))
-    # 614 614 614 0.13 79
-    images_to_pdf(generated_reminders_folder_path, output_reminders_pdf_path, image_new_size=55, side_margin=0.5, between_margin=0.10, background_color=(45, 45, 45))
-    # 255 255 255 0.2 51
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Place the tokens and reminders on printable PDFs.')
+    parser.add_argument('scripts', nargs='*',
+                        help='Script JSONs (paths, or names of scripts in scripts_and_night_order_sheets/scripts): print one pair of PDFs per script, with only its characters. Default: every token.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Render the tokens and reminders while writing the PDFs, instead of placing the generated files.')
+    parser.add_argument('--jobs', type=int, default=1, help='With --stream, number of processes rendering tokens.')
+    parser.add_argument('--save-images', action='store_true', help='With --stream, also save the rendered images to the generated folders.')
+    parser.add_argument('--force', action='store_true', help='With --stream, render every image again, even the up to date generated files.')
+    parser.add_argument('--backend', choices=['wand', 'numpy'], default=None, help='With --stream, how role names are curved.')
+    add_tracing_arguments(parser)
+    args = parser.parse_args()
+    TRACER.configure(args.trace, args.profile, reset=True)
+
+    with TRACER.profile('pdf'):
+        if args.stream:
+            stream_pdfs(args.scripts, jobs=args.jobs, save_images=args.save_images, force=args.force, backend=args.backend)
+        else:
+            print_pdfs(args.scripts)
+    if args.trace:
+        print_trace_summary(args.trace)
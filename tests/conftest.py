@@ -0,0 +1,24 @@
+import os
+import sys
+import pytest
+
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import character_db
+
+
+@pytest.fixture(autouse=True)
+def repo_cwd(monkeypatch):
+    # The modules read their assets from paths relative to the repository
+    monkeypatch.chdir(REPO_PATH)
+
+
+@pytest.fixture(autouse=True)
+def character_db_cache(tmp_path, monkeypatch):
+    # The compiled character database is pickled in the test folder instead of img/token
+    cache_path = str(tmp_path / 'character_db.pickle')
+    monkeypatch.setattr(character_db, 'CHARACTER_DB_CACHE_PATH', cache_path)
+    monkeypatch.setattr(character_db.load_character_database, '__defaults__',
+                        character_db.load_character_database.__defaults__[:-1] + (cache_path,))
@@ -0,0 +1,40 @@
+import numpy as np
+from PIL import Image
+import generate_tokens_and_reminders as tokens
+from batch_composite import PIL_TOLERANCE, PIL_TOLERANCE_MIN_ALPHA
+
+
+def noisy_icon(seed, size=(300, 300)):
+    """
+    Stand-in for a scraped icon: random colors with every level of transparency.
+    """
+    pixels = np.random.default_rng(seed).integers(0, 256, size=(size[1], size[0], 4), dtype=np.uint8)
+    return Image.fromarray(pixels, 'RGBA')
+
+
+def assert_matches_pil(batch_image, pil_image):
+    batch = np.asarray(batch_image).astype(np.int16)
+    reference = np.asarray(pil_image).astype(np.int16)
+    assert batch.shape == reference.shape
+    opaque = reference[..., 3] >= PIL_TOLERANCE_MIN_ALPHA
+    assert np.abs(batch - reference)[opaque].max() <= PIL_TOLERANCE
+
+
+def test_token_batch_matches_pil():
+    # Stacks of different depths, like characters with more or fewer leaves
+    stacks = [
+        ['img/token/leaves/top-3.png', 'img/token/leaves/left-1.png', noisy_icon(1)],
+        ['img/token/leaves/right-1.png', 'img/token/leaves/setup.png', 'img/token/leaves/top-6.png', noisy_icon(2)],
+        [noisy_icon(3)],
+    ]
+    batch = tokens.overlay_batch_with_alpha_composite(tokens.TOKEN_BACKGROUND_PATH, stacks, tokens.TOKEN_MASK_COLOR)
+    assert len(batch) == len(stacks)
+    for image, stack in zip(batch, stacks):
+        assert_matches_pil(image, tokens.overlay_with_alpha_composite(tokens.TOKEN_BACKGROUND_PATH, stack, None, tokens.TOKEN_MASK_COLOR))
+
+
+def test_unmasked_reminder_batch_matches_pil():
+    stacks = [['img/token_bg/clockface-2-very_white.png', noisy_icon(seed)] for seed in range(4)]
+    batch = tokens.overlay_batch_with_alpha_composite(tokens.REMINDER_BACKGROUND_PATH, stacks, None)
+    for image, stack in zip(batch, stacks):
+        assert_matches_pil(image, tokens.overlay_with_alpha_composite(tokens.REMINDER_BACKGROUND_PATH, stack, None, None))
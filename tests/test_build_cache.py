@@ -0,0 +1,79 @@
+import os
+import pytest
+from PIL import Image
+from build_cache import BuildManifest, RenderStore, atomic_write, content_key
+from layer_cache import LayerCache
+
+
+def render(color):
+    return lambda: Image.new('RGBA', (32, 32), color)
+
+
+def test_render_store_renders_each_key_once(tmp_path):
+    store = RenderStore(str(tmp_path))
+    path = store.get_path('a', render((255, 0, 0, 255)))
+    assert store.get_path('a', render((0, 255, 0, 255))) == path
+    assert (store.renders, store.hits) == (1, 1)
+    assert Image.open(path).getpixel((0, 0)) == (255, 0, 0, 255)
+
+
+def test_render_store_prunes_the_least_recently_used_entries(tmp_path):
+    store = RenderStore(str(tmp_path))
+    paths = {key: store.get_path(key, render((index, 0, 0, 255))) for index, key in enumerate('abc')}
+    for index, key in enumerate('abc'):
+        os.utime(paths[key], ns=(index, os.stat(paths[key]).st_mtime_ns))
+    # Using a makes b the least recently used entry
+    store.get_path('a', render((0, 0, 0, 255)))
+
+    entry_size = os.path.getsize(paths['b'])
+    assert store.prune(2 * entry_size) == 1
+    assert not os.path.exists(paths['b'])
+    assert os.path.exists(paths['a']) and os.path.exists(paths['c'])
+    assert store.evictions == 1
+
+
+def test_render_store_stays_under_its_size(tmp_path):
+    entry_size = os.path.getsize(RenderStore(str(tmp_path / 'probe')).get_path('probe', render((0, 0, 0, 255))))
+    store = RenderStore(str(tmp_path / 'store'), max_bytes=4 * entry_size)
+    for index in range(10):
+        path = store.get_path(str(index), render((0, 0, 0, 255)))
+        assert os.path.exists(path)
+    assert sum(os.path.getsize(entry.path) for entry in os.scandir(tmp_path / 'store')) <= 4 * entry_size
+    assert store.evictions > 0
+
+
+def test_manifest_and_content_keys_agree(tmp_path):
+    input_path = tmp_path / 'input.txt'
+    input_path.write_text('first')
+    manifest = BuildManifest(str(tmp_path / 'manifest.json'))
+    key = manifest.build_key([str(input_path)], {'size': 1})
+    assert key == content_key({'size': 1}, [str(input_path)])
+    assert key != content_key({'size': 2}, [str(input_path)])
+
+    input_path.write_text('second, longer')
+    manifest.refresh()
+    assert manifest.build_key([str(input_path)], {'size': 1}) == content_key({'size': 1}, [str(input_path)]) != key
+
+
+def test_render_store_hits_keep_decoded_layers_cached(tmp_path):
+    store = RenderStore(str(tmp_path))
+    layers = LayerCache()
+    path = store.get_path('a', render((255, 0, 0, 255)))
+    mtime = os.stat(path).st_mtime_ns
+    first = layers.get(path)
+    assert store.get_path('a', render((255, 0, 0, 255))) == path
+    assert os.stat(path).st_mtime_ns == mtime
+    assert layers.get(path) is first
+    assert (layers.hits, layers.misses) == (1, 1)
+
+
+def test_atomic_write_keeps_the_previous_file_when_writing_fails(tmp_path):
+    path = tmp_path / 'state.json'
+    with atomic_write(str(path)) as file:
+        file.write('first')
+    with pytest.raises(ValueError):
+        with atomic_write(str(path)) as file:
+            file.write('half')
+            raise ValueError('interrupted')
+    assert path.read_text() == 'first'
+    assert os.listdir(tmp_path) == ['state.json']
@@ -0,0 +1,42 @@
+import json
+import pytest
+import arc_text
+import font_fitting
+from character_db import CHARACTERS_JSON_PATH
+from generate_tokens_and_reminders import ROLE_NAME_FONT_PATH, TOKEN_DIAMETER
+
+
+def shrink_loop(text, font_size, max_width):
+    """
+    The fitting loop fit_font_size replaces: shrinks the font by FONT_SHRINK_FACTOR until the text fits.
+    """
+    width, height = arc_text.measure_text(text, ROLE_NAME_FONT_PATH, font_size)
+    while width > max_width:
+        font_size *= font_fitting.FONT_SHRINK_FACTOR
+        width, height = arc_text.measure_text(text, ROLE_NAME_FONT_PATH, font_size)
+    return font_size, (width, height)
+
+
+@pytest.fixture
+def metrics_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(font_fitting, 'METRICS_CACHE', font_fitting.FontMetricsCache(str(tmp_path / 'font_metrics_cache.json')))
+
+
+def role_names():
+    with open(CHARACTERS_JSON_PATH, 'r') as file:
+        return sorted({character['name'].upper() for character in json.load(file)})
+
+
+# The role name width of curved_text_to_image, and narrower ones so most names need many shrink steps
+@pytest.mark.parametrize('width_fraction', [1, 0.5, 0.25, 0.1])
+def test_role_names_fit_at_the_sizes_of_the_shrink_loop(metrics_cache, width_fraction):
+    token_diameter = int(TOKEN_DIAMETER - TOKEN_DIAMETER * 0.1)
+    font_size, max_width = token_diameter * 0.15, 2 * token_diameter * 0.5 * width_fraction
+    different = {}
+    for name in role_names() + [name + ' OF THE LONG NIGHT' for name in role_names()]:
+        expected = shrink_loop(name, font_size, max_width)
+        fitted = font_fitting.fit_font_size(name, ROLE_NAME_FONT_PATH, font_size, max_width,
+                                            lambda size: arc_text.measure_text(name, ROLE_NAME_FONT_PATH, size), 'pil')
+        if fitted != expected:
+            different[name] = (fitted, expected)
+    assert different == {}
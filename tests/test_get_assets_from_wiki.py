@@ -0,0 +1,112 @@
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import get_assets_from_wiki as wiki
+
+
+ICONS = {'/images/a/a1/Icon_imp.png': b'imp icon', '/images/b/b2/Icon_baron.png': b'baron icon'}
+MOVED_IMP_PATH = '/images/c/c3/Icon_imp.png'
+
+
+class WikiHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the wiki: the File: page of the imp, and icons with an ETag, answered with a 304 when it matches.
+    """
+
+    requests = []
+    icons = ICONS
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path == '/File:Icon_imp.png':
+            imp_path = next(path for path in self.icons if path.endswith('Icon_imp.png'))
+            body = f'<a href="{imp_path}">Icon_imp.png</a>'.encode('utf-8')
+            self.send_response(200)
+        elif self.path in self.icons:
+            etag = f'"{self.path.rsplit("/", 1)[-1]}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = self.icons[self.path]
+            self.send_response(200)
+            self.send_header('ETag', etag)
+        else:
+            body = b'not found'
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def wiki_url():
+    WikiHandler.requests = []
+    WikiHandler.icons = ICONS
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WikiHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def scrape(wiki_url, tmp_path, characters=('baron', 'imp'), skip_existing=False):
+    return wiki.scrape_character_images(list(characters), {'baron': '/images/b/b2/Icon_baron.png'}, base_url=wiki_url, jobs=2,
+                                        skip_existing=skip_existing, images_dir=str(tmp_path / 'icons'),
+                                        state_path=str(tmp_path / 'state' / 'state.json'))
+
+
+def test_unchanged_icons_are_revalidated_with_a_conditional_get(wiki_url, tmp_path):
+    state = scrape(wiki_url, tmp_path)
+    assert (tmp_path / 'icons' / 'imp.png').read_bytes() == b'imp icon'
+    assert (tmp_path / 'icons' / 'baron.png').read_bytes() == b'baron icon'
+    assert state['imp']['etag'] == '"Icon_imp.png"'
+    with open(tmp_path / 'state' / 'state.json') as file:
+        assert json.load(file) == state
+
+    WikiHandler.requests = []
+    assert scrape(wiki_url, tmp_path) == state
+    # The File: page is not loaded again, and both icons are answered with a 304
+    assert sorted(WikiHandler.requests) == [('/images/a/a1/Icon_imp.png', '"Icon_imp.png"'),
+                                            ('/images/b/b2/Icon_baron.png', '"Icon_baron.png"')]
+    assert (tmp_path / 'icons' / 'imp.png').read_bytes() == b'imp icon'
+
+
+def test_skip_existing_only_requests_missing_icons(wiki_url, tmp_path):
+    scrape(wiki_url, tmp_path)
+    os.remove(tmp_path / 'icons' / 'baron.png')
+
+    WikiHandler.requests = []
+    scrape(wiki_url, tmp_path, skip_existing=True)
+    assert WikiHandler.requests == [('/images/b/b2/Icon_baron.png', None)]
+    assert (tmp_path / 'icons' / 'baron.png').read_bytes() == b'baron icon'
+
+
+def test_icon_that_cannot_be_written_does_not_stop_the_others(wiki_url, tmp_path):
+    # A folder in the way of the imp icon
+    os.makedirs(tmp_path / 'icons' / 'imp.png')
+    state = scrape(wiki_url, tmp_path)
+    assert 'imp' not in state
+    assert (tmp_path / 'icons' / 'baron.png').read_bytes() == b'baron icon'
+
+
+def test_moved_icon_is_found_again_on_its_file_page(wiki_url, tmp_path):
+    scrape(wiki_url, tmp_path)
+    WikiHandler.icons = {MOVED_IMP_PATH: b'new imp icon', '/images/b/b2/Icon_baron.png': b'baron icon'}
+
+    WikiHandler.requests = []
+    state = scrape(wiki_url, tmp_path, characters=['imp'])
+    assert [path for path, _ in WikiHandler.requests] == ['/images/a/a1/Icon_imp.png', '/File:Icon_imp.png', MOVED_IMP_PATH]
+    assert state['imp']['url'] == wiki_url + MOVED_IMP_PATH
+    assert (tmp_path / 'icons' / 'imp.png').read_bytes() == b'new imp icon'
+
+    # The next runs revalidate the new URL
+    WikiHandler.requests = []
+    scrape(wiki_url, tmp_path, characters=['imp'])
+    assert WikiHandler.requests == [(MOVED_IMP_PATH, '"Icon_imp.png"')]
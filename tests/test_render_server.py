@@ -0,0 +1,67 @@
+import io
+import json
+import threading
+import http.client
+import pytest
+from PIL import Image
+import generate_tokens_and_reminders as tokens
+import render_server
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # A stand-in scraped icon, so the imp token can be rendered without fetching the wiki
+    scraped_path = tmp_path / 'scraped_images'
+    scraped_path.mkdir()
+    Image.new('RGBA', (200, 200), (120, 30, 30, 255)).save(scraped_path / 'imp.png')
+    monkeypatch.setattr(tokens, 'SCRAPED_IMAGES_PATH', str(scraped_path))
+
+    server = render_server.create_server(render_server.RenderService(backend='numpy'), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path):
+    connection = http.client.HTTPConnection(*server.server_address[:2], timeout=120)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def test_token_is_rendered_then_cached(server):
+    status, headers, body = get(server, '/token/imp.png')
+    assert status == 200
+    assert headers['Content-Type'] == 'image/png'
+    assert headers['X-Cache'] == 'miss'
+    assert Image.open(io.BytesIO(body)).format == 'PNG'
+
+    status, headers, cached_body = get(server, '/token/imp.png')
+    assert status == 200
+    assert headers['X-Cache'] == 'hit'
+    assert cached_body == body
+
+    stats = json.loads(get(server, '/stats')[2])
+    assert stats['routes']['token']['requests'] == 2
+    assert stats['routes']['token']['hits'] == 1
+
+
+def test_unknown_paths_and_characters_are_not_found(server):
+    assert get(server, '/token/not-a-character.png')[0] == 404
+    assert get(server, '/reminder/imp/not-a-reminder.png')[0] == 404
+    assert get(server, '/night-sheet/not-a-script.jpg')[0] == 404
+    assert get(server, '/unknown')[0] == 404
+
+
+@pytest.mark.parametrize('path', ['/night-sheet/%2Fetc%2Fhostname.jpg',
+                                  '/night-sheet/..%2F..%2Fcharacters.pdf',
+                                  '/night-sheet/..%5Cnight-order.jpg'])
+def test_night_sheet_names_cannot_leave_the_scripts(server, path):
+    status, _, body = get(server, path)
+    assert status == 400
+    assert 'Invalid script name' in json.loads(body)['error']
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import cProfile
+import argparse
+import threading
+import contextlib
+import multiprocessing
+from collections import defaultdict
+
+
+DEFAULT_TRACE_PATH = 'output_prints/trace.jsonl'
+DEFAULT_PROFILE_DIR = 'output_prints/profiles'
+# Number of rows of each table of the trace summary
+SUMMARY_TOP = 10
+# Spans are written to the trace when a top-level span ends, or when this many are waiting
+FLUSH_SPANS = 1000
+
+
+class Span:
+    """
+    A timed section of work, written to the trace as one JSON line when it ends.
+    """
+
+    __slots__ = ('tracer', 'record', 'start')
+
+    def __init__(self, tracer, name, fields):
+        self.tracer = tracer
+        self.record = {'name': name, **fields}
+        self.start = None
+
+    def set(self, **fields):
+        """
+        Adds fields to the span, e.g. the number of bytes written once they are known.
+        """
+        self.record.update(fields)
+
+    def __enter__(self):
+        stack = self.tracer.stack
+        if stack:
+            parent = stack[-1].record
+            self.record['parent'] = parent['name']
+            for field in ('item', 'character'):
+                if field in parent and field not in self.record:
+                    self.record[field] = parent[field]
+        stack.append(self)
+        self.record['ts'] = round(time.time(), 6)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record['ms'] = round((time.perf_counter() - self.start) * 1000, 3)
+        if exc_type is not None:
+            self.record['error'] = f'{exc_type.__name__}: {exc_value}'
+        self.tracer.stack.pop()
+        self.tracer.emit(self.record)
+        return False
+
+
+class NullSpan:
+    """
+    The span returned while tracing is disabled: it records nothing.
+    """
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """
+    Per-process instrumentation of the pipeline: timing spans written as JSON lines, and cProfile dumps per stage.
+
+    Both are disabled until configure() is given a trace path or a profile directory, spans then cost a method call.
+    Spans nest: a span records the name of the span it runs in (in the same thread), and inherits its item and
+    character fields.
+    Worker processes are configured with the settings() of their parent and append to the same trace file;
+    every line has the pid of the process that wrote it.
+    """
+
+    def __init__(self):
+        self.trace_path = None
+        self.profile_dir = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.lines = []
+        self.profilers = {}
+        self.profiling = False
+
+    @property
+    def stack(self):
+        """
+        The spans running in the current thread, innermost last.
+        """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def configure(self, trace_path=None, profile_dir=None, reset=False):
+        """
+        Enables the trace and the profiling. With reset, an existing trace file is cleared first:
+        only the process starting a run should reset it.
+        """
+        self.flush()
+        self.trace_path = trace_path
+        self.profile_dir = profile_dir
+        if trace_path:
+            os.makedirs(os.path.dirname(trace_path) or '.', exist_ok=True)
+            if reset:
+                open(trace_path, 'w').close()
+
+    def settings(self):
+        """
+        Returns the keyword arguments of configure() enabling the same instrumentation in a worker process.
+        """
+        return {'trace_path': self.trace_path, 'profile_dir': self.profile_dir}
+
+    def span(self, name, **fields):
+        """
+        Returns a context manager timing the code it wraps, e.g.
+            with TRACER.span('png_encode', item=path) as span:
+                ...
+                span.set(bytes=size)
+        """
+        if self.trace_path is None:
+            return NULL_SPAN
+        return Span(self, name, fields)
+
+    def emit(self, record):
+        record['pid'] = os.getpid()
+        with self.lock:
+            self.lines.append(json.dumps(record) + '\n')
+        if not self.stack or len(self.lines) >= FLUSH_SPANS:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines, self.lines = self.lines, []
+        if not lines or not self.trace_path:
+            return
+        # Each flush is a single append, so the lines of concurrent processes do not interleave
+        with open(self.trace_path, 'a') as file:
+            file.write(''.join(lines))
+
+    def profile_path(self, stage):
+        if multiprocessing.parent_process() is not None:
+            stage = f'{stage}.{os.getpid()}'
+        return os.path.join(self.profile_dir, f'{stage}.prof')
+
+    @contextlib.contextmanager
+    def profile(self, stage):
+        """
+        Runs the code it wraps under cProfile when a profile directory is configured. The statistics of every
+        call for the same stage are accumulated and dumped to <profile_dir>/<stage>.prof (<stage>.<pid>.prof
+        in worker processes), to read with pstats or snakeviz.
+        Only the outermost profiled stage of a process is profiled: cProfile cannot run twice at once.
+        """
+        if self.profile_dir is None or self.profiling:
+            yield
+            return
+        profiler = self.profilers.setdefault(stage, cProfile.Profile())
+        self.profiling = True
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.profiling = False
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(self.profile_path(stage))
+
+
+TRACER = Tracer()
+
+
+def add_tracing_arguments(parser):
+    """
+    Adds the --trace and --profile options to the parser of a script.
+    """
+    parser.add_argument('--trace', nargs='?', const=DEFAULT_TRACE_PATH, default=None,
+                        help=f'Write a timing span of every step to a JSON lines file (default: {DEFAULT_TRACE_PATH}) and print the slowest ones.')
+    parser.add_argument('--profile', nargs='?', const=DEFAULT_PROFILE_DIR, default=None,
+                        help=f'Run each stage under cProfile and write its statistics to this folder (default: {DEFAULT_PROFILE_DIR}).')
+
+
+def read_trace(trace_path):
+    spans = []
+    with open(trace_path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                spans.append(json.loads(line))
+    return spans
+
+
+def summarize_trace(trace_path, top=SUMMARY_TOP):
+    """
+    Returns the lines of a summary of a trace: the time spent in each kind of span, and the slowest
+    characters and items. Top-level spans are the ones that do not run inside another span.
+    """
+    spans = read_trace(trace_path)
+    if not spans:
+        return [f'No spans in {trace_path}']
+
+    stages = defaultdict(list)
+    stage_bytes = defaultdict(int)
+    characters = defaultdict(float)
+    for span in spans:
+        stages[span['name']].append(span['ms'])
+        stage_bytes[span['name']] += span.get('bytes', 0)
+        if 'character' in span and 'parent' not in span:
+            characters[span['character']] += span['ms']
+
+    lines = [f"{'span':<24}{'count':>8}{'total s':>10}{'mean ms':>10}{'p95 ms':>10}{'max ms':>10}{'MB':>9}"]
+    for name, durations in sorted(stages.items(), key=lambda stage: -sum(stage[1])):
+        durations.sort()
+        p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+        lines.append(f'{name:<24}{len(durations):>8}{sum(durations) / 1000:>10.2f}{sum(durations) / len(durations):>10.1f}'
+                     f'{p95:>10.1f}{durations[-1]:>10.1f}{stage_bytes[name] / 1e6:>9.1f}')
+
+    if characters:
+        lines.append('')
+        lines.append('Slowest characters (token and reminders):')
+        for character, duration in sorted(characters.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f'  {character:<30}{duration:>10.1f} ms')
+
+    top_level = sorted((span for span in spans if 'parent' not in span), key=lambda span: -span['ms'])[:top]
+    lines.append('')
+    lines.append('Slowest items:')
+    for span in top_level:
+        lines.append(f"  {span['name']:<20}{str(span.get('item', '')):<40}{span['ms']:>10.1f} ms")
+    return lines
+
+
+def print_trace_summary(trace_path, top=SUMMARY_TOP):
+    TRACER.flush()
+    print(f'Trace written to {trace_path}')
+    for line in summarize_trace(trace_path, top):
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize a trace written with --trace.')
+    parser.add_argument('trace', nargs='?', default=DEFAULT_TRACE_PATH, help='The JSON lines trace file.')
+    parser.add_argument('--top', type=int, default=SUMMARY_TOP, help='Number of slowest characters and items to show.')
+    args = parser.parse_args()
+    for line in summarize_trace(args.trace, args.top):
+        print(line)